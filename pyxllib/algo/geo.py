@@ -357,6 +357,180 @@ class ComputeIou:
         polygon1, polygon2 = ShapelyPolygon.gen(pts1), ShapelyPolygon.gen(pts2)
         return cls.polygon(polygon1, polygon2)
 
+    @classmethod
+    def ltrb_matrix(cls, boxes1, boxes2=None):
+        """ 两组ltrb框两两之间的交并比矩阵，numpy向量化计算
+
+        :param boxes1: n个框，n*4的list或np.ndarray
+        :param boxes2: m个框，默认跟boxes1相同
+        :return: n*m的np.ndarray，跟逐对调用ltrb的结果一致
+
+        >>> ComputeIou.ltrb_matrix([[0, 0, 10, 10], [5, 5, 15, 15]], [[0, 0, 10, 10]]).round(4).tolist()
+        [[1.0], [0.1429]]
+        """
+        a = np.asarray(boxes1, dtype=float).reshape(-1, 4)
+        b = a if boxes2 is None else np.asarray(boxes2, dtype=float).reshape(-1, 4)
+        lt = np.maximum(a[:, None, :2], b[None, :, :2])
+        rb = np.minimum(a[:, None, 2:], b[None, :, 2:])
+        wh = np.clip(rb - lt, 0, None)
+        inter = wh[..., 0] * wh[..., 1]
+        union = cls._ltrb_areas(a)[:, None] + cls._ltrb_areas(b)[None, :] - inter
+        return np.divide(inter, union, out=np.zeros_like(inter), where=inter > 0)
+
+    @classmethod
+    def xywh_matrix(cls, boxes1, boxes2=None):
+        """ 两组xywh框两两之间的交并比矩阵 """
+        boxes1 = cls._xywh2ltrb_array(boxes1)
+        boxes2 = None if boxes2 is None else cls._xywh2ltrb_array(boxes2)
+        return cls.ltrb_matrix(boxes1, boxes2)
+
+    @classmethod
+    def _ltrb_areas(cls, boxes):
+        return np.abs((boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1]))
+
+    @classmethod
+    def _xywh2ltrb_array(cls, boxes):
+        boxes = np.array(boxes, dtype=float).reshape(-1, 4)
+        boxes[:, 2:] += boxes[:, :2]
+        return boxes
+
+    @classmethod
+    def _ltrb_iou_one(cls, box, boxes, areas, box_area):
+        """ 一个框和一组框的交并比，nms内部用，面积都是预先算好的 """
+        w = np.clip(np.minimum(box[2], boxes[:, 2]) - np.maximum(box[0], boxes[:, 0]), 0, None)
+        h = np.clip(np.minimum(box[3], boxes[:, 3]) - np.maximum(box[1], boxes[:, 1]), 0, None)
+        inter = w * h
+        union = box_area + areas - inter
+        return np.divide(inter, union, out=np.zeros_like(inter), where=inter > 0)
+
+    @classmethod
+    def nms_ltrb_indices(cls, boxes, iou=0.5, scores=None):
+        """ 向量化的贪心nms，返回保留下来的框的下标
+
+        :param boxes: n*4的ltrb框
+        :param scores: 框的权重，默认认为boxes已经按权重从大到小排过序
+        :return: list，保留框的下标，按权重从大到小
+
+        每保留一个框，就用向量化的方式一次算出它和剩余所有框的交并比，
+        复杂度是O(n*保留框数)，但不会像算整个n*n矩阵那样占用大量内存
+        """
+        boxes = np.asarray(boxes, dtype=float).reshape(-1, 4)
+        if scores is None:
+            order = np.arange(len(boxes))
+        else:
+            order = np.argsort(-np.asarray(scores, dtype=float), kind='stable')
+        areas = cls._ltrb_areas(boxes)
+
+        keep = []
+        while order.size:
+            i = order[0]
+            keep.append(int(i))
+            rest = order[1:]
+            ious = cls._ltrb_iou_one(boxes[i], boxes[rest], areas[rest], areas[i])
+            order = rest[ious < iou]
+        return keep
+
+    @classmethod
+    def soft_nms_ltrb(cls, boxes, scores, iou=0.3, *, sigma=0.5, method='gaussian', score_threshold=0.001):
+        """ soft-nms，不直接删除重叠框，而是按重叠程度降低它们的分数
+
+        Bodla et al. Soft-NMS -- Improving Object Detection With One Line of Code. ICCV 2017.
+
+        :param boxes: n*4的ltrb框
+        :param scores: 每个框的分数
+        :param iou: linear模式下，交并比超过这个值才衰减分数
+        :param sigma: gaussian模式的衰减参数，分数乘以 exp(-iou²/sigma)
+        :param method: gaussian、linear，或者hard（等价于普通nms）
+        :param score_threshold: 衰减后分数低于该值的框会被丢弃
+        :return: (keep, new_scores)，保留框的下标，以及对应的衰减后分数，按选中的先后顺序
+        """
+        boxes = np.asarray(boxes, dtype=float).reshape(-1, 4)
+        scores = np.array(scores, dtype=float).reshape(-1)
+        areas = cls._ltrb_areas(boxes)
+        idxs = np.arange(len(boxes))
+
+        keep, keep_scores = [], []
+        while idxs.size:
+            k = np.argmax(scores[idxs])
+            i = idxs[k]
+            keep.append(int(i))
+            keep_scores.append(float(scores[i]))
+            idxs = np.delete(idxs, k)
+            if not idxs.size:
+                break
+            ious = cls._ltrb_iou_one(boxes[i], boxes[idxs], areas[idxs], areas[i])
+            if method == 'gaussian':
+                weights = np.exp(-(ious * ious) / sigma)
+            elif method == 'linear':
+                weights = np.where(ious >= iou, 1 - ious, 1)
+            elif method == 'hard':
+                weights = (ious < iou).astype(float)
+            else:
+                raise ValueError(f'不支持的方法 {method}')
+            scores[idxs] *= weights
+            idxs = idxs[scores[idxs] >= score_threshold]
+        return keep, keep_scores
+
+    @classmethod
+    def polygon_matrix(cls, polys1, polys2=None):
+        """ 两组多边形两两之间的交并比矩阵
+
+        :param polys1: n个多边形，支持ShapelyPolygon.gen能处理的各种格式
+        :param polys2: m个多边形，默认跟polys1相同
+        :return: n*m的np.ndarray
+
+        >>> ComputeIou.polygon_matrix([[[0, 0], [10, 10]]], [[[5, 5], [15, 15]], [[20, 20], [30, 30]]]).round(4).tolist()
+        [[0.1429, 0.0]]
+        """
+        import shapely
+        from pyxllib.algo.shapelylib import ShapelyPolygon, polygon_intersection_matrix
+
+        geoms1 = ShapelyPolygon.gen_array(polys1)
+        geoms2 = geoms1 if polys2 is None else ShapelyPolygon.gen_array(polys2)
+        inter = polygon_intersection_matrix(geoms1, geoms2)
+        union = shapely.area(geoms1)[:, None] + shapely.area(geoms2)[None, :] - inter
+        return np.divide(inter, union, out=np.zeros_like(inter), where=(inter > 0) & (union > 0))
+
+    @classmethod
+    def nms_polygon_indices(cls, polys, iou=0.5, scores=None):
+        """ 多边形的贪心nms，返回保留下来的多边形下标，参数同nms_ltrb_indices
+
+        多边形只构造一次，用STRtree筛出外接矩形相交的候选对，再向量化算出这些候选对的交并比，
+        每个多边形只需要记录跟它重叠超过阈值的邻居，贪心保留时直接抑制这些邻居
+        """
+        import shapely
+        from pyxllib.algo.shapelylib import ShapelyPolygon
+
+        geoms = ShapelyPolygon.gen_array(polys)
+        n = len(geoms)
+        if scores is None:
+            order = np.arange(n)
+        else:
+            order = np.argsort(-np.asarray(scores, dtype=float), kind='stable')
+
+        # 1 找出所有交并比超过阈值的多边形对
+        idxs1, idxs2 = shapely.STRtree(geoms).query(geoms)
+        mask = idxs1 < idxs2
+        idxs1, idxs2 = idxs1[mask], idxs2[mask]
+        inter = shapely.area(shapely.intersection(geoms[idxs1], geoms[idxs2]))
+        areas = shapely.area(geoms)
+        union = areas[idxs1] + areas[idxs2] - inter
+        ious = np.divide(inter, union, out=np.zeros_like(inter), where=(inter > 0) & (union > 0))
+        mask = ious >= iou
+        idxs1, idxs2 = idxs1[mask], idxs2[mask]
+        neighbors = [[] for _ in range(n)]
+        for i, j in zip(idxs1.tolist(), idxs2.tolist()):
+            neighbors[i].append(j)
+            neighbors[j].append(i)
+
+        # 2 贪心保留
+        keep, suppressed = [], np.zeros(n, dtype=bool)
+        for i in order.tolist():
+            if not suppressed[i]:
+                keep.append(i)
+                suppressed[neighbors[i]] = True
+        return keep
+
     @classmethod
     def nms_basic(cls, boxes, func, iou=0.5, *, key=None, index=False):
         """ 假设boxes已经按权重从大到小排过序
@@ -392,7 +566,15 @@ class ComputeIou:
 
     @classmethod
     def nms_ltrb(cls, boxes, iou=0.5, *, key=None, index=False):
-        return cls.nms_basic(boxes, cls.ltrb, iou, key=key, index=index)
+        """ ltrb框的nms，内部用nms_ltrb_indices向量化计算 """
+        if not len(boxes):
+            return []
+        ltrbs = [key(b) for b in boxes] if callable(key) else boxes
+        idxs = cls.nms_ltrb_indices(ltrbs, iou)
+        if index:
+            return idxs
+        else:
+            return [boxes[i] for i in idxs]
 
     @classmethod
     def nms_xywh(cls, boxes, iou=0.5, *, key=None, index=False):
@@ -404,8 +586,18 @@ class ComputeIou:
 
     @classmethod
     def nms_polygon(cls, boxes, iou=0.5, *, key=None, index=False):
-        # ShapelyPolygon.gen
-        return cls.nms_basic(boxes, cls.polygon, iou, key=key, index=index)
+        """ 多边形的nms，内部用nms_polygon_indices计算
+
+        :param key: 将框映射为ShapelyPolygon.gen能处理的多边形格式
+        """
+        if not len(boxes):
+            return []
+        polys = [key(b) for b in boxes] if callable(key) else boxes
+        idxs = cls.nms_polygon_indices(polys, iou)
+        if index:
+            return idxs
+        else:
+            return [boxes[i] for i in idxs]
 
 
 ____other = """
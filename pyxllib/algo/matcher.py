@@ -89,6 +89,337 @@ def compute_text_similarity_favoring_length(text1, text2, baseline=100, scale=10
     return min(weighted_similarity, 1.0)
 
 
+def _qgram_codes(text, q=1):
+    """ 把字符串里每个长度为q的gram编码成一个整数，码位最多21位，所以q最大支持3 """
+    codes = np.frombuffer(text.encode('utf-32-le', 'surrogatepass'), dtype='<u4').astype(np.int64)
+    m = max(len(codes) - q + 1, 0)
+    grams = codes[:m].copy()
+    for k in range(1, q):
+        grams |= codes[k:k + m] << (21 * k)
+    return grams
+
+
+class LevenshteinIndex:
+    """ 按Levenshtein.ratio检索相似字符串的倒排索引
+
+    ratio = 2*LCS/(len1+len2)，而公共子序列长度不会超过两串"字符多重集的交集"大小，
+    所以用"字符 -> (含该字符的字符串, 出现次数)"的倒排表，能一次性算出query跟所有候选的ratio上界。
+    再配合长度上界 ratio <= 2*min(len1,len2)/(len1+len2)，只需要按上界从高到低精算少量候选，
+    上界低于当前第top_n名时就能提前结束。这是精确剪枝，结果跟逐个计算ratio再排序完全一致。
+
+    字母表很小的数据，每个字符的倒排表都很长，这时可以改用q-gram倒排表。
+    设公共q-gram数为g，有 LCS <= (g + (q-1)*(len1+len2+1)) / (2q-1)，仍是精确剪枝，
+    但g=0时上界约为2(q-1)/(2q-1)，所以q=2只在score_cutoff>2/3时、q=3只在score_cutoff>0.8时才有剪枝效果。
+
+    >> index = LevenshteinIndex(['abc', 'abd', 'xyz'])
+    >> index.query('abc', top_n=2)
+    [(0, 1.0), (1, 0.6666666666666667)]
+    """
+
+    def __init__(self, strings=(), q=1):
+        """
+        :param q: 倒排表的gram长度，支持1~3，默认1按单字符建索引
+        """
+        if q not in (1, 2, 3):
+            raise ValueError(f'Invalid q: {q}')
+        self.strings = list(strings)
+        self.q = q
+        self._arrays = None  # 懒构建，增删数据后置空
+
+    def __len__(self):
+        return len(self.strings)
+
+    @classmethod
+    def suggest_q(cls, min_similarity):
+        """ 按相似度阈值推荐q，阈值越高，越长的gram剪枝效果越好 """
+        if min_similarity >= 0.85:
+            return 3
+        elif min_similarity >= 0.7:
+            return 2
+        return 1
+
+    def add(self, s):
+        self.strings.append(s)
+        self._arrays = None
+
+    def build(self):
+        """ 构建倒排表，所有字符串按长度排序后编号，这样长度剪枝就是一段连续区间 """
+        if self._arrays is not None:
+            return self
+        n = len(self.strings)
+        lengths = np.fromiter(map(len, self.strings), dtype=np.int64, count=n)
+        order = np.argsort(lengths, kind='stable')
+        lengths = lengths[order]
+
+        # 所有字符串拼成一个码位数组，向量化统计每个(gram, 字符串)的出现次数
+        text = ''.join([self.strings[i] for i in order])
+        grams = _qgram_codes(text, self.q)
+        pos = np.repeat(np.arange(n, dtype=np.int64), lengths)[:len(grams)]
+        if self.q > 1:  # 去掉跨越两个字符串的gram
+            valid = np.cumsum(lengths)[pos] >= np.arange(len(grams)) + self.q
+            grams, pos = grams[valid], pos[valid]
+        uchars, gram_ids = np.unique(grams, return_inverse=True)
+        # 倒排表的键是 gram编号*n+字符串编号，整体有序，每个gram的倒排表是其中连续的一段
+        keys, counts = np.unique(gram_ids.reshape(-1) * max(n, 1) + pos, return_counts=True)
+
+        self._arrays = {'order': order, 'lengths': lengths, 'uchars': uchars, 'post_key': keys,
+                        'post_pos': (keys % max(n, 1)).astype(np.int32), 'post_cnt': counts.astype(np.int32)}
+        return self
+
+    def upper_bounds(self, s, score_cutoff=0.0):
+        """ 计算s跟候选的ratio上界
+
+        :return: (positions, bounds)，positions是候选按长度排序后的编号，没列出的候选ratio一定小于score_cutoff
+        """
+        a = self.build()._arrays
+        lengths, lq = a['lengths'], len(s)
+
+        # 1 长度剪枝
+        lo, hi = 0, len(lengths)
+        if score_cutoff > 0:
+            r = min(score_cutoff, 1.0)
+            lo = int(np.searchsorted(lengths, lq * r / (2 - r) - 1e-9, 'left'))
+            hi = int(np.searchsorted(lengths, lq * (2 - r) / r + 1e-9, 'right'))
+
+        # 2 用倒排表累加公共gram数，一次searchsorted就能定位所有gram倒排表里落在长度区间的那段
+        q = self.q
+        positions, common = np.arange(lo, hi), np.zeros(hi - lo)
+        if lq >= q and hi > lo and len(a['uchars']):
+            qcodes, qcounts = np.unique(_qgram_codes(s, q), return_counts=True)
+            uchars, keys, nn = a['uchars'], a['post_key'], max(len(lengths), 1)
+            slots = np.minimum(np.searchsorted(uchars, qcodes), len(uchars) - 1)
+            hit = uchars[slots] == qcodes
+            slots, qcounts = slots[hit], qcounts[hit]
+
+            b = np.searchsorted(keys, slots * nn + lo)
+            e = np.searchsorted(keys, slots * nn + hi)
+            sizes = e - b
+            idx = np.repeat(b - np.cumsum(sizes) + sizes, sizes) + np.arange(sizes.sum())
+            cnts = np.minimum(a['post_cnt'][idx], np.repeat(qcounts, sizes))
+            common = np.bincount(a['post_pos'][idx] - lo, cnts, hi - lo)
+
+        # 3 没有公共gram的候选上界也低于score_cutoff时，只需要看倒排表里出现过的候选
+        if score_cutoff > 0 and hi > lo:
+            # 没有公共gram时，不取整的上界2(q-1)(total+1)/((2q-1)total)随总长度递减，取区间内最短的算
+            total = lq + lengths[lo]
+            if total and 2 * (q - 1) * (total + 1) / ((2 * q - 1) * total) < score_cutoff - 1e-9:
+                touched = np.flatnonzero(common)
+                positions, common = positions[touched], common[touched]
+        common = common.astype(np.int64)
+
+        total = lq + lengths[positions]
+        lcs = np.minimum((common + (q - 1) * (total + 1)) // (2 * q - 1), np.minimum(lengths[positions], lq))
+        bounds = np.ones(len(positions))  # 两个空串的ratio是1
+        np.divide(2 * lcs, total, out=bounds, where=total > 0)
+        return positions, bounds
+
+    def query(self, s, top_n=1, score_cutoff=0.0):
+        """ 找出跟s最相似的top_n个字符串
+
+        :param top_n: 返回数量，None表示返回所有满足score_cutoff的结果
+        :param score_cutoff: 只返回ratio>=score_cutoff的结果，设置后能利用长度剪枝，大幅减少计算量
+        :return: [(下标, ratio), ...]，按ratio降序，相同ratio时下标小的在前
+        """
+        if top_n is None:
+            top_n = len(self.strings)
+        if top_n <= 0 or not self.strings:
+            return []
+
+        positions, bounds = self.upper_bounds(s, score_cutoff)
+        order = self._arrays['order'][positions]
+
+        # 1 按上界从高到低精算，上界不可能挤进前top_n时提前结束
+        if score_cutoff > 0:
+            cand = np.flatnonzero(bounds >= score_cutoff - 1e-9)
+        else:
+            cand = np.flatnonzero(bounds > 0)
+        cand = cand[np.lexsort((order[cand], -bounds[cand]))]
+        heap = []  # (ratio, -下标)的最小堆
+        for p in cand:
+            if len(heap) >= top_n and bounds[p] + 1e-9 < heap[0][0]:
+                break
+            i = int(order[p])
+            sim = Levenshtein.ratio(s, self.strings[i])
+            if sim < score_cutoff:
+                continue
+            if len(heap) < top_n:
+                heapq.heappush(heap, (sim, -i))
+            elif (sim, -i) > heap[0]:
+                heapq.heapreplace(heap, (sim, -i))
+        res = [(-i, sim) for sim, i in sorted(heap, reverse=True)]
+
+        # 2 上界为0的候选ratio都是0，score_cutoff<=0时要按下标顺序补足
+        if score_cutoff <= 0 and len(res) < top_n:
+            zeros = np.sort(order[bounds <= 0])[:top_n - len(res)]
+            res += [(int(i), 0.0) for i in zeros]
+        return res
+
+    def query_batch(self, queries, top_n=1, score_cutoff=0.0, *, max_workers=1, pbar=None):
+        """ 批量检索，max_workers!=1时用多进程并行
+
+        索引会随任务序列化到子进程，所以会把queries切成"进程数*4"块左右，每块只传一次索引。
+        进程池启动有几秒开销，query数量少的时候单进程反而更快。
+
+        :return: 每个query对应一个query()的结果列表
+        """
+        self.build()
+        queries = list(queries)
+        if max_workers == 1:
+            return [self.query(q, top_n, score_cutoff) for q in tqdm(queries, disable=not pbar)]
+
+        import functools
+        from pyxllib.prog.specialist.xlexecutor import XlExecutor
+
+        executor = XlExecutor(max_workers, 'process')
+        executor.chunk_size = max(1, math.ceil(len(queries) / (executor.max_workers * 4)))
+        func = functools.partial(self.query, top_n=top_n, score_cutoff=score_cutoff)
+        return list(executor.map(func, queries, pbar=pbar))
+
+    def similarity_graph(self, min_similarity, top_k=None, *, max_workers=1, pbar=None):
+        """ 所有字符串两两之间ratio>=min_similarity的稀疏图，内存跟边数成正比，不需要n*n的矩阵
+
+        每个字符串作为query检索一遍索引，所以可以用max_workers多进程分块计算。
+        min_similarity太小时几乎所有点对都是边，就失去稀疏的意义了。
+
+        :param top_k: 每个字符串最多保留的近邻数，即kNN图，None表示不限
+        :return: (rows, cols, sims)，rows<cols，每条边只出现一次
+        """
+        n = len(self.strings)
+        top_n = None if top_k is None else top_k + 1  # 会检索到自己，要多取一个
+        res = self.query_batch(self.strings, top_n, min_similarity, max_workers=max_workers, pbar=pbar)
+
+        rows = np.repeat(np.arange(n, dtype=np.int64), [len(x) for x in res])
+        cols = np.array([i for x in res for i, _ in x], dtype=np.int64)
+        sims = np.array([sim for x in res for _, sim in x], dtype=np.float64)
+        rows, cols = np.minimum(rows, cols), np.maximum(rows, cols)
+        keep = rows < cols
+        # kNN图里a检索到b、b检索到a是同一条边，去重
+        _, first = np.unique(rows[keep] * max(n, 1) + cols[keep], return_index=True)
+        return rows[keep][first], cols[keep][first], sims[keep][first]
+
+
+def sparse_agglomerative_clustering(n, rows, cols, sims, threshold=0.5, linkage='average'):
+    """ 在稀疏相似度图上做层次聚类，不需要n*n的距离矩阵
+
+    距离=1-相似度，跟AgglomerativeClustering(distance_threshold=threshold)一样，距离小于threshold的类才会合并。
+    图里没有的边视为距离1：
+        single，等价于距离<threshold的边构成的连通分量
+        complete，图里包含了所有距离<threshold的边、且距离没有并列值时，结果跟稠密矩阵的层次聚类一致
+            有并列距离时合并先后可能不同，分组结果也可能跟着不同
+        average，缺失的点对按距离1参与平均，是稠密结果的近似，分出的类会偏细一些
+
+    :param n: 样本数
+    :param rows, cols, sims: 稀疏图的边，每条边只出现一次
+    :return: 长度n的类别标签数组
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    cols = np.asarray(cols, dtype=np.int64)
+    sims = np.asarray(sims, dtype=np.float64)
+
+    if linkage == 'single':
+        from scipy.sparse import coo_matrix
+        from scipy.sparse.csgraph import connected_components
+
+        keep = 1 - sims < threshold
+        graph = coo_matrix((np.ones(keep.sum(), dtype=np.int8), (rows[keep], cols[keep])), shape=(n, n))
+        return connected_components(graph, directed=False)[1]
+    elif linkage not in ('complete', 'average'):
+        raise ValueError(f'Invalid linkage: {linkage}')
+
+    # 1 每个类跟相邻类之间的边统计：[相似度之和, 最小相似度, 边数]
+    sizes = [1] * n
+    nbrs = [dict() for _ in range(n)]
+    for i, j, sim in zip(rows.tolist(), cols.tolist(), sims.tolist()):
+        if i != j:
+            nbrs[i][j] = nbrs[j][i] = [sim, sim, 1]
+
+    def distance(a, b, stat):
+        if linkage == 'average':
+            return 1 - stat[0] / (sizes[a] * sizes[b])
+        # complete要求两类间所有点对都有边，否则存在距离>=threshold的点对
+        return 1 - stat[1] if stat[2] == sizes[a] * sizes[b] else 1.0
+
+    heap = [(distance(a, b, stat), a, b) for a in range(n) for b, stat in nbrs[a].items() if a < b]
+    heap = [x for x in heap if x[0] < threshold]
+    heapq.heapify(heap)
+
+    # 2 每次合并距离最近的两个类，合并出的新类用新编号，旧编号作废，所以堆里的旧记录直接跳过即可
+    parent = list(range(n))
+    while heap:
+        _, a, b = heapq.heappop(heap)
+        if nbrs[a] is None or nbrs[b] is None:
+            continue
+        c = len(sizes)
+        sizes.append(sizes[a] + sizes[b])
+        parent.append(c)
+        parent[a] = parent[b] = c
+
+        merged = {}
+        for x in (a, b):
+            for k, stat in nbrs[x].items():
+                if k == a or k == b:
+                    continue
+                del nbrs[k][x]
+                m = merged.get(k)
+                merged[k] = list(stat) if m is None else [m[0] + stat[0], min(m[1], stat[1]), m[2] + stat[2]]
+            nbrs[x] = None
+        nbrs.append(merged)
+
+        for k, stat in merged.items():
+            nbrs[k][c] = stat
+            d = distance(c, k, stat)
+            if d < threshold:
+                heapq.heappush(heap, (d, k, c))
+
+    # 3 新类的编号总比被合并的类大，倒序一遍就能找到每个样本最终所在的类
+    root = list(range(len(parent)))
+    for c in range(len(parent) - 1, -1, -1):
+        if parent[c] != c:
+            root[c] = root[parent[c]]
+    return np.unique(root[:n], return_inverse=True)[1]
+
+
+def sparse_cluster_groups(indices, labels, rows, cols, sims, strategy='center'):
+    """ 把稀疏聚类的结果整理成{代表样本: 同组样本列表}，按组员数从多到少排序
+
+    :param indices: 参与聚类的数据下标，labels、rows、cols都是它的局部下标
+    :param strategy: 选择组代表的策略
+        center，组内跟其他样本的相似度之和最大的样本，图里没有的边相似度按0算
+        first，组内第一个样本
+    """
+    labels = np.asarray(labels)
+    rows = np.asarray(rows, dtype=np.int64)
+    cols = np.asarray(cols, dtype=np.int64)
+    same = labels[rows] == labels[cols]
+    scores = np.bincount(rows[same], np.asarray(sims)[same], len(labels)) \
+             + np.bincount(cols[same], np.asarray(sims)[same], len(labels))
+
+    cluster_dict = defaultdict(list)
+    for i, label in enumerate(labels):
+        cluster_dict[label].append(i)
+
+    result = {}
+    for label, items in sorted(cluster_dict.items(), key=lambda x: -len(x[1])):
+        if strategy == 'first':
+            representative = items[0]
+        elif strategy == 'center':
+            representative = items[int(np.argmax(scores[items]))]
+        else:
+            raise ValueError(f'Invalid strategy: {strategy}')
+        result[indices[representative]] = [indices[i] for i in items]
+    return result
+
+
+def _similarity_row_edges(compute_similarity, items, min_similarity, i):
+    """ 第i个数据跟它后面的数据两两计算相似度，只保留>=min_similarity的边 """
+    edges = []
+    for j in range(i + 1, len(items)):
+        sim = compute_similarity(items[i], items[j])
+        if sim >= min_similarity:
+            edges.append((i, j, sim))
+    return edges
+
+
 class DataMatcher:
     """ 泛化的匹配类，对任何类型的数据进行匹配 """
 
@@ -98,12 +429,14 @@ class DataMatcher:
         """
         self.cmp_key = cmp_key
         self.data = []  # 用于匹配的数据
+        self._index = None  # 编辑距离检索用的LevenshteinIndex，数据变动后置空
 
     def __getitem__(self, i):
         return self.data[i]
 
     def __delitem__(self, i):
         del self.data[i]
+        self._index = None
 
     def __len__(self):
         return len(self.data)
@@ -118,22 +451,54 @@ class DataMatcher:
     def add_candidate(self, data):
         """添加候选数据"""
         self.data.append(data)
-
-    def find_best_matches(self, item, top_n=1, print_mode=0):
+        self._index = None
+
+    def _get_index(self):
+        """ 默认的字符串编辑距离可以用倒排索引加速，子类重载了compute_similarity、或数据不是字符串时返回None """
+        if type(self).compute_similarity is not DataMatcher.compute_similarity:
+            return None
+        if self._index is None or len(self._index) != len(self.data):
+            keys = [x[self.cmp_key] for x in self.data] if self.cmp_key else self.data
+            if not all(isinstance(k, str) for k in keys):
+                return None
+            self._index = LevenshteinIndex(keys)
+        return self._index
+
+    def find_best_matches(self, item, top_n=1, print_mode=0, *, score_cutoff=0):
         """ 找到与给定数据项最匹配的候选项。
 
         :param item: 需要匹配的数据项。
         :param top_n: 返回的最佳匹配数量。
+        :param score_cutoff: 只返回相似度>=score_cutoff的候选，字符串匹配时还能用来做长度剪枝
         :return: 一个包含(index, similarity)的元组列表，代表最佳匹配。
         """
-        # 计算所有候选数据的相似度
-        similarities = [(i, self.compute_similarity(candidate, item))
-                        for i, candidate in tqdm(enumerate(self.data), disable=not print_mode)]
+        index = self._get_index()
+        if index is not None and isinstance(item, str):
+            return index.query(item, top_n, score_cutoff)
+
+        # 计算所有候选数据的相似度，只保留前top_n个
+        similarities = ((i, self.compute_similarity(candidate, item))
+                        for i, candidate in tqdm(enumerate(self.data), disable=not print_mode))
+        similarities = (x for x in similarities if x[1] >= score_cutoff)
+        return heapq.nlargest(top_n, similarities, key=lambda x: x[1])
+
+    def find_best_matches_batch(self, items, top_n=1, *, score_cutoff=0, max_workers=1, print_mode=0):
+        """ 批量匹配，返回每个item对应的find_best_matches结果
+
+        :param max_workers: 不为1时用多进程并行
+        """
+        items = list(items)
+        index = self._get_index()
+        if index is not None and all(isinstance(x, str) for x in items):
+            return index.query_batch(items, top_n, score_cutoff, max_workers=max_workers, pbar=print_mode or None)
 
-        # 按相似度降序排序
-        sorted_matches = sorted(similarities, key=lambda x: x[1], reverse=True)
+        import functools
+        from pyxllib.prog.specialist.xlexecutor import XlExecutor
 
-        return sorted_matches[:top_n]
+        func = functools.partial(self.find_best_matches, top_n=top_n, score_cutoff=score_cutoff)
+        if max_workers == 1:
+            return [func(x) for x in tqdm(items, disable=not print_mode)]
+        return list(XlExecutor(max_workers, 'process').map(func, items, pbar=print_mode or None))
 
     def find_best_match_items(self, item, top_n=1):
         """ 直接返回匹配的数据内容，而不是下标和相似度 """
@@ -150,12 +515,56 @@ class DataMatcher:
         items = self.find_best_match_items(item)
         return items[0]
 
-    def agglomerative_clustering(self, threshold=0.5):
+    def similarity_graph(self, indices=None, min_similarity=0.5, *, top_k=None, max_workers=1, print_mode=0):
+        """ 数据两两之间相似度>=min_similarity的稀疏图，内存跟边数成正比，不需要n*n的矩阵
+
+        默认的字符串编辑距离会用LevenshteinIndex剪枝；重载了compute_similarity的子类没法剪枝，
+        只能分块两两计算，但也只保留满足阈值的边，此时不支持top_k。
+
+        :param indices: 参与计算的数据下标，默认全部
+        :param top_k: 每个样本最多保留的近邻数，None表示不限
+        :param max_workers: 不为1时用多进程分块计算
+        :return: (rows, cols, sims)，rows、cols是在indices里的局部下标，rows<cols
+        """
+        if indices is None:
+            indices = range(len(self.data))
+
+        index = self._get_index()
+        if index is not None:
+            sub_index = LevenshteinIndex([index.strings[i] for i in indices],
+                                         q=LevenshteinIndex.suggest_q(min_similarity))
+            return sub_index.similarity_graph(min_similarity, top_k, max_workers=max_workers, pbar=print_mode or None)
+
+        import functools
+        from pyxllib.prog.specialist.xlexecutor import XlExecutor
+
+        items = [self.data[i] for i in indices]
+        func = functools.partial(_similarity_row_edges, self.compute_similarity, items, min_similarity)
+        if max_workers == 1:
+            res = [func(i) for i in tqdm(range(len(items)), disable=not print_mode)]
+        else:
+            executor = XlExecutor(max_workers, 'process')
+            executor.chunk_size = max(1, math.ceil(len(items) / (executor.max_workers * 4)))
+            res = list(executor.map(func, range(len(items)), pbar=print_mode or None))
+        edges = [e for x in res for e in x]
+        rows = np.array([e[0] for e in edges], dtype=np.int64)
+        cols = np.array([e[1] for e in edges], dtype=np.int64)
+        sims = np.array([e[2] for e in edges], dtype=np.float64)
+        return rows, cols, sims
+
+    def agglomerative_clustering(self, threshold=0.5, *, sparse=False, max_workers=1):
         """ 对内部字符串进行层次聚类
 
         :param threshold: 可以理解成距离的阈值，距离小于这个阈值的字符串会被聚为一类
             值越小，分出的类别越多越细
+        :param sparse: 只计算相似度>1-threshold的稀疏图来聚类，数据量大时用，
+            complete聚类在距离没有并列值时结果跟稠密矩阵一致
+        :param max_workers: sparse模式下计算相似度图的进程数
         """
+        if sparse:
+            rows, cols, sims = self.similarity_graph(min_similarity=1 - threshold, max_workers=max_workers)
+            return sparse_agglomerative_clustering(len(self), rows, cols, sims, threshold, linkage='complete')
+
         # 1 给每个样本标类别
         distance_matrix = np.zeros((len(self), len(self)))
         for i in range(len(self)):
@@ -210,15 +619,22 @@ class DataMatcher:
         center_idx = max(indices, key=lambda x: sum(get_similarity(x, y) for y in indices))
         return center_idx
 
-    def find_top_similar_pairs(self, top_n=1):
+    def find_top_similar_pairs(self, top_n=1, *, max_workers=1):
         """找到最相近的top_n对数据。
 
         :param top_n: 需要返回的最相似的数据对的数量。
+        :param max_workers: 字符串数据用索引检索时的进程数
         :return: 一个列表，包含(top_n个)最相似数据对的索引和它们之间的相似度。
         """
         if len(self.data) < 2:
             return []
 
+        if self._get_index() is not None:
+            # 全局最相似的top_n对，一定在各样本自己的top_n近邻里
+            rows, cols, sims = self.similarity_graph(min_similarity=0, top_k=top_n, max_workers=max_workers)
+            order = np.lexsort((cols, rows, -sims))[:top_n]
+            return [((int(rows[k]), int(cols[k])), float(sims[k])) for k in order]
+
         # 初始化一个列表来保存最相似的数据对，使用最小堆来维护这个列表
         # 最小堆能够保证每次都能快速弹出相似度最小的数据对
         top_pairs = []
@@ -256,12 +672,15 @@ class GroupedDataMatcher(DataMatcher):
             new_groups[rep] = items
         self.groups = new_groups
 
-    def merge_group(self, indices, threshold=0.5, strategy='center'):
+    def merge_group(self, indices, threshold=0.5, strategy='center', *, sparse=False, max_workers=1):
         """ 对输入的索引进行合并，根据阈值生成分组
 
         :param indices: 数据项的索引列表。
         :param threshold: 两个数据项的距离小于此阈值时，它们被认为是相似的。
         :param strategy: 选择组代表的策略，可以是'center'或'first'。
+        :param sparse: 只计算相似度>1-threshold的稀疏图来聚类，内存跟边数成正比，
+            average聚类时缺失的点对按距离1计算，是稠密结果的近似
+        :param max_workers: sparse模式下计算相似度图的进程数
         :return: 一个字典，键是代表性数据项的索引，值是相似数据项的索引列表。
         """
         # 1 给每个样本标类别
@@ -269,6 +688,11 @@ class GroupedDataMatcher(DataMatcher):
         if n == 1:
             return {indices[0]: indices}
 
+        if sparse:
+            rows, cols, sims = self.similarity_graph(indices, 1 - threshold, max_workers=max_workers)
+            labels = sparse_agglomerative_clustering(n, rows, cols, sims, threshold, linkage='average')
+            return sparse_cluster_groups(indices, labels, rows, cols, sims, strategy)
+
         distance_matrix = np.zeros((n, n))
         for i in range(n):
             for j in range(i + 1, n):
@@ -302,12 +726,14 @@ class GroupedDataMatcher(DataMatcher):
 
         return result
 
-    def init_groups(self, threshold=0.5, batch_size=1000, print_mode=0):
+    def init_groups(self, threshold=0.5, batch_size=1000, print_mode=0, *, sparse=False, max_workers=1):
         """ 初始化数据的分组
 
         :param threshold: 两个数据项的距离小于此阈值时，它们被认为是相似的。
             这里写成1的话，一般就是故意特地把类别只分成一类
         :param batch_size: 由于数据可能很大，可以使用批量处理来减少计算量。
+            sparse模式的内存跟边数成正比，batch_size可以设得很大，甚至一次性处理全部数据
+        :param sparse, max_workers: 传给merge_group
         :return: 一个字典，键是代表性数据项的索引，值是相似数据项的索引列表。
         """
         # 1 最开始每个样本都是一个组
@@ -318,7 +744,7 @@ class GroupedDataMatcher(DataMatcher):
         while len(groups) > 1:
             for indices in chunked(groups.keys(), batch_size):
                 # 对于这里返回的字典，原groups里的values也要对应拼接的
-                indices2 = self.merge_group(indices, threshold=threshold)
+                indices2 = self.merge_group(indices, threshold=threshold, sparse=sparse, max_workers=max_workers)
                 for idx, idxs in indices2.items():
                     # 获取原始分组中的索引
                     original_idxs = [groups[original_idx] for original_idx in idxs]
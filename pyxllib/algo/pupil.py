@@ -418,8 +418,58 @@ def intersection_split(a, b):
     return ls1, ls2, ls3, ls4
 
 
+def matchpairs_matrix(scores, least_score=sys.float_info.epsilon, *, method='greedy'):
+    r""" 根据已经算好的相似度矩阵匹配两组数据
+
+    :param scores: n*m的相似度矩阵，scores[i][j]是xs[i]和ys[j]的相似度，值越大越相似
+        相似度能向量化计算的（比如ComputeIou.ltrb_matrix），直接传入矩阵比逐对调用cmp_func快得多
+    :param least_score: 允许匹配的最低分
+    :param method: 配对算法
+        greedy（默认），贪心，每次取剩余最高分的一对，跟matchpairs的结果一致
+        hungarian，匈牙利算法，使得配对的总分最大，需要scipy
+    :return: [(i1, j1, score1), (i2, j2, score2), ...]，按分数从大到小
+
+    >>> matchpairs_matrix([[0.9, 0.8], [0.85, 0.1]])
+    [(0, 0, 0.9), (1, 1, 0.1)]
+    >>> matchpairs_matrix([[0.9, 0.8], [0.85, 0.1]], method='hungarian')
+    [(1, 0, 0.85), (0, 1, 0.8)]
+    >>> matchpairs_matrix([[0.9, 0.8], [0.85, 0.1]], 0.5)
+    [(0, 0, 0.9)]
+    """
+    import numpy as np
+
+    scores = np.asarray(scores, dtype=float)
+    if scores.ndim != 2 or not scores.size:
+        return []
+    n, m = scores.shape
+    valid = scores >= least_score
+
+    if method == 'greedy':
+        # 按分数从大到小排序，分数并列时按(i, j)先来后到，跟matchpairs的排序规则一致
+        flat = np.flatnonzero(valid)
+        flat = flat[np.argsort(-scores.ravel()[flat], kind='stable')]
+        pairs = []
+        x_used, y_used = np.zeros(n, dtype=bool), np.zeros(m, dtype=bool)
+        limit = min(n, m)
+        for i, j in zip(*np.unravel_index(flat, (n, m))):
+            if not x_used[i] and not y_used[j]:
+                pairs.append((int(i), int(j), float(scores[i, j])))
+                x_used[i] = y_used[j] = True
+                if len(pairs) == limit:
+                    break
+        return pairs
+    elif method == 'hungarian':
+        from scipy.optimize import linear_sum_assignment
+        # 低于least_score的配对当作0分参与求解，最后再过滤掉
+        rows, cols = linear_sum_assignment(np.where(valid, scores, 0), maximize=True)
+        pairs = [(int(i), int(j), float(scores[i, j])) for i, j in zip(rows, cols) if valid[i, j]]
+        return sorted(pairs, key=lambda v: (-v[2], v[0], v[1]))
+    else:
+        raise ValueError(f'不支持的配对算法 {method}')
+
+
 def matchpairs(xs, ys, cmp_func, least_score=sys.float_info.epsilon, *,
-               key=None, index=False):
+               key=None, index=False, method='greedy'):
     r""" 匹配两组数据
 
     :param xs: 第一组数据
@@ -428,6 +478,7 @@ def matchpairs(xs, ys, cmp_func, least_score=sys.float_info.epsilon, *,
     :param least_score: 允许匹配的最低分，默认必须要大于0
     :param key: 是否需要对xs, ys进行映射后再传入 cmp_func 操作
     :param index: 返回的不是原值，而是下标
+    :param method: 配对算法，greedy或hungarian，见matchpairs_matrix
     :return: 返回结构[(x1, y1, score1), (x2, y2, score2), ...]，注意长度肯定不会超过min(len(xs), len(ys))
 
     注意：这里的功能①不支持重复匹配，②任何一个x,y都有可能没有匹配到
@@ -435,6 +486,7 @@ def matchpairs(xs, ys, cmp_func, least_score=sys.float_info.epsilon, *,
 
     TODO 这里很多中间步骤结果都是很有分析价值的，能改成类，然后支持分析中间结果？
     TODO 这样全量两两比较是很耗性能的，可以加个参数草算，不用精确计算的功能？
+        相似度能向量化计算时，可以自己算好矩阵，直接调用matchpairs_matrix
 
     >>> xs, ys = [4, 6, 1, 2, 9, 4, 5], [1, 5, 8, 9, 2]
     >>> cmp_func = lambda x,y: 1-abs(x-y)/max(x,y)
@@ -455,29 +507,12 @@ def matchpairs(xs, ys, cmp_func, least_score=sys.float_info.epsilon, *,
         xs_, ys_ = xs, ys
 
     # 1 计算所有两两相似度
-    n, m = len(xs), len(ys)
-    all_pairs = []
-    for i in range(n):
-        for j in range(m):
-            score = cmp_func(xs_[i], ys_[j])
-            if score >= least_score:
-                all_pairs.append([i, j, score])
-    # 按分数权重排序，如果分数有很多相似并列，就只能按先来后到排序啦
-    all_pairs = sorted(all_pairs, key=lambda v: (-v[2], v[0], v[1]))
+    scores = [[cmp_func(x, y) for y in ys_] for x in xs_]
 
     # 2 过滤出最终结果
-    pairs = []
-    x_used, y_used = set(), set()
-    for p in all_pairs:
-        i, j, score = p
-        if i not in x_used and j not in y_used:
-            if index:
-                pairs.append((i, j, score))
-            else:
-                pairs.append((xs[i], ys[j], score))
-            x_used.add(i)
-            y_used.add(j)
-
+    pairs = matchpairs_matrix(scores, least_score, method=method)
+    if not index:
+        pairs = [(xs[i], ys[j], score) for i, j, score in pairs]
     return pairs
 
 
@@ -65,3 +65,56 @@ class ShapelyPolygon:
     @classmethod
     def to_ndarray(cls, p, dtype=None):
         return np.array(p.exterior.coords, dtype=dtype)
+
+    @classmethod
+    def gen_array(cls, items):
+        """ 批量转成shapely多边形，返回np.ndarray(dtype=object)，方便后续用shapely的向量化接口计算
+
+        自相交等无效的多边形会用make_valid修正，否则求交集时会报TopologyException
+        """
+        try:  # 点数相同的多边形，可以直接批量构造
+            coords = np.asarray(items, dtype=float)
+        except (ValueError, TypeError):
+            coords = None
+        if coords is not None and coords.ndim == 3 and coords.shape[1] >= 3 and coords.shape[2] == 2:
+            geoms = shapely.polygons(coords)
+        else:
+            geoms = np.empty(len(items), dtype=object)
+            geoms[:] = [cls.gen(x) for x in items]
+        invalid = ~shapely.is_valid(geoms)
+        if invalid.any():
+            geoms[invalid] = shapely.make_valid(geoms[invalid])
+        return geoms
+
+
+def polygon_intersection_matrix(geoms1, geoms2=None):
+    """ 两组多边形两两之间的相交面积矩阵
+
+    :param geoms1: n个多边形，最好是ShapelyPolygon.gen_array的结果，避免重复构造多边形
+    :param geoms2: m个多边形，默认跟geoms1相同
+    :return: n*m的np.ndarray
+
+    先用STRtree按外接矩形筛出可能相交的候选对，只对这些候选对用shapely的向量化接口求交集面积，
+    文本检测这类场景，大部分框两两之间根本不相交，能省掉绝大部分的多边形求交运算
+
+    >>> polygon_intersection_matrix(ShapelyPolygon.gen_array([[[0, 0], [10, 10]], [[5, 5], [15, 15]], [[20, 20], [30, 30]]]))
+    array([[100.,  25.,   0.],
+           [ 25., 100.,   0.],
+           [  0.,   0., 100.]])
+    """
+    def is_geoms(x):  # 已经是gen_array的结果；数值型的ndarray还是坐标，需要构造多边形
+        return isinstance(x, np.ndarray) and x.dtype == object
+
+    if not is_geoms(geoms1):
+        geoms1 = ShapelyPolygon.gen_array(geoms1)
+    if geoms2 is None:
+        geoms2 = geoms1
+    elif not is_geoms(geoms2):
+        geoms2 = ShapelyPolygon.gen_array(geoms2)
+
+    mat = np.zeros((len(geoms1), len(geoms2)))
+    if len(geoms1) and len(geoms2):
+        idxs1, idxs2 = shapely.STRtree(geoms2).query(geoms1)
+        if len(idxs1):
+            mat[idxs1, idxs2] = shapely.area(shapely.intersection(geoms1[idxs1], geoms2[idxs2]))
+    return mat
@@ -6,6 +6,10 @@
 
 from collections import defaultdict
 import concurrent.futures
+import contextlib
+import functools
+import multiprocessing
+import time
 
 import cv2
 import pandas as pd
@@ -15,7 +19,6 @@ import PIL.Image
 
 from pyxllib.algo.stat import update_dataframes_to_excel
 from pyxllib.file.specialist import get_etag, XlPath
-from pyxllib.prog.specialist import Iterate
 from pyxllib.cv.xlcvlib import CvImg, xlcv
 from pyxllib.cv.xlpillib import PilImg, xlpil
 
@@ -24,9 +27,189 @@ def __1_目录级处理图片的功能():
     pass
 
 
+class _StageTimer:
+    """ 记录处理单张图片时，各个阶段的耗时
+
+    >> with timer('read'): im = xlcv.read(f)
+    """
+
+    def __init__(self):
+        self.elapsed = defaultdict(float)
+
+    @contextlib.contextmanager
+    def __call__(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.elapsed[stage] += time.perf_counter() - start
+
+
+_image_worker_inited = False
+
+
+def _init_image_worker():
+    """ 子进程里只需要执行一次的初始化 """
+    global _image_worker_inited
+    if _image_worker_inited:
+        return
+    if multiprocessing.parent_process() is not None:
+        cv2.setNumThreads(1)  # 多进程并行时，opencv内部再开多线程只会互相抢cpu
+    PIL.Image.init()  # 提前加载好所有图片格式的解码插件，后面每张图片都直接复用
+    _image_worker_inited = True
+
+
+def _run_image_func(func, root, file):
+    """ 在子进程里处理一张图片
+
+    :return: (文件相对路径, func返回的日志记录, 各阶段耗时)
+    """
+    _init_image_worker()
+    timer = _StageTimer()
+    record = func(root / file, timer)
+    return file, record, dict(timer.elapsed)
+
+
+def _fix_suffix_file(file, timer):
+    with timer('check'):
+        res = list(file._check_faker_suffix([file]))
+    if not res:
+        return None
+    with timer('read'):
+        im = xlcv.read(file)
+    with timer('write'):
+        xlcv.write(im, file)  # 读取图片，并按照原本文件名期望的格式存储
+    return {'原图片类型': res[0][1]}
+
+
+def _reduce_image_file(file, timer, *, root, limit_size, read_flags, change_length, suffix, quality, min_quality):
+    size1 = file.size()
+    with timer('read'):
+        im = xlpil.read(file, read_flags)
+    _suffix = suffix or file.suffix
+    with timer('encode'):  # 编码结果直接写入文件，不用再重复编码
+        buffer, im = xlpil.encode_to_filesize(im, limit_size if change_length else None, _suffix,
+                                              quality=quality, min_quality=min_quality)
+    size2 = len(buffer)
+    dst_f = file.with_suffix(_suffix)
+    with timer('write'):
+        if size2 < size1 or file.suffix != _suffix:  # 只有文件尺寸确实变小的才更新，换格式的时候原图会被删，一定要写入
+            dst_f.write_bytes(buffer)
+        if file.suffix != _suffix:
+            file.delete()
+    return {'新图片': dst_f.relpath(root).as_posix(), '原文件大小': size1, '新文件大小': size2}
+
+
+def _adjust_image_shape_file(file, timer, *, min_length, max_length):
+    with timer('check'):
+        # 用pil库判断图片尺寸更快，只读文件头，但处理过程用的是cv2库
+        h, w = xlpil.read(file).size[::-1]
+    x, y = min(h, w), max(h, w)
+    if not ((min_length and x < min_length) or (max_length and y > max_length)):
+        return None
+
+    with timer('read'):
+        im = xlcv.read(file)
+    with timer('resize'):
+        im2 = xlcv.adjust_shape(im, min_length, max_length)
+    if im2.shape == im.shape:
+        return None
+    with timer('write'):
+        xlcv.write(im2, file)
+    return {'原尺寸': list(im.shape), '新尺寸': list(im2.shape)}
+
+
+def _clear_exif_file(file, timer):
+    with timer('read'):
+        im = xlpil.read(file)
+        exif = xlpil.get_exif(im)
+    if not exif or not exif.get("Orientation", None):
+        return None
+    with timer('rotate'):
+        im = xlpil.apply_exif_orientation(im)
+    with timer('write'):
+        xlpil.write(im, file)
+    return {'Orientation': exif.get("Orientation")}
+
+
 class ImagesDir(XlPath):
     """ 这个函数功能，默认都是原地操作，如果怕以防万一出问题，最好对原始数据有另外的备份，而在新的目录里操作 """
 
+    def process_images(self, func, files, *, log_file=None, reset=False, max_workers=None, chunk_size=16,
+                       desc=None, print_mode=True):
+        """ 多进程处理图片的通用流水线
+
+        :param func: func(file, timer)，处理单张图片，在子进程里运行
+            timer用来统计各阶段耗时，例如 with timer('read'): im = xlcv.read(file)
+            返回一个dict作为日志记录，没有做任何修改的图片可以返回None
+        :param files: 要处理的图片文件
+        :param log_file: jsonl格式的检查点日志，相对路径时存在self目录下
+            每处理完一批图片就会追加写入，程序中断后再次运行，会跳过日志里已经处理过的图片
+            注意日志只按图片路径判断是否处理过，不会记录func的参数，换了参数重跑时要设置reset
+        :param reset: 清空log_file重新处理所有图片
+        :param max_workers: 进程数，默认cpu数；1表示在当前进程串行处理，方便调试
+        :param chunk_size: 每个任务打包的图片数，减少进程间的调度开销
+        :return list[dict]: 所有返回了非None的日志记录（含之前运行已处理的），每条记录的'file'是图片相对路径
+        """
+        from pyxllib.file.specialist import StreamJsonlWriter
+        from pyxllib.prog.specialist import XlExecutor
+
+        # 1 断点续传
+        files = [XlPath(f).relpath(self).as_posix() for f in files]
+        records, done = [], set()
+        log = None
+        if log_file:
+            log_file = XlPath.init(log_file, self)
+            if reset and log_file.is_file():
+                log_file.delete()
+            if log_file.is_file():
+                for x in log_file.read_jsonl():
+                    done.add(x['file'])
+                    if not x.get('_skip'):
+                        records.append(x)
+            log = StreamJsonlWriter(log_file, batch_size=chunk_size)
+        todo = [f for f in files if f not in done]
+
+        # 2 处理图片
+        stage_elapsed = defaultdict(float)
+        worker = functools.partial(_run_image_func, func, self)
+        pbar = tqdm(total=len(todo), desc=desc, disable=not print_mode)
+        start = time.time()
+        if max_workers == 1:
+            results = (worker(f) for f in todo)
+        else:
+            results = XlExecutor(max_workers, 'process', chunk_size=chunk_size).map(worker, todo, ordered=False)
+        for file, record, elapsed in results:
+            for k, v in elapsed.items():
+                stage_elapsed[k] += v
+            if record is None:
+                record = {'file': file, '_skip': True}
+            else:
+                record = {'file': file, **record}
+                records.append(record)
+            if log:
+                log.append_line(record)
+            pbar.update(1)
+        pbar.close()
+        if log:
+            log.flush()
+
+        # 3 各阶段耗时统计，这里是所有进程的累计耗时
+        if print_mode and todo:
+            total = time.time() - start
+            msg = ', '.join([f'{k} {v:.2f}s' for k, v in stage_elapsed.items()])
+            print(f'处理{len(todo)}张图片，用时{total:.2f}s，各阶段累计用时：{msg}')
+
+        return records
+
+    def _save_images_log(self, log_file, sheet_name, records, columns):
+        """ 把process_images的日志记录转成df，如果log_file是xlsx格式，按旧版的方式存储一份表格 """
+        df = pd.DataFrame.from_records([[x.get(k) for k in ['file'] + columns[1:]] for x in records],
+                                       columns=columns)
+        if log_file and XlPath(log_file).suffix == '.xlsx':
+            update_dataframes_to_excel(XlPath.init(log_file, self), {sheet_name: df})
+        return df
+
     def debug_image_func(self, func, pattern='*', *, save=None, show=False):
         """
         :param func: 对每张图片执行的功能，函数应该只有一个图片路径参数  new_img = func(img)
@@ -55,40 +238,27 @@ class ImagesDir(XlPath):
                 if key == '0x1B':  # ESC 键
                     break
 
-    def fix_suffixs(self, pattern='**/*', log_file='_图片统计.xlsx', max_workers=None, pinterval=None):
+    def fix_suffixs(self, pattern='**/*', log_file='_图片统计.xlsx', max_workers=None, pinterval=None, *, reset=False):
         """ 修正错误的后缀名
 
-        :param pinterval: 支持智能地判断进度间隔
+        :param log_file: xlsx格式时，处理完后写入'修改后缀名'表
+            jsonl格式时是可以断点续传的检查点日志，详见process_images
+        :param reset: jsonl格式的log_file，是否清空重新处理
+        :param max_workers: 进程数
+        :param pinterval: 已弃用，改为用tqdm展示进度
         """
-
-        # 1 修改后缀
-        # 定义并行处理子函数
-        def process_image_file(args):
-            """ 处理单个图片文件，修正后缀名 """
-            file, ext = args
-            xlcv.write(xlcv.read(file), file)  # 读取图片，并按照原本文件名期望的格式存储
-            ls.append([file.relpath(self).as_posix(), ext])
-
-        ls = []
-        files_with_exts = list(self.xglob_faker_suffix_images(pattern))
-        if pinterval is None and files_with_exts:
-            p = max(1000 * 100 // len(files_with_exts), 1)  # 最小也按1%进度展示
-            if p < 50:  # 间隔只有小余50%，才比较有显示的意义
-                pinterval = f'{p}%'  # 每1千张显示进度
-        Iterate(files_with_exts).run(process_image_file, max_workers=max_workers, pinterval=pinterval)
-
-        # 2 记录修改情况
-        df = pd.DataFrame.from_records(ls, columns=['图片名', '原图片类型'])
-        if log_file:
-            update_dataframes_to_excel(XlPath.init(log_file, self), {'修改后缀名': df})
-        return df
+        jsonl_log = log_file if log_file and XlPath(log_file).suffix == '.jsonl' else None
+        records = self.process_images(_fix_suffix_file, self.glob_images(pattern), log_file=jsonl_log, reset=reset,
+                                      max_workers=max_workers, desc='修改后缀名')
+        return self._save_images_log(log_file, '修改后缀名', records, ['图片名', '原图片类型'])
 
     def reduce_image_filesize(self, pattern='**/*',
                               limit_size=4 * 1024 ** 2, *,
                               read_flags=None,
                               change_length=False,
                               suffix=None,
-                              log_file='_图片统计.xlsx',
+                              quality=None, min_quality=None,
+                              log_file='_图片统计.xlsx', reset=False,
                               max_workers=None, pinterval=None):
         """ 减小图片尺寸，可以限制目录里尺寸最大的图片不超过多少
 
@@ -103,6 +273,15 @@ class ImagesDir(XlPath):
         :param suffix: 可以统一图片后缀格式，默认保留原图片名称
             要带前缀'.'，例如'.jpg'
             注意其他格式的原图会被删除
+        :param quality: jpg、webp格式保存的质量上限，默认使用pil的默认参数
+        :param min_quality: 质量下限，设置后会先尝试降低质量，仍不满足limit_size才缩小尺寸
+            详见 xlpil.encode_to_filesize
+        :param log_file: xlsx格式时，处理完后写入'图片瘦身'表
+            jsonl格式时是可以断点续传的检查点日志，详见process_images
+            检查点只记录处理过哪些图片，limit_size、quality、suffix等参数变了，之前处理过的图片也会被跳过
+        :param reset: jsonl格式的log_file，是否清空重新处理，换了参数重跑时要设置
+        :param max_workers: 进程数
+        :param pinterval: 已弃用，改为用tqdm展示进度
 
         因为所有图片都会读入后再重新写入，速度可能会稍慢
         """
@@ -111,93 +290,92 @@ class ImagesDir(XlPath):
         print('原始大小', self.size(human_readable=True))
 
         # 2 精简图片尺寸
-        # 定义并行处理子函数
-        def process_image_file(f):
-            """处理单个图片文件，减小图片尺寸"""
-            size1 = f.size()
-            im = xlpil.read(f, read_flags)
-            _suffix = suffix or f.suffix
-            if change_length:
-                im = xlpil.reduce_filesize(im, limit_size, _suffix)
-            size2 = xlpil.evaluate_image_file_size(im, _suffix)
-            dst_f = f.with_suffix(_suffix)
-            if size2 < size1:  # 只有文件尺寸确实变小的才更新
-                xlpil.write(im, dst_f)
-            if f.suffix != _suffix:
-                f.delete()
-            ls.append([f.relpath(self).as_posix(), dst_f.relpath(self).as_posix(), size1, size2])
-
-        ls = []
-        files = list(self.glob_images(pattern))
-        if pinterval is None and files:
-            p = max(100 * 100 // len(files), 1)  # 最小也按1%进度展示
-            if p < 50:  # 间隔只有小余50%，才比较有显示的意义
-                pinterval = f'{p}%'  # 每1千张显示进度
-        Iterate(files).run(process_image_file, max_workers=max_workers, pinterval=pinterval)
+        func = functools.partial(_reduce_image_file, root=self, limit_size=limit_size, read_flags=read_flags,
+                                 change_length=change_length, suffix=suffix,
+                                 quality=quality, min_quality=min_quality)
+        jsonl_log = log_file if log_file and XlPath(log_file).suffix == '.jsonl' else None
+        records = self.process_images(func, self.glob_images(pattern), log_file=jsonl_log, reset=reset,
+                                      max_workers=max_workers, desc='图片瘦身')
 
         print('新目录大小', self.size(human_readable=True))
 
         # 3 记录修改细节
         # 注意，如果不使用suffix参数，'新图片'的值应该跟'原图片'是一样的
         # 以及当尝试精简的'新文件大小'大于'原文件大小'时，图片其实是不会被覆盖更新的
-        df = pd.DataFrame.from_records(ls, columns=['原图片', '新图片', '原文件大小', '新文件大小'])
-        if log_file:
-            update_dataframes_to_excel(XlPath.init(log_file, self), {'图片瘦身': df})
-        return df
+        return self._save_images_log(log_file, '图片瘦身', records, ['原图片', '新图片', '原文件大小', '新文件大小'])
 
-    def adjust_image_shape(self, pattern='*', min_length=None, max_length=None, print_mode=True):
-        """ 调整图片尺寸 """
+    def adjust_image_shape(self, pattern='*', min_length=None, max_length=None, print_mode=True, *,
+                           log_file=None, reset=False, max_workers=None):
+        """ 调整图片尺寸
 
-        def printf(*args, **kwargs):
-            if print_mode:
-                print(*args, **kwargs)
+        :param log_file: jsonl格式的检查点日志，详见process_images
+        :param reset: 是否清空log_file重新处理
+        :param max_workers: 进程数
+        :return list[dict]: 调整了尺寸的图片记录
+        """
+        func = functools.partial(_adjust_image_shape_file, min_length=min_length, max_length=max_length)
+        records = self.process_images(func, self.glob_images(pattern), log_file=log_file, reset=reset,
+                                      max_workers=max_workers, desc='调整图片尺寸', print_mode=print_mode)
+        if print_mode:
+            for j, x in enumerate(records, start=1):
+                print(f'{j}、{x["file"]} {tuple(x["原尺寸"])} -> {tuple(x["新尺寸"])}')
+        return records
 
-        j = 1
-        for f in self.glob_images(pattern):
-            # 用pil库判断图片尺寸更快，但处理过程用的是cv2库
-            h, w = xlpil.read(f).size[::-1]
-            x, y = min(h, w), max(h, w)
-
-            if (min_length and x < min_length) or (max_length and y > max_length):
-                im = xlcv.read(f)
-                im2 = xlcv.adjust_shape(im, min_length, max_length)
-                if im2.shape != im.shape:
-                    printf(f'{j}、{f} {im.shape} -> {im2.shape}')
-                    xlcv.write(im2, f)
-                    j += 1
+    def _get_images_hash_func(self, pattern, mode, max_workers=None, files=None):
+        """ 批量多进程计算好所有图片的哈希值，返回 (图片列表, hash_func)
+
+        :param files: 直接指定图片清单，此时pattern失效
+        """
+        from pyxllib.cv.imhash import batch_hashes, hashes_to_hex
+
+        files = list(self.glob_images(pattern) if files is None else files)
+        hashes, ok = batch_hashes(files, mode, processes_num=max_workers or -1)
+        # 读取失败的图片，给一个唯一值，避免被当成重复图片
+        d = {f: (h if k else f'error:{f}') for f, h, k in zip(files, hashes_to_hex(hashes), ok)}
+        return files, lambda p: d[p]
 
     def check_repeat_phash_images(self, pattern='**/*', **kwargs):
-        from pyxllib.cv.imhash import phash
-        if 'files' not in kwargs:
-            kwargs['files'] = self.glob_images(pattern)
         if 'hash_func' not in kwargs:
-            kwargs['hash_func'] = lambda p: phash(p)
+            kwargs['files'], kwargs['hash_func'] = self._get_images_hash_func(pattern, 'phash',
+                                                                              files=kwargs.get('files'))
+        elif 'files' not in kwargs:
+            kwargs['files'] = self.glob_images(pattern)
         self.check_repeat_files(pattern, **kwargs)
 
     def check_repeat_dhash_images(self, pattern='**/*', **kwargs):
-        from pyxllib.cv.imhash import dhash
-        if 'files' not in kwargs:
-            kwargs['files'] = self.glob_images(pattern)
         if 'hash_func' not in kwargs:
-            kwargs['hash_func'] = lambda p: dhash(p)
+            kwargs['files'], kwargs['hash_func'] = self._get_images_hash_func(pattern, 'dhash',
+                                                                              files=kwargs.get('files'))
+        elif 'files' not in kwargs:
+            kwargs['files'] = self.glob_images(pattern)
         self.check_repeat_files(pattern, **kwargs)
 
-    def clear_exif(self):
+    def find_similar_images(self, pattern='**/*', mode='dhash', radius=4, *, max_workers=None):
+        """ 查找相似图片
+
+        check_repeat_*hash_images只能找哈希值完全相同的图片，这里可以找汉明距离不超过radius的近似重复图片
+
+        :param mode: phash、dhash
+        :param radius: 哈希值的汉明距离阈值，64位的哈希一般用4~10，越大找到的越多，也越容易误判
+        :return list[list[XlPath]]: 相似图片分组，按组大小从大到小排序
+        """
+        from pyxllib.cv.imhash import batch_hashes, HammingIndex
+
+        files = list(self.glob_images(pattern))
+        hashes, ok = batch_hashes(files, mode, processes_num=max_workers or -1)
+        files = [f for f, k in zip(files, ok) if k]
+        groups = HammingIndex(hashes[ok], radius).clusters()
+        return [[files[i] for i in g] for g in groups]
+
+    def clear_exif(self, *, log_file=None, reset=False, max_workers=None):
         """ 清除图片中的exif标记 """
-        cnt = 0
-        for file in tqdm(self.rglob_images()):
-            im = xlpil.read(file)
-            exif = xlpil.get_exif(im)
-            if exif:
-                orientation = exif.get("Orientation", None)
-                if orientation:
-                    cnt += 1
-                    im = xlpil.apply_exif_orientation(im)
-                    xlpil.write(im, file)
-        print(f'处理了{cnt}份exif')
-
-
-def find_modified_images(dirs, print_mode=False):
+        records = self.process_images(_clear_exif_file, self.rglob_images(), log_file=log_file, reset=reset,
+                                      max_workers=max_workers, desc='清除exif')
+        print(f'处理了{len(records)}份exif')
+        return records
+
+
+def find_modified_images(dirs, print_mode=False, *, use_manifest=False):
     """ 查找可能被修改过的图片
 
     一般用在数据标注工作中，对收回来的数据目录，和原本数据目录做个对比，
@@ -205,6 +383,8 @@ def find_modified_images(dirs, print_mode=False):
 
     :param list[str] dirs: 图片所在目录列表
     :param bool print_mode: 是否打印进度提示，默认为 False
+    :param use_manifest: 使用DirManifest记录每个目录的etag，再次检查时只有变化过的图片才需要重新读取计算
+        清单会以sqlite文件的形式存在临时目录下，适合反复检查同一批目录的场景
     :return dict[str, list[str]]: 包含图片名字和可能被修改过的图片路径列表的字典
 
     示例用法：
@@ -217,7 +397,7 @@ def find_modified_images(dirs, print_mode=False):
                                 r'm2305latex2lg/1、做完的数据'])
     pprint(res)
     """
-    from pyxllib.file.specialist import get_etag  # 发现不能用相似，还是得用etag
+    from pyxllib.file.specialist import get_etag, DirManifest  # 发现不能用相似，还是得用etag
 
     # 1 将图片按名字分组
     def group_by_name(dirs):
@@ -240,6 +420,17 @@ def find_modified_images(dirs, print_mode=False):
 
     image_groups = group_by_name(dirs)
 
+    # etag只跟文件内容有关，etag相同时图片尺寸也一定相同，所以只需要比较etag
+    path2etag = {}
+    if use_manifest:
+        paths = [p for ps in image_groups.values() if len(ps) > 1 for p in ps]
+        for dir in dirs:
+            manifest = DirManifest(dir)
+            # 只刷新同名分组里的图片，没有同名的图片不需要比较，也就不用计算etag
+            manifest.update_files(paths, print_mode=print_mode)
+            # 不在这个目录下的图片，拿到的etag是None
+            path2etag.update({p: etag for p, etag in zip(paths, manifest.get_etags(paths)) if etag})
+
     # 2 存储有哪些变化的分组
     modified_images = {}
     progress_counter = 0
@@ -252,11 +443,10 @@ def find_modified_images(dirs, print_mode=False):
         if len(paths) <= 1:
             continue
 
-        hash_values = [get_etag(str(path)) for path in paths]
-        sizes = [PIL.Image.open(path).size for path in paths]
+        hash_values = [path2etag.get(path) or get_etag(str(path)) for path in paths]
 
         # 这里可以增强，更加详细展示差异，比如是不是被旋转了90度、180度、270度，但会大大提升运算量，暂时不添加
-        if len(set(hash_values)) > 1 or len(set(sizes)) > 1:
+        if len(set(hash_values)) > 1:
             # 获取posix风格路径
             modified_images[image_name] = [XlPath(path).as_posix() for path in paths]
 
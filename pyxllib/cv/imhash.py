@@ -5,15 +5,22 @@
 # @Date   : 2021/06/08 22:53
 
 """
-TODO 写一些图片相似度相关功能
+图片相似度相关功能
+
+单张图片直接用phash、dhash即可；
+大批量图片可以用batch_hashes多进程解码、矩阵化计算哈希，得到uint64数组，
+再用HammingIndex按汉明距离检索、聚类相似图片。
 """
 
 from pyxllib.prog.pupil import check_install_package
 
 check_install_package('imagehash', 'ImageHash')
 
+import io
+
 import imagehash
 import numpy as np
+import PIL.Image
 
 from pyxllib.cv.xlpillib import xlpil
 
@@ -37,3 +44,276 @@ def dhash(image, *args, **kwargs):
     """
     im = xlpil.read(image)
     return imagehash.dhash(im, *args, **kwargs)
+
+
+def __2_批量计算哈希():
+    pass
+
+
+def _get_thumbnail_size(mode, hash_size=8, highfreq_factor=4):
+    """ 计算哈希需要的缩略图尺寸 (w, h) """
+    if mode == 'phash':
+        return hash_size * highfreq_factor, hash_size * highfreq_factor
+    elif mode == 'dhash':
+        return hash_size + 1, hash_size
+    else:
+        raise ValueError(f'不支持的哈希类型：{mode}')
+
+
+def load_hash_thumbnail(image, size, *, draft=False):
+    """ 读取图片并缩小成计算哈希用的灰度缩略图，跟imagehash内部的处理方式一致
+
+    :param image: 图片路径、bytes数据，或者其他xlpil.read支持的格式
+    :param size: (w, h)
+    :param draft: jpg图片可以直接以缩小的尺寸解码，能快好几倍，但结果跟完整解码后再缩小会有细微差别，
+        极少数图片的哈希值会有1、2位不同
+    :return: h*w的uint8矩阵
+    """
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        im = PIL.Image.open(io.BytesIO(image))
+    else:
+        im = xlpil.read(image)
+    if draft and im.format == 'JPEG':
+        # 至少保留目标尺寸4倍的分辨率，再用LANCZOS缩小，尽量减少跟完整解码的差异
+        im.draft('L', (size[0] * 4, size[1] * 4))
+    im = im.convert('L').resize(size, PIL.Image.LANCZOS)
+    return np.asarray(im)
+
+
+def phash_array(thumbs, hash_size=8):
+    """ phash的矩阵化版本
+
+    :param thumbs: n*h*w的灰度缩略图，h=w=hash_size*highfreq_factor
+    :return: n*hash_size*hash_size的bool矩阵
+    """
+    import scipy.fftpack
+    thumbs = np.asarray(thumbs)
+    dct = scipy.fftpack.dct(scipy.fftpack.dct(thumbs, axis=1), axis=2)
+    low = dct[:, :hash_size, :hash_size]
+    med = np.median(low.reshape(len(low), -1), axis=1)
+    return low > med[:, None, None]
+
+
+def dhash_array(thumbs):
+    """ dhash的矩阵化版本
+
+    :param thumbs: n*hash_size*(hash_size+1)的灰度缩略图
+    :return: n*hash_size*hash_size的bool矩阵
+    """
+    thumbs = np.asarray(thumbs)
+    return thumbs[:, :, 1:] > thumbs[:, :, :-1]
+
+
+def pack_hashes(bits):
+    """ 把n*8*8的bool哈希矩阵打包成uint64数组
+
+    位的顺序跟imagehash的str格式一致，即 int(str(h), 16) == pack_hashes(h.hash[None])[0]
+    """
+    bits = np.asarray(bits).reshape(len(bits), -1)
+    if bits.shape[1] > 64:
+        raise ValueError('只支持打包64位以内的哈希值，即hash_size<=8')
+    if bits.shape[1] < 64:  # 高位补0
+        bits = np.concatenate([np.zeros((len(bits), 64 - bits.shape[1]), dtype=bool), bits], axis=1)
+    return np.packbits(bits, axis=1).view('>u8').ravel().astype(np.uint64)
+
+
+def hex_to_hashes(hexs):
+    """ imagehash的16进制字符串格式转uint64数组 """
+    return np.array([int(h, 16) for h in hexs], dtype=np.uint64)
+
+
+def hashes_to_hex(hashes):
+    """ uint64数组转imagehash的16进制字符串格式 """
+    return [f'{int(h):016x}' for h in hashes]
+
+
+def batch_hashes(images, mode='dhash', hash_size=8, *, processes_num=-1, chunk_size=64, draft=False,
+                 print_mode=False):
+    """ 批量计算图片哈希
+
+    解码缩小图片是主要耗时，在多进程里完成，计算哈希则对所有缩略图做矩阵运算
+
+    :param images: 图片路径、bytes数据等的列表
+    :param mode: phash、dhash
+    :param processes_num: 进程数，1表示在当前进程计算
+    :param draft: 见load_hash_thumbnail
+    :return: (hashes, ok)
+        hashes，uint64数组，跟images一一对应
+        ok，bool数组，图片读取失败的位置为False，对应的hashes值为0
+    """
+    import functools
+    from pyxllib.prog.specialist import XlExecutor
+
+    images = list(images)
+    size = _get_thumbnail_size(mode, hash_size)
+    func = functools.partial(load_hash_thumbnail, size=size, draft=draft)
+
+    # 1 多进程读图、缩小
+    if processes_num == 1:
+        thumbs = []
+        for x in images:
+            try:
+                thumbs.append(func(x))
+            except Exception:
+                thumbs.append(None)
+    else:
+        executor = XlExecutor(processes_num, 'process', chunk_size=chunk_size, error_mode='skip')
+        thumbs = list(executor.map(func, images, pbar=print_mode or None))
+
+    # 2 矩阵化计算哈希
+    ok = np.array([x is not None for x in thumbs], dtype=bool)
+    hashes = np.zeros(len(images), dtype=np.uint64)
+    if ok.any():
+        arr = np.stack([x for x in thumbs if x is not None])
+        bits = phash_array(arr, hash_size) if mode == 'phash' else dhash_array(arr)
+        hashes[ok] = pack_hashes(bits)
+    return hashes, ok
+
+
+def __3_汉明距离索引():
+    pass
+
+
+if hasattr(np, 'bitwise_count'):
+    def popcount64(x):
+        """ 统计uint64数组每个元素二进制里1的个数 """
+        return np.bitwise_count(np.asarray(x, dtype=np.uint64)).astype(np.int64)
+else:
+    _POPCOUNT8 = np.array([bin(i).count('1') for i in range(256)], dtype=np.int64)
+
+
+    def popcount64(x):
+        """ 统计uint64数组每个元素二进制里1的个数 """
+        x = np.ascontiguousarray(x, dtype=np.uint64)
+        return _POPCOUNT8[x.view(np.uint8)].reshape(x.shape + (8,)).sum(axis=-1)
+
+
+def hamming_distances(hashes, h):
+    """ hashes数组里每个哈希值跟h的汉明距离 """
+    return popcount64(np.asarray(hashes, dtype=np.uint64) ^ np.uint64(h))
+
+
+class HammingIndex:
+    """ 64位哈希值的汉明距离索引，使用multi-index hashing算法
+
+    把64位拆成radius+1段，根据抽屉原理，汉明距离不超过radius的两个哈希值，至少有一段是完全相同的，
+    所以只需要比较至少有一段相同的候选值，不用两两全比较。
+
+    >> index = HammingIndex(hashes, radius=4)
+    >> index.query(h)  # 跟h距离不超过4的所有哈希值 [(下标, 距离), ...]
+    >> index.clusters()  # 所有相似图片分组
+    """
+
+    def __init__(self, hashes, radius=4):
+        """
+        :param hashes: uint64数组
+        :param radius: 建索引时支持的最大检索半径，越大分段越短，候选值越多，速度越慢
+            dhash、phash判断相似图片，一般用4~10
+        """
+        self.hashes = np.asarray(hashes, dtype=np.uint64)
+        self.radius = radius
+
+        # 完全相同的哈希值先合并，实际数据里重复图片往往很多
+        self.uniq, self.inverse = np.unique(self.hashes, return_inverse=True)
+        self.inverse = self.inverse.ravel()
+
+        # 每段的位置、长度，以及每段按值排序后的结果，用于二分查找
+        m = min(radius + 1, 64)
+        bounds = np.linspace(0, 64, m + 1).astype(int)
+        self.blocks = []
+        for a, b in zip(bounds[:-1], bounds[1:]):
+            mask = np.uint64((1 << (b - a)) - 1)
+            keys = (self.uniq >> np.uint64(a)) & mask
+            order = np.argsort(keys, kind='stable')
+            self.blocks.append((np.uint64(a), mask, keys[order], order))
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def _query_uniq(self, h, radius):
+        """ 返回uniq中跟h距离不超过radius的 (下标数组, 距离数组) """
+        h = np.uint64(h)
+        if radius > self.radius:  # 超出索引的检索范围，只能全量比较，矩阵运算其实也挺快的
+            cands = np.arange(len(self.uniq))
+        else:
+            cands = []
+            for shift, mask, keys, order in self.blocks:
+                key = (h >> shift) & mask
+                i, j = np.searchsorted(keys, key, 'left'), np.searchsorted(keys, key, 'right')
+                cands.append(order[i:j])
+            cands = np.unique(np.concatenate(cands)) if cands else np.array([], dtype=np.int64)
+        dists = hamming_distances(self.uniq[cands], h)
+        sel = dists <= radius
+        return cands[sel], dists[sel]
+
+    def query(self, h, radius=None):
+        """ 检索跟h的汉明距离不超过radius的所有哈希值
+
+        :return list[(int, int)]: [(在hashes中的下标, 距离), ...]，按距离从小到大排序
+        """
+        radius = self.radius if radius is None else radius
+        cands, dists = self._query_uniq(h, radius)
+        dist_of = dict(zip(cands.tolist(), dists.tolist()))
+        idx = np.nonzero(np.isin(self.inverse, cands))[0]
+        res = [(i, dist_of[self.inverse[i]]) for i in idx.tolist()]
+        res.sort(key=lambda x: x[1])
+        return res
+
+    def uniq_pairs(self, radius=None):
+        """ 不同的哈希值里，所有距离不超过radius的组合
+
+        :return: (a, b, dists)三个数组，a、b是uniq中的下标，a<b
+        """
+        radius = self.radius if radius is None else radius
+        if radius > self.radius:
+            raise ValueError(f'radius={radius}超出了索引支持的最大半径{self.radius}')
+
+        pairs = []
+        for shift, mask, keys, order in self.blocks:
+            # 同一段值相同的排序后是连续的一段，组内两两组合，第d轮比较每个元素和它后面第d个元素
+            n = len(keys)
+            starts = np.r_[0, np.nonzero(keys[1:] != keys[:-1])[0] + 1]
+            sizes = np.diff(np.r_[starts, n])
+            group_end = np.repeat(starts + sizes, sizes)
+            pos = np.arange(n)
+            d = 1
+            while True:
+                pos = pos[pos + d < group_end[pos]]
+                if not len(pos):
+                    break
+                a, b = order[pos], order[pos + d]
+                dists = popcount64(self.uniq[a] ^ self.uniq[b])
+                sel = dists <= radius
+                if sel.any():
+                    a, b = a[sel], b[sel]
+                    pairs.append(np.stack([np.minimum(a, b), np.maximum(a, b), dists[sel]], axis=1))
+                d += 1
+
+        if not pairs:
+            empty = np.array([], dtype=np.int64)
+            return empty, empty, empty
+        # 不同的段可能找到同一对，去重
+        pairs = np.unique(np.concatenate(pairs), axis=0)
+        return pairs[:, 0], pairs[:, 1], pairs[:, 2]
+
+    def clusters(self, radius=None, *, min_size=2):
+        """ 按汉明距离不超过radius的关系，把相似的哈希值连通成组
+
+        注意相似关系会传递，a跟b相似，b跟c相似，a、b、c就会分在一组，即使a、c的距离超过了radius
+
+        :return list[list[int]]: 每组在hashes中的下标，组按大小从大到小排序
+        """
+        from scipy.sparse import coo_matrix
+        from scipy.sparse.csgraph import connected_components
+
+        a, b, _ = self.uniq_pairs(radius)
+        n = len(self.uniq)
+        graph = coo_matrix((np.ones(len(a), dtype=np.int8), (a, b)), shape=(n, n))
+        _, labels = connected_components(graph, directed=False)
+        labels = labels[self.inverse]
+
+        order = np.argsort(labels, kind='stable')
+        groups = np.split(order, np.nonzero(np.diff(labels[order]))[0] + 1)
+        groups = [g.tolist() for g in groups if len(g) >= min_size]
+        groups.sort(key=lambda g: -len(g))
+        return groups
@@ -1451,15 +1451,8 @@ class RgbFormatter:
             return RgbFormatter(*c.tolist())
 
         def precise_func():
-            """ TODO 这个应该也可以想办法改成np矩阵运算 """
-            nearest_color, nearest_dis = None, 1e10
-            for c in colors:
-                c = RgbFormatter(*c.tolist())
-                dis = self.distance(c)
-                if dis < nearest_dis:
-                    nearest_dis = dis
-                    nearest_color = c
-            return nearest_color
+            i = find_similar_std_colors([self.to_tuple()], color_range, precise_mode=True)[0]
+            return RgbFormatter(*colors[i].tolist())
 
         colors = _get_colors_array(color_range)
         return precise_func() if precise_mode else fast_func()
@@ -1523,3 +1516,100 @@ def _get_colors_array(color_range=2):
     hexs = _get_hexs_names(color_range)[0].keys()
     arr = np.array([RgbFormatter.from_hex(h).to_tuple() for h in hexs])
     return arr
+
+
+def color_distances(rgbs, colors):
+    """ RgbFormatter.distance的numpy矩阵版本，计算两组颜色两两之间的距离
+
+    :param rgbs: n*3的rgb颜色矩阵
+    :param colors: m*3的rgb颜色矩阵
+    :return: n*m的距离矩阵，跟RgbFormatter.distance的计算结果完全一致
+    """
+    import numpy as np
+    a = np.asarray(rgbs, dtype=np.int64).reshape(-1, 1, 3)
+    b = np.asarray(colors, dtype=np.int64).reshape(1, -1, 3)
+    rmean = (a[..., 0] + b[..., 0]) // 2
+    d = a - b
+    r, g, b = d[..., 0], d[..., 1], d[..., 2]
+    return np.sqrt((((512 + rmean) * r * r) >> 8) + 4 * g * g + (((767 - rmean) * b * b) >> 8))
+
+
+def find_similar_std_colors(rgbs, color_range=2, *, precise_mode=False, batch_size=4096):
+    """ find_similar_std_color的批量版本
+
+    :param rgbs: n*3的rgb颜色矩阵
+    :param precise_mode: 同find_similar_std_color
+    :param batch_size: 分批计算，避免n*m的距离矩阵太占内存
+    :return: 长度n的数组，每个颜色最相近的标准色在_get_colors_array(color_range)中的下标
+    """
+    import numpy as np
+    rgbs = np.asarray(rgbs).reshape(-1, 3)
+    colors = _get_colors_array(color_range)
+    res = np.empty(len(rgbs), dtype=np.int64)
+    for i in range(0, len(rgbs), batch_size):
+        a = rgbs[i:i + batch_size]
+        if precise_mode:
+            # sqrt是单调的，找最小值不需要计算sqrt，但为了跟distance完全一致，这里不做简化
+            dists = color_distances(a, colors)
+        else:
+            dists = ((a.astype(np.int64)[:, None, :] - colors[None, :, :]) ** 2).sum(axis=2)
+        res[i:i + batch_size] = dists.argmin(axis=1)  # 距离相同时，跟原来的逐个比较一样取第1个
+    return res
+
+
+@run_once('str')
+def get_std_color_lut(color_range=2, bits=5, precise_mode=False):
+    """ 量化后的 rgb -> 最相近标准色下标 查找表
+
+    每个通道只取高bits位，比如默认5位，就是把每个通道256个值分成32档，用每档的中间值计算最近的标准色，
+    这样整张图片的所有像素，用一次数组索引就能完成分类：
+    >> lut = get_std_color_lut()
+    >> idx = lut[r >> 3, g >> 3, b >> 3]
+
+    计算一次大概要1秒，结果会缓存到临时目录，之后直接读取
+
+    :param bits: 量化位数，8位就是精确值，但查找表有16M个元素，计算也要很久
+        标准色有近千种，比较密集，5位量化时约有2成的颜色会归到相邻的另一个近似标准色，统计颜色分布是够用的
+    :return: (2**bits, 2**bits, 2**bits)的uint16数组，值是_get_colors_array(color_range)中的下标
+    """
+    import hashlib
+    import os
+    import tempfile
+    import numpy as np
+
+    colors = _get_colors_array(color_range)
+    tag = hashlib.md5(colors.tobytes()).hexdigest()[:8]
+    file = os.path.join(tempfile.gettempdir(),
+                        f'pyxllib_color_lut_{color_range}_{bits}_{int(precise_mode)}_{tag}.npy')
+    n = 2 ** bits
+    if os.path.isfile(file):
+        try:
+            lut = np.load(file)
+            if lut.shape == (n, n, n):
+                return lut
+        except (OSError, ValueError):  # 缓存文件损坏，重新计算
+            pass
+
+    step = 256 // n
+    centers = np.arange(n) * step + step // 2
+    grid = np.stack(np.meshgrid(centers, centers, centers, indexing='ij'), axis=-1).reshape(-1, 3)
+    lut = find_similar_std_colors(grid, color_range, precise_mode=precise_mode).astype(np.uint16).reshape(n, n, n)
+
+    tmp_file = f'{file}.{os.getpid()}.tmp'
+    with open(tmp_file, 'wb') as f:
+        np.save(f, lut)
+    os.replace(tmp_file, file)
+    return lut
+
+
+def classify_std_colors(rgbs, color_range=2, bits=5, precise_mode=False):
+    """ 用查找表，把每个像素归类到最相近的标准色
+
+    :param rgbs: ...*3的rgb像素矩阵，比如整张图片
+    :return: 跟rgbs前面维度一致的下标矩阵，值是_get_colors_array(color_range)中的下标
+    """
+    import numpy as np
+    lut = get_std_color_lut(color_range, bits, precise_mode)
+    rgbs = np.asarray(rgbs, dtype=np.uint8)
+    shift = 8 - bits
+    return lut[rgbs[..., 0] >> shift, rgbs[..., 1] >> shift, rgbs[..., 2] >> shift]
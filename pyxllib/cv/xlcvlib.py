@@ -22,6 +22,99 @@ from pyxllib.file.specialist import XlPath
 _show_win_num = 0
 
 
+_PROBE_AREA = 512 * 512  # reduce_filesize探针图的面积
+
+
+def _encode_to_filesize(im, area, encode, resize, filesize, quality=None, min_quality=None, max_encodes=8):
+    """ 按文件大小上限编码图片的核心算法，xlcv、xlpil共用
+
+    以前的做法是每轮编码整张原图，看大小再缩小至多5%，一张大图往往要编码10~20次。
+    这里先编码一张缩小的探针图估算每像素字节数，直接预估缩放比例，
+    然后在[下限, 上限]区间里二分逼近：先在最低质量下找尽量大的缩放比例，再在该比例下找尽量高的质量。
+
+    :param area: 原图面积
+    :param encode: encode(im, quality) -> bytes，quality为None时使用编码器默认参数
+    :param resize: resize(im, scale) -> im
+    :param quality: 质量上限，None表示不调质量，只调尺寸
+    :param min_quality: 质量下限，只有设置了quality才有效，默认跟quality相同
+    :param max_encodes: 整图编码次数上限（不含探针图），达到上限后只会继续缩小尺寸，直到满足filesize
+    :return: (buffer, im)，im是最终采用的（可能缩小过的）图片，buffer是其编码后的数据
+    :raises ValueError: 缩小到resize的1像素下限仍超过filesize时
+    """
+    if not filesize:
+        return encode(im, quality), im
+
+    if quality is None or min_quality is None:
+        min_quality = quality
+    cnt = 0  # 整图编码次数
+
+    def try_encode(scale, q):
+        nonlocal cnt
+        cnt += 1
+        im2 = resize(im, scale) if scale < 1 else im
+        return encode(im2, q), im2
+
+    # 1 探针图估算缩放比例，同样内容缩小后每像素的信息量更大，所以估算结果偏保守
+    r = min(1, (_PROBE_AREA / area) ** 0.5)
+    probe = encode(resize(im, r) if r < 1 else im, min_quality)
+    scale = min(1, (filesize / (len(probe) / r ** 2)) ** 0.5)
+    if r == 1:  # 图片本身就很小，探针就是原图
+        if len(probe) <= filesize:
+            return _encode_to_filesize_quality(im, encode, filesize, probe, quality, min_quality, max_encodes)
+        scale *= 0.97
+
+    # 2 最低质量下，找尽量大的缩放比例
+    lo, hi = 0, None  # lo是已知能满足要求的最大比例，hi是已知不能满足要求的最小比例
+    best = None
+    prev_size = None  # 上一次编码的大小，用来判断是否已经缩小到resize的1像素下限
+    while True:
+        buffer, im2 = try_encode(scale, min_quality)
+        if len(buffer) <= filesize:
+            lo, best = scale, (buffer, im2)
+        else:
+            hi = scale
+            # 尺寸缩到下限后编码大小就不再变小，再缩也没用；另外也限制总编码次数，避免意外死循环
+            if not best and ((prev_size is not None and len(buffer) >= prev_size) or cnt >= max_encodes + 32):
+                raise ValueError(f'无法把图片编码到{filesize}字节以内，缩到最小仍有{len(buffer)}字节')
+            prev_size = len(buffer)
+        if best and (lo == 1 or len(best[0]) > 0.95 * filesize or cnt >= max_encodes // 2
+                     or (hi and hi - lo < 0.02)):
+            break
+
+        # 文件大小近似跟面积成正比，按比例预测下一个缩放比例
+        pred = scale * (filesize / len(buffer)) ** 0.5 * 0.98
+        if not best:  # 还没找到满足要求的尺寸，超出次数上限也要继续缩小
+            scale = min(pred, hi * 0.95)
+        else:  # 预测值限制在(lo, hi)区间内，保证区间每次都能明显缩小
+            top = hi or 1
+            scale = min(max(pred, lo + (top - lo) * 0.25), lo + (top - lo) * 0.75 if hi else 1)
+
+    # 3 在这个比例下，找尽量高的质量
+    buffer, im2 = best
+    return _encode_to_filesize_quality(im2, encode, filesize, buffer, quality, min_quality, max_encodes - cnt)
+
+
+def _encode_to_filesize_quality(im, encode, filesize, buffer, quality, min_quality, max_encodes):
+    """ 尺寸确定后，二分查找满足filesize的最高质量
+
+    :param buffer: im在min_quality下的编码结果，已知满足filesize
+    """
+    if quality is None or quality == min_quality or max_encodes <= 0:
+        return buffer, im
+
+    lo, hi = min_quality, quality + 1  # lo能满足要求，hi不能
+    while hi - lo > 1 and max_encodes > 0:
+        # 第一次先直接试最高质量，小图经常直接就满足了
+        q = quality if hi == quality + 1 else (lo + hi) // 2
+        b = encode(im, q)
+        max_encodes -= 1
+        if len(b) <= filesize:
+            lo, buffer = q, b
+        else:
+            hi = q
+    return buffer, im
+
+
 def _rgb_to_bgr_list(a):
     # 类型转为list
     if isinstance(a, np.ndarray):
@@ -498,23 +591,44 @@ class xlcv(EnchantBase):
         :param suffix: 使用的图片类型
 
         >> reduce_filesize(im, 300*1024, 'jpg')
+
+        只调整尺寸，按默认质量保存后满足filesize；如果要同时调整质量，并直接拿到编码结果，可以用encode_to_filesize
         """
+        if not filesize:
+            return im
+        return xlcv.encode_to_filesize(im, filesize, suffix)[1]
 
-        # 1 工具
-        def get_file_size(im):
-            success, buffer = cv2.imencode(suffix, im)
-            return len(buffer)
+    @staticmethod
+    def encode_to_filesize(im, filesize=None, suffix='.jpg', *, quality=None, min_quality=None, max_encodes=8):
+        """ 编码成不超过filesize的图片文件数据
 
-        # 2 然后开始循环处理
-        while filesize:
-            r = get_file_size(im) / filesize
-            if r <= 1:
-                break
+        :param filesize: 单位Bytes，None表示不限制
+        :param suffix: 使用的图片类型
+        :param quality: jpg、webp等有损格式的质量上限，None表示使用opencv默认参数，只调整尺寸
+        :param min_quality: 质量下限，会优先降低质量（不低于下限），仍不满足才缩小尺寸
+            默认跟quality相同
+        :param max_encodes: 整图编码次数的参考上限
+        :return: (buffer, im)，编码后的bytes，以及对应的（可能缩小过的）图片
+
+        >> buffer, im = xlcv.encode_to_filesize(im, 300*1024, '.jpg', quality=95, min_quality=70)
+        >> XlPath('a.jpg').write_bytes(buffer)
+        """
+        if suffix[0] != '.':
+            suffix = '.' + suffix
+        flag = {'.jpg': cv2.IMWRITE_JPEG_QUALITY, '.jpeg': cv2.IMWRITE_JPEG_QUALITY,
+                '.webp': cv2.IMWRITE_WEBP_QUALITY}.get(suffix.lower())
+        if flag is None:  # 无损格式没有质量参数
+            quality = min_quality = None
 
-            # 假设图片面积和文件大小成正比，如果r=4，表示长宽要各减小至1/(r**0.5)才能到目标文件大小
-            rate = min(1 / (r ** 0.5), 0.95)  # 并且限制每轮至少要缩小至95%，避免可能会迭代太多轮
-            im = cv2.resize(im, (int(im.shape[1] * rate), int(im.shape[0] * rate)))
-        return im
+        def encode(im, q):
+            return cv2.imencode(suffix, im, [flag, q] if q is not None else [])[1].tobytes()
+
+        def resize(im, scale):
+            h, w = im.shape[:2]
+            return cv2.resize(im, (max(int(w * scale), 1), max(int(h * scale), 1)), interpolation=cv2.INTER_AREA)
+
+        h, w = im.shape[:2]
+        return _encode_to_filesize(im, h * w, encode, resize, filesize, quality, min_quality, max_encodes)
 
     @staticmethod
     def __5_warp():
@@ -930,21 +1044,28 @@ class xlcv(EnchantBase):
         return colors
 
     @staticmethod
-    def color_desc(im, color_num=10):
-        """ 描述一张图的颜色分布，这个速度还特别慢，没有优化 """
-        from collections import Counter
-        from pyxllib.cv.rgbfmt import RgbFormatter
-
-        colors = xlcv.count_pixels(im)
-        total = sum([cnt for _, cnt in colors])
-        colors2 = Counter()
-        for c, cnt in colors[:10000]:
-            c0 = RgbFormatter(*c).find_similar_std_color()
-            colors2[c0.to_tuple()] += cnt
-
-        for c, cnt in colors2.most_common(color_num):
-            desc = RgbFormatter(*c).relative_color_desc()
-            print(desc, f'{cnt / total:.2%}')
+    def color_desc(im, color_num=10, *, precise_mode=False):
+        """ 描述一张图的颜色分布
+
+        每个像素通过查找表归类到最相近的标准色，再统计各标准色的占比
+
+        :param precise_mode: 同find_similar_std_color，默认用欧式距离，True时用RgbFormatter.distance的色彩距离算法
+        """
+        from pyxllib.cv.rgbfmt import RgbFormatter, classify_std_colors, _get_colors_array
+
+        if im.ndim == 2:
+            im = cv2.cvtColor(im, cv2.COLOR_GRAY2BGR)
+        rgbs = im[..., 2::-1]  # bgr转rgb，有alpha通道的话去掉
+        idx = classify_std_colors(rgbs, precise_mode=precise_mode)
+        counts = np.bincount(idx.ravel(), minlength=len(_get_colors_array(2)))
+        total = counts.sum()
+        colors = _get_colors_array(2)
+
+        for i in np.argsort(-counts, kind='stable')[:color_num]:
+            if not counts[i]:
+                break
+            desc = RgbFormatter(*colors[i].tolist()).relative_color_desc()
+            print(desc, f'{counts[i] / total:.2%}')
 
 
 class CvImg(np.ndarray):
@@ -28,7 +28,7 @@ except ImportError:
 
 from pyxllib.prog.pupil import inject_members
 from pyxllib.file.specialist import XlPath, get_font_file
-from pyxllib.cv.xlcvlib import xlcv
+from pyxllib.cv.xlcvlib import xlcv, _encode_to_filesize
 
 
 class PilImg(PIL.Image.Image):
@@ -217,18 +217,40 @@ class PilImg(PIL.Image.Image):
             None, 可以不输入，默认读取后按原尺寸返回，这样看似没变化，其实图片一读一写，是会对手机拍照的很多大图进行压缩的
 
         >> reduce_filesize(im, 300*1024, 'jpg')
+
+        只调整尺寸，按默认质量保存后满足filesize；如果要同时调整质量，并直接拿到编码结果，可以用encode_to_filesize
+        """
+        if not filesize:
+            return self
+        return xlpil.encode_to_filesize(self, filesize, suffix)[1]
+
+    def encode_to_filesize(self, filesize=None, suffix='.jpeg', *, quality=None, min_quality=None, max_encodes=8):
+        """ 编码成不超过filesize的图片文件数据，参数含义同xlcv.encode_to_filesize
+
+        :return: (buffer, im)，编码后的bytes，以及对应的（可能缩小过的）图片
         """
+        if suffix[0] == '.':
+            suffix = suffix[1:]
+        if suffix.lower() == 'jpg':
+            suffix = 'jpeg'
+        if suffix.lower() not in ('jpeg', 'webp'):
+            quality = min_quality = None
+
         im = self
-        # 循环处理
-        while filesize:
-            r = xlpil.evaluate_image_file_size(im, suffix) / filesize
-            if r <= 1:
-                break
-
-            # 假设图片面积和文件大小成正比，如果r=4，表示长宽要各减小至1/(r**0.5)才能到目标文件大小
-            rate = min(1 / (r ** 0.5), 0.95)  # 并且限制每轮至少要缩小至95%，避免可能会迭代太多轮
-            im = im.resize((int(im.size[0] * rate), int(im.size[1] * rate)))
-        return im
+        if im.mode in ('RGBA', 'P') and suffix.lower() == 'jpeg':
+            im = im.convert('RGB')
+
+        def encode(im, q):
+            file = io.BytesIO()
+            im.save(file, suffix, **({'quality': q} if q is not None else {}))
+            return file.getvalue()
+
+        def resize(im, scale):
+            w, h = im.size
+            return im.resize((max(int(w * scale), 1), max(int(h * scale), 1)))
+
+        w, h = im.size
+        return _encode_to_filesize(im, w * h, encode, resize, filesize, quality, min_quality, max_encodes)
 
     def trim(self, *, border=0, color=None):
         """ 默认裁剪掉白色边缘，可以配合 get_backgroup_color 裁剪掉背景色
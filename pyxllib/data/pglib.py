@@ -13,17 +13,22 @@ import sys
 from pyxllib.file.specialist import XlPath
 
 import io
-from collections import Counter
+import os
+import contextlib
+from collections import Counter, defaultdict
 import json
 import json
 import textwrap
 import datetime
 import re
+import time
 
+from more_itertools import chunked
 from tqdm import tqdm
 
 import psycopg
 import psycopg.rows
+import psycopg.sql
 
 from pyxllib.prog.newbie import round_int, human_readable_number
 from pyxllib.prog.pupil import utc_now, utc_timestamp, is_valid_identifier
@@ -148,7 +153,8 @@ END $$;
         # cur.close()
         return data
 
-    def exec2dict_batch(self, sql, batch_size=1000, use_offset=None, **kwargs):
+    def exec2dict_batch(self, sql, batch_size=1000, use_offset=None, *,
+                        mode=None, key_col=None, start_key=None, count=True, **kwargs):
         """ 分批返回数据的版本
 
         :param use_offset: 是否使用offset分页，会根据sql中是否含有where自动判断，但有时候最好明确指定以防错误
@@ -156,34 +162,93 @@ END $$;
                 每次取对应的满足条件的数据即可
                 这种情况，也需要本函数内部主动执行commit_all的
             否则，只是一种遍历查询，没有where或者where获取的数据情况是不会变化的，则要使用offset
+        :param str mode: 分批获取数据的方式，默认None会根据key_col、use_offset自动推断
+            offset，LIMIT/OFFSET分页，越往后每页要跳过的数据越多，大表后期会越来越慢，总耗时是O(n²)级别的
+            where，不用offset，每次都重新取满足where条件的前batch_size条，配合外部会修改数据状态的场景
+            keyset，键集分页，WHERE key_col > 上一批最后的值 ORDER BY key_col LIMIT n，每批都能走索引，速度稳定
+            cursor，psycopg的服务端命名游标，只执行一次查询，按batch_size流式拉取
+                注意遍历过程中不能commit，否则游标会被关闭
+        :param str key_col: keyset模式参照的列名，设置后mode默认就是keyset
+            要求是有索引、值唯一的列，比如主键；且查询结果里要有这个字段
+        :param start_key: keyset模式的起始值（不含），常用于断点续传
+        :param bool count: 是否先执行一次COUNT(*)统计数据总数，大表统计也挺耗时的，不需要的时候可以关掉
         :return:
             第1个值，是一个迭代器，看起来仍然能一条一条返回，实际后台是按照batch_size打包获取的
-            第2个值，是数据总数
+            第2个值，是数据总数，count=False时为None
         """
         if not isinstance(sql, SqlBuilder):
             raise ValueError('暂时只能搭配SQLBuilder使用')
 
-        if use_offset is None:
-            use_offset = not sql._where
-
-        num = self.exec2one(sql.build_count())
-        offset = 0
-
-        def yield_row():
-            nonlocal offset
+        if mode is None:
+            if key_col:
+                mode = 'keyset'
+            else:
+                if use_offset is None:
+                    use_offset = not sql._where
+                mode = 'offset' if use_offset else 'where'
+
+        sql = sql.copy()
+        if mode == 'keyset':
+            if not key_col:
+                raise ValueError('keyset模式需要指定key_col')
+            if sql._order_by and sql._order_by != [key_col]:
+                raise ValueError(f'keyset模式只能按照{key_col}排序，现在的排序规则是{sql._order_by}')
+            sql._order_by = [key_col]
+            if start_key is not None:
+                sql.where(f'{key_col} > {self.sql_literal(start_key)}')
+
+        num = self.exec2one(sql.build_count()) if count else None
+
+        def yield_offset():
+            offset = 0
             while True:
                 sql2 = sql.copy()
-                if not use_offset:  # 如果不使用offset，那么缓存的sql操作需要全部提交，确保数据都更新后，再提取数据
+                if mode == 'where':  # 如果不使用offset，那么缓存的sql操作需要全部提交，确保数据都更新后，再提取数据
                     self.commit_all()
-                sql2.limit(batch_size, offset)
+                    sql2.limit(batch_size)
+                else:
+                    sql2.limit(batch_size, offset)
                 rows = self.exec2dict(sql2.build_select(), **kwargs).fetchall()
-                if use_offset:
-                    offset += len(rows)
+                offset += len(rows)
                 if not rows:
                     break
                 yield from rows
 
-        return yield_row(), num
+        def yield_keyset():
+            name = key_col.split('.')[-1]  # 结果里的字段名不带表名前缀
+            last = None
+            while True:
+                sql2 = sql.copy()
+                if last is not None:
+                    sql2.where(f'{key_col} > {self.sql_literal(last)}')
+                sql2.limit(batch_size)
+                rows = self.exec2dict(sql2.build_select(), **kwargs).fetchall()
+                if not rows:
+                    break
+                yield from rows
+                if len(rows) < batch_size:
+                    break
+                last = rows[-1][name]
+
+        def yield_cursor():
+            # autocommit模式下，命名游标需要显式开一个事务
+            with (self.transaction() if self.autocommit else contextlib.nullcontext()):
+                cur = self.cursor(name=f'pyxllib_cursor_{id(sql)}', row_factory=psycopg.rows.dict_row)
+                try:
+                    cur.itersize = batch_size
+                    cur.execute(sql.build_select(), **kwargs)
+                    while True:
+                        rows = cur.fetchmany(batch_size)
+                        if not rows:
+                            break
+                        yield from rows
+                finally:
+                    cur.close()
+
+        funcs = {'offset': yield_offset, 'where': yield_offset, 'keyset': yield_keyset, 'cursor': yield_cursor}
+        if mode not in funcs:
+            raise ValueError(f'不支持的mode：{mode}')
+        return funcs[mode](), num
 
     exec_dict = exec2dict
 
@@ -197,6 +262,10 @@ END $$;
         # 注意list数组类型读、写都会自动适配py
         return val
 
+    def sql_literal(self, val):
+        """ 把py的值转成可以直接拼接到sql里的字面量文本，会正确处理引号转义 """
+        return psycopg.sql.Literal(val).as_string(self)
+
     @classmethod
     def autotype(cls, val):
         if isinstance(val, str):
@@ -237,13 +306,7 @@ END $$;
         vs = ','.join(['%s'] * (len(cols.keys())))
         query = f'INSERT INTO {table_name}({ks}) VALUES ({vs})'
         params = self.cvt_types(cols.values())
-
-        if on_conflict == 'REPLACE':
-            on_conflict = f'ON CONFLICT ON CONSTRAINT {table_name}_pkey DO UPDATE SET ' + \
-                          ','.join([f'{k}=EXCLUDED.{k}' for k in cols.keys()])
-        else:
-            on_conflict = f'ON CONFLICT {on_conflict}'
-        query += f' {on_conflict}'
+        query += ' ' + self._build_on_conflict(table_name, cols.keys(), on_conflict)
 
         self.commit_base(commit, query, params)
 
@@ -252,6 +315,7 @@ END $$;
 
         :param str keys: 要插入的字段名，一个字符串，逗号,隔开属性值
         :param list[list] ls: n行m列的数组
+            数据量大的时候，推荐使用copy_rows
 
         >> con.insert_rows('hosts2', 'id,host_name,nick_name', [[1, 'test5', 'dcba'], [11, 'test', 'aabb']])
         """
@@ -261,15 +325,168 @@ END $$;
         params = []
         for cols in ls:
             params += self.cvt_types(cols)
+        query += ' ' + self._build_on_conflict(table_name, keys.split(','), on_conflict)
+
+        self.commit_base(commit, query, params)
 
+    @classmethod
+    def _build_on_conflict(cls, table_name, keys, on_conflict):
+        """ 生成 ON CONFLICT 子句，on_conflict参数的规则见insert_row """
         if on_conflict == 'REPLACE':
-            on_conflict = f'ON CONFLICT ON CONSTRAINT {table_name}_pkey DO UPDATE SET ' + \
-                          ','.join([f'{k.strip()}=EXCLUDED.{k.strip()}' for k in keys.split(',')])
+            return f'ON CONFLICT ON CONSTRAINT {table_name}_pkey DO UPDATE SET ' + \
+                ','.join([f'{k.strip()}=EXCLUDED.{k.strip()}' for k in keys])
         else:
-            on_conflict = f'ON CONFLICT {on_conflict}'
-        query += f' {on_conflict}'
+            return f'ON CONFLICT {on_conflict}'
+
+    def _get_conflict_columns(self, clause):
+        """ 解析 ON CONFLICT ... DO UPDATE 子句的冲突判定字段，DO NOTHING等情况返回None """
+        if 'DO UPDATE' not in clause.upper():
+            return None
+        m = re.match(r'ON CONFLICT\s*\(', clause, flags=re.IGNORECASE)
+        if m:
+            # 冲突字段里可能有lower(name)这类带括号的表达式，要找到配对的右括号；引号里的括号不算
+            depth, quote = 1, None
+            for i in range(m.end(), len(clause)):
+                c = clause[i]
+                if quote:
+                    if c == quote:
+                        quote = None
+                elif c in '\'"':
+                    quote = c
+                elif c == '(':
+                    depth += 1
+                elif c == ')':
+                    depth -= 1
+                    if not depth:
+                        return clause[m.end():i].strip()
+            raise ValueError(f'ON CONFLICT子句的括号不配对：{clause}')
+        m = re.match(r'ON CONFLICT\s+ON CONSTRAINT\s+(\w+)', clause, flags=re.IGNORECASE)
+        if m:
+            cols = self.exec2col('SELECT a.attname FROM pg_constraint c '
+                                 'JOIN pg_attribute a ON a.attrelid = c.conrelid AND a.attnum = ANY(c.conkey) '
+                                 'WHERE c.conname = %s', (m.group(1),))
+            return ','.join(cols) or None
+
+    def _get_column_type_oids(self, table_name, keys):
+        """ 获得表格中各个字段的类型oid，顺序跟keys对应 """
+        rows = self.execute('SELECT attname, atttypid FROM pg_attribute '
+                            'WHERE attrelid = %s::regclass AND attnum > 0 AND NOT attisdropped',
+                            (table_name,)).fetchall()
+        oids = dict(rows)
+        return [oids[k] for k in keys]
+
+    def copy_rows(self, table_name, keys, rows, *, on_conflict='DO NOTHING', batch_size=10000,
+                  binary=True, print_mode=0):
+        """ 【增】用COPY协议批量导入数据
+
+        insert_rows是把所有数据拼成一条超长的INSERT语句，executemany则要逐条绑定参数，
+        数据量大时瓶颈都在参数处理和网络往返上，COPY是pg专门用来批量导入数据的协议，会快很多
+
+        :param str|list keys: 要插入的字段名，逗号,隔开的字符串，或者字段名列表
+        :param rows: n行m列的数据，可以是生成器，会自动按batch_size分批导入，每批是一个独立的事务
+        :param on_conflict: 跟insert_row的规则一样，默认DO NOTHING
+            None，直接COPY进目标表，速度最快，但遇到冲突会报错
+            其他值，先COPY进临时表，再用 INSERT INTO ... SELECT ... ON CONFLICT ... 合并进目标表
+                DO UPDATE的时候，同一批里如果有重复的key，以最后出现的数据为准，跟逐条插入的效果一致
+        :param binary: 是否使用二进制格式传输，能省去数据的文本格式化和解析
+            如果py数据类型跟字段类型对不上，会自动退回文本格式
+        :param print_mode: 是否显示进度条，会显示每秒导入的条数
+        :return int: 处理的数据条数（含因冲突被跳过的）
+
+        >> con.copy_rows('hosts2', 'id,host_name,nick_name', [[1, 'test5', 'dcba'], [11, 'test', 'aabb']])
+        """
+        if isinstance(keys, str):
+            keys = [k.strip() for k in keys.split(',')]
+        cols = ','.join(keys)
+
+        # 1 有冲突处理规则的时候，要借助临时表中转
+        clause, stage = None, None
+        if on_conflict:
+            clause = self._build_on_conflict(table_name, keys, on_conflict)
+            stage = '_pyxllib_stage_' + re.sub(r'\W', '_', table_name)
+            self.execute(f'DROP TABLE IF EXISTS {stage}')
+            # 只取需要的字段，不复制约束、默认值，避免误触发自增序列
+            self.execute(f'CREATE TEMP TABLE {stage} AS SELECT {cols} FROM {table_name} WITH NO DATA')
+            self.execute(f'ALTER TABLE {stage} ADD COLUMN _pyxllib_rowid bigserial')
+            conflict_cols = self._get_conflict_columns(clause)
+            if conflict_cols:
+                select = f'SELECT DISTINCT ON ({conflict_cols}) {cols} FROM {stage} ' \
+                         f'ORDER BY {conflict_cols}, _pyxllib_rowid DESC'
+            else:
+                select = f'SELECT {cols} FROM {stage} ORDER BY _pyxllib_rowid'
+            merge_query = f'INSERT INTO {table_name}({cols}) {select} {clause}'
+        target = stage or table_name
+
+        # 2 分批导入
+        types = self._get_column_type_oids(target, keys) if binary else None
+        json_cols = [i for i, t in enumerate(types or []) if t in (114, 3802)]  # json、jsonb
+
+        def copy_batch(batch, use_binary):
+            with self.cursor() as cur:
+                with cur.copy(f'COPY {target}({cols}) FROM STDIN' + (' (FORMAT BINARY)' if use_binary else '')) as cp:
+                    if use_binary:
+                        cp.set_types(types)
+                        for row in batch:
+                            row = list(row)
+                            for i in json_cols:  # 二进制格式的json字段要传入py对象，传入文本会被当成json字符串
+                                if isinstance(row[i], str):
+                                    row[i] = json.loads(row[i])
+                            cp.write_row(row)
+                    else:
+                        for row in batch:
+                            cp.write_row(self.cvt_types(row))
+
+        n, start_time = 0, time.time()
+        pbar = tqdm(desc=f'导入{table_name}表', unit='rows', disable=not print_mode)
+        try:
+            for batch in chunked(rows, batch_size):
+                if binary:
+                    try:
+                        with self.transaction():  # 出错时只会回滚这次copy
+                            copy_batch(batch, True)
+                    except Exception:  # 类型对不上等问题，改用文本格式重试，如果是其他问题，文本格式也会再次报错
+                        binary = False
+                if not binary:
+                    copy_batch(batch, False)
+                if clause:
+                    self.execute(merge_query)
+                    self.execute(f'TRUNCATE {stage}')
+                self.commit()
+                n += len(batch)
+                pbar.update(len(batch))
+        finally:
+            pbar.close()
+            if stage and not self.closed:
+                self.rollback()
+                self.execute(f'DROP TABLE IF EXISTS {stage}')
+                self.commit()
+
+        if print_mode:
+            elapsed = time.time() - start_time
+            print(f'{table_name}表导入{n}条数据，耗时{elapsed:.2f}秒，{n / max(elapsed, 1e-6):.0f}条/秒')
+        return n
+
+    def commit_all(self, copy_min_rows=1000):
+        """ 提交commit_base(-1)缓存的所有操作
+
+        :param copy_min_rows: 缓存的单条INSERT语句，数据量达到这个值的，改用copy_rows批量导入
+        """
+        if not self._commit_cache:
+            self.commit()
+            return
 
-        self.commit_base(commit, query, params)
+        for query, params in self._commit_cache.items():
+            m = re.match(r'INSERT INTO (\S+?)\((.+?)\) VALUES \(%s(?:,%s)*\)(?:\s+ON CONFLICT (.+))?$',
+                         query, flags=re.DOTALL)
+            if m and len(params) >= copy_min_rows:
+                self.copy_rows(m.group(1), m.group(2), params, on_conflict=m.group(3))
+            else:
+                cur = self.cursor()
+                cur.executemany(query, params)
+                cur.close()
+                self.commit()
+
+        self._commit_cache = defaultdict(list)
 
     def __6_高级统计(self):
         pass
@@ -376,10 +593,11 @@ END $$;
         :param batch_size: 每次读取的行数和保存的行数
         :param key_col: 作为主键的列名，如果有的话，会自动去重
             强烈推荐要设置
-            实际不一定要用主键，只要是有顺序值的列就行
-
-        todo 暴力最简单的版本不难写，我纠结的是缓存机制，还有bytes类型数据会有点大等问题
-            还需要先支持一个通用的缓存写文件功能
+            实际不一定要用主键，只要是有索引、值唯一、有顺序的列就行
+            设置后使用keyset分页导出，并支持断点续传：
+                每写入一批数据，会在 file_path + '.ckpt' 检查点文件里记录已导出的最后一个key值和文件字节数，
+                再次导出时直接从检查点继续，不用重新读取整个已导出的文件
+            没有设置时，使用服务端游标流式导出，数据追加到文件末尾
         """
         # 1 sql
         if isinstance(table_name, str):
@@ -392,22 +610,35 @@ END $$;
         assert isinstance(sql, SqlBuilder)
 
         file_path = XlPath(file_path)
-        if key_col:
-            sql.order_by(key_col)
-            if file_path.is_file():
-                # 读取现有数据，找出主键最大值
-                data = file_path.read_jsonl(batch_size=1000)
-                if data:
-                    max_val = max([x[key_col] for x in data]) if data else None
-                    if max_val is not None:
-                        sql.where(f'{key_col} > {max_val}')
+        ckpt_file = XlPath(str(file_path) + '.ckpt')
+        start_key = None
+        if key_col and file_path.is_file():
+            start_key = _get_export_resume_key(file_path, ckpt_file, key_col)
 
         # 2 获取数据
         file = StreamJsonlWriter(file_path, batch_size=batch_size)  # 流式存储
-        rows, total = self.exec2dict_batch(sql, batch_size=batch_size, use_offset=True)
+        if key_col:
+            rows, total = self.exec2dict_batch(sql, batch_size=batch_size, key_col=key_col, start_key=start_key,
+                                               count=bool(print_mode))
+        else:
+            rows, total = self.exec2dict_batch(sql, batch_size=batch_size, mode='cursor', count=bool(print_mode))
+
+        def save_checkpoint(last):
+            if key_col and last is not None:
+                tmp_file = XlPath(str(ckpt_file) + '.tmp')
+                tmp_file.write_json({'key_col': key_col, 'last': last, 'size': file_path.size()}, default=str)
+                os.replace(tmp_file, ckpt_file)
+
+        name = key_col.split('.')[-1] if key_col else None
+        last = start_key
         for row in tqdm(rows, total=total, desc=f'从{table_name}表导出数据', disable=not print_mode):
             file.append_line(row)
+            if name:
+                last = row[name]
+                if not file.cache_text_lines:  # 刚写入了一批数据
+                    save_checkpoint(last)
         file.flush()
+        save_checkpoint(last)
 
     def check_db_tables_size(self, db_name=None):
         """ 查看指定数据下所有表格的大小 """
@@ -479,6 +710,56 @@ END $$;
 """
 
 
+def _read_last_jsonl_record(file_path, block_size=65536):
+    """ 从文件末尾倒着找最后一条完整的jsonl数据
+
+    :return: (record, end)，end是这条数据（含换行符）结束的字节位置，
+        end之后是写入中断等原因产生的不完整内容；找不到有效数据时返回 (None, 0)
+    """
+    with open(file_path, 'rb') as f:
+        size = f.seek(0, 2)
+        pos, buf = size, b''
+        while pos > 0:
+            step = min(block_size, pos)
+            pos -= step
+            f.seek(pos)
+            buf = f.read(step) + buf
+            lines = buf.split(b'\n')
+            # 没读到文件开头时，第1行可能是不完整的，留到下一轮再解析
+            for i in range(len(lines) - 1, -1 if pos == 0 else 0, -1):
+                if not lines[i].strip():
+                    continue
+                try:
+                    record = json.loads(lines[i])
+                except ValueError:
+                    continue
+                end = pos + sum(len(x) + 1 for x in lines[:i + 1])
+                return record, min(end, size)
+    return None, 0
+
+
+def _get_export_resume_key(file_path, ckpt_file, key_col):
+    """ export_jsonl断点续传时，获得已导出的最后一个key值，并截掉文件末尾不完整的数据 """
+    end, last = None, None
+    if ckpt_file.is_file():
+        ckpt = ckpt_file.read_json()
+        if ckpt.get('key_col') == key_col and file_path.size() >= ckpt['size']:
+            end, last = ckpt['size'], ckpt['last']
+
+    if end is None:  # 没有检查点（比如旧版导出的文件），读取文件最后一条数据
+        record, end = _read_last_jsonl_record(file_path)
+        last = record[key_col.split('.')[-1]] if record else None
+
+    # 检查点之后的内容，可能是上次中断时写了一半的数据，截掉后重新导出
+    with open(file_path, 'r+b') as f:
+        f.truncate(end)
+        if end:
+            f.seek(end - 1)
+            if f.read(1) != b'\n':
+                f.write(b'\n')
+    return last
+
+
 class XlprDb(Connection):
     """ xlpr统一集中管理的一个数据库
 
@@ -1035,30 +1316,35 @@ class XlprDb(Connection):
     def __4_一些数据更新操作(self):
         """ 比如一些扩展字段，在调用api的时候为了性能并没有进行计算，则可以这里补充更新 """
 
-    def update_files_dhash(self, print_mode=True):
-        """ 更新files表中的dhash字段值 """
-        from pyxllib.cv.imhash import dhash
-        from pyxllib.xlcv import xlpil
+    def update_files_dhash(self, print_mode=True, *, batch_size=1000, processes_num=-1):
+        """ 更新files表中的dhash字段值
 
-        # 获取总图片数
-        total_count = self.execute("SELECT COUNT(*) FROM files WHERE dhash IS NULL").fetchall()[0][0]
+        :param batch_size: 每批读取的图片数，每批在多进程里解码，矩阵化计算哈希后，一次性写回数据库
+        :param processes_num: 解码图片的进程数
+        """
+        from pyxllib.cv.imhash import batch_hashes, hashes_to_hex
 
-        # 执行查询语句，获取dhash为NULL的记录
+        # 获取总图片数
+        total_count = self.exec2one("SELECT COUNT(*) FROM files WHERE dhash IS NULL")
 
         # 初始化进度条
         progress_bar = tqdm(total=total_count, disable=not print_mode)
 
+        # 按id递增分批，读取失败的图片dhash会仍然是NULL，不会被重复读取
+        last_id = -1
         while True:
-            result = self.execute("SELECT id, data FROM files WHERE dhash IS NULL LIMIT 5")
-            if not result:
+            rows = self.execute("SELECT id, data FROM files WHERE dhash IS NULL AND id > %s ORDER BY id LIMIT %s",
+                                (last_id, batch_size)).fetchall()
+            if not rows:
                 break
-            for row in result:
-                file_id = row[0]
-                im = xlpil.read_from_buffer(row[1])
-                computed_dhash = str(dhash(im))
-                self.update_row('files', {'dhash': computed_dhash}, {'id': file_id})
-                progress_bar.update(1)
+            last_id = rows[-1][0]
+            hashes, ok = batch_hashes([bytes(row[1]) for row in rows], 'dhash', processes_num=processes_num)
+            params = [(h, row[0]) for row, h, k in zip(rows, hashes_to_hex(hashes), ok) if k]
+            with self.cursor() as cur:
+                cur.executemany("UPDATE files SET dhash=%s WHERE id=%s", params)
             self.commit()
+            progress_bar.update(len(rows))
+        progress_bar.close()
 
     def append_history(self, table_name, where, backup_keys, *,
                        can_merge=None,
@@ -5,12 +5,14 @@
 # @Date   : 2022/04/12 08:59
 
 import copy
+import itertools
 import json
 import re
 import sqlite3
 import warnings
 from collections import defaultdict
 
+from more_itertools import chunked
 import pandas as pd
 
 # 旧版的pandas警告
@@ -478,11 +480,55 @@ class Connection(sqlite3.Connection, SqlBase):
         DELETE	删除记录。
     DQL - 数据查询语言
         SELECT	从一个或多个表中检索某些记录。
+
+    >> con = Connection.connect('data.db')  # 等价于 sqlite3.connect('data.db', factory=Connection)，并应用性能配置
     """
 
+    def __init__(self, *args, **kwargs):
+        sqlite3.Connection.__init__(self, *args, **kwargs)
+        SqlBase.__init__(self, *args, **kwargs)
+
+    @classmethod
+    def connect(cls, database, *, profile='fast', **kwargs):
+        """ 连接数据库
+
+        :param profile: 性能配置方案
+            fast，默认，见tune的参数
+            None，不做任何配置，使用sqlite的默认设置
+            dict，自定义tune的参数
+        :param kwargs: sqlite3.connect的其他参数，比如timeout、check_same_thread
+        """
+        con = sqlite3.connect(database, factory=cls, **kwargs)
+        if profile == 'fast':
+            con.tune()
+        elif isinstance(profile, dict):
+            con.tune(**profile)
+        return con
+
     def __1_库(self):
         pass
 
+    def tune(self, *, journal_mode='WAL', synchronous='NORMAL', mmap_size=256 * 1024 ** 2,
+             cache_size=64 * 1024 ** 2, temp_store='MEMORY', busy_timeout=5000):
+        """ 性能相关的配置，sqlite的默认配置偏保守，大批量读写的时候可以快很多
+
+        :param journal_mode: WAL模式下，读写可以并发，写入也只是顺序追加到wal文件
+        :param synchronous: WAL模式下用NORMAL是安全的，只有断电才可能丢失最近的事务，但不会损坏数据库
+        :param mmap_size: 内存映射读取的字节数上限，减少read系统调用
+        :param cache_size: 页缓存的字节数，默认只有2MB
+        :param temp_store: 临时表、临时索引放在内存
+        :param busy_timeout: 数据库被其他连接锁住时，等待的毫秒数
+        """
+        pragmas = {'journal_mode': journal_mode,
+                   'synchronous': synchronous,
+                   'mmap_size': mmap_size,
+                   'cache_size': cache_size and -(cache_size // 1024),  # 负数表示按KB计算
+                   'temp_store': temp_store,
+                   'busy_timeout': busy_timeout}
+        for k, v in pragmas.items():
+            if v is not None:
+                self.execute(f'PRAGMA {k}={v}')
+
     def vacuum(self):
         """ 删除数据后，文件不会直接减小，需要使用vacuum来实际压缩文件占用空间 """
         self.execute('vacuum')  # 不用 commit
@@ -512,19 +558,52 @@ class Connection(sqlite3.Connection, SqlBase):
         cur.row_factory = sqlite3.Row
         return cur.execute(*args, **kwargs)
 
+    @staticmethod
+    def _dict_factory(cursor, row):
+        d = {}
+        for idx, col in enumerate(cursor.description):
+            d[col[0]] = row[idx]
+        return d
+
     def exec2dict(self, *args, **kwargs):
         """ execute基础上，改成返回值为dict类型 """
-
-        def dict_factory(cursor, row):
-            d = {}
-            for idx, col in enumerate(cursor.description):
-                d[col[0]] = row[idx]
-            return d
-
         cur = self.cursor()  # todo 不关是不是不好？如果出错了是不是会事务未结束导致无法修改表格结构？是否有auto close的机制？
-        cur.row_factory = dict_factory
+        cur.row_factory = self._dict_factory
         return cur.execute(*args, **kwargs)
 
+    def exec2dict_batch(self, sql, batch_size=1000, *, params=(), count=True):
+        """ 分批返回数据的版本，跟pglib.Connection.exec2dict_batch的接口对应
+
+        sqlite的游标本身就是逐步计算结果的，这里只执行一次查询，每次fetchmany取batch_size条，不会一次性读入内存
+
+        :param str|SqlBuilder sql: 查询语句
+        :param params: sql里?占位符对应的参数
+        :param bool count: 是否先统计数据总数
+        :return:
+            第1个值，是一个迭代器，逐条返回dict格式的数据
+            第2个值，是数据总数，count=False时为None
+        """
+        if isinstance(sql, SqlBuilder):
+            num = self.exec2one(sql.build_count(), params) if count else None
+            sql = sql.build_select()
+        else:
+            num = self.exec2one(f'SELECT COUNT(*) FROM ({sql})', params) if count else None
+
+        def yield_row():
+            cur = self.cursor()
+            cur.row_factory = self._dict_factory
+            try:
+                cur.execute(sql, params)
+                while True:
+                    rows = cur.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    yield from rows
+            finally:
+                cur.close()
+
+        return yield_row(), num
+
     # 兼容老版本
     exec_dict = exec2dict
 
@@ -566,3 +645,86 @@ class Connection(sqlite3.Connection, SqlBase):
         ks = ','.join(cols.keys())
         vs = ','.join('?' * (len(cols.keys())))
         self.execute(f'INSERT OR {if_exists} INTO {table_name}({ks}) VALUES ({vs})', self.cvt_types(cols.values()))
+
+    def _executemany_chunks(self, query, keys, rows, batch_size):
+        """ 分批executemany，每批是一个事务
+
+        sqlite3模块会缓存编译好的语句，executemany整批数据只需要prepare一次；
+        而默认每条语句都是独立事务，每个事务都要同步磁盘，所以批量写入一定要合并事务
+
+        :return int: 处理的数据条数
+        """
+        n = 0
+        for batch in chunked(rows, batch_size):
+            if isinstance(batch[0], dict):
+                batch = [[x.get(k) for k in keys] for x in batch]
+            with self:  # 正常结束时commit，出错时rollback
+                self.executemany(query, [self.cvt_types(x) for x in batch])
+            n += len(batch)
+        return n
+
+    @classmethod
+    def _parse_keys(cls, keys, rows):
+        """ keys可以是逗号隔开的字符串、字段名列表；没有设置的时候，尝试从第1条dict数据里获取
+
+        :return: keys, rows
+        """
+        if keys is None:
+            rows = iter(rows)
+            first = next(rows, None)
+            if first is None:
+                return [], []
+            if not isinstance(first, dict):
+                raise ValueError('数据不是dict格式时，需要指定keys')
+            keys = list(first.keys())
+            rows = itertools.chain([first], rows)
+        elif isinstance(keys, str):
+            keys = [k.strip() for k in keys.split(',')]
+        return keys, rows
+
+    def insert_rows(self, table_name, keys, rows, if_exists='IGNORE', *, batch_size=10000):
+        """ 【增】批量插入数据
+
+        :param str|list|None keys: 要插入的字段名，逗号,隔开的字符串，或者字段名列表
+            rows是dict格式的时候可以不设置，默认使用第1条数据的keys
+        :param rows: n行m列的数据，或者dict格式的数据，可以是生成器
+        :param if_exists: 同insert_row
+        :param batch_size: 每批数据作为一个事务提交
+        :return int: 处理的数据条数（含IGNORE跳过的）
+
+        >> con.insert_rows('files', 'etag,name', [['abc', 'a.jpg'], ['def', 'b.jpg']])
+        """
+        keys, rows = self._parse_keys(keys, rows)
+        if not keys:
+            return 0
+        query = f'INSERT OR {if_exists} INTO {table_name}({",".join(keys)}) VALUES ({",".join("?" * len(keys))})'
+        return self._executemany_chunks(query, keys, rows, batch_size)
+
+    def upsert_rows(self, table_name, keys, rows, conflict_cols, update_cols=None, *, batch_size=10000):
+        """ 【增/改】批量插入数据，已存在的数据则更新指定字段
+
+        跟insert_rows(if_exists='REPLACE')的区别是，REPLACE会删除旧行再插入，没有提供的字段会被重置，
+        upsert只更新update_cols，其他字段保留原值
+
+        :param str|list conflict_cols: 判断数据是否已存在的字段，要有对应的唯一索引或主键
+        :param str|list update_cols: 已存在时要更新的字段，默认是keys里除了conflict_cols的所有字段
+            如果为空，则已存在的数据不做处理
+        :return int: 处理的数据条数
+        """
+        keys, rows = self._parse_keys(keys, rows)
+        if not keys:
+            return 0
+        if isinstance(conflict_cols, str):
+            conflict_cols = [k.strip() for k in conflict_cols.split(',')]
+        if update_cols is None:
+            update_cols = [k for k in keys if k not in conflict_cols]
+        elif isinstance(update_cols, str):
+            update_cols = [k.strip() for k in update_cols.split(',')]
+
+        query = f'INSERT INTO {table_name}({",".join(keys)}) VALUES ({",".join("?" * len(keys))}) ' \
+                f'ON CONFLICT({",".join(conflict_cols)}) '
+        if update_cols:
+            query += 'DO UPDATE SET ' + ','.join([f'{k}=excluded.{k}' for k in update_cols])
+        else:
+            query += 'DO NOTHING'
+        return self._executemany_chunks(query, keys, rows, batch_size)
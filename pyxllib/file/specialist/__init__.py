@@ -6,11 +6,14 @@
 
 
 from collections import OrderedDict
-import sqlite3
+from collections.abc import Sequence
+import heapq
+import tempfile
 
 from joblib import Parallel, delayed
 
 from pyxllib.file.specialist.filelib import *
+from pyxllib.file.specialist.filelib import _get_workers_num
 from pyxllib.file.specialist.dirlib import *
 from pyxllib.file.specialist.download import *
 
@@ -22,15 +25,97 @@ def merge_jsonl(*infiles):
     return data
 
 
+class LazyJsonlRecords(Sequence):
+    """ 基于行偏移量索引（LineOffsetIndex）按需读取的jsonl记录，只读，用法上尽量模拟list
+
+    空行会被跳过，跟read_jsonl的条目编号一致；但非法的json行不会跳过，访问到时会报错
+    """
+
+    def __init__(self, file, encoding='utf8'):
+        self.index = XlPath(file).line_index()
+        self.encoding = encoding
+
+    def __len__(self):
+        return self.index.num_records
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return list(self.islice(item.start, item.stop, item.step))
+        line = self.index.read_line(self.index.line_no(item), self.encoding)
+        return jsonl_loads(line)
+
+    def __iter__(self):
+        return self.islice()
+
+    def islice(self, start=None, end=None, step=None):
+        """ 流式读取区间内的记录，会直接seek到start条记录所在的位置 """
+        start, end, step = slice(start, end, step).indices(len(self))
+        if start >= end:
+            return
+        k = 0
+        for line in self.index.iter_lines(self.index.line_no(start), encoding=self.encoding):
+            if not line:
+                continue
+            if k % step == 0:
+                yield jsonl_loads(line)
+            k += 1
+            if start + k >= end:
+                break
+
+
+class RecordsChunkProcessor:
+    """ 多进程分块处理records的引擎
+
+    基于XlExecutor的多进程后端：records按chunk_size打包提交，同时在跑的块数限制在进程数的2倍以内，
+    所以输入可以是很大的生成器，内存占用也有上限。结果按输入的原顺序流式返回。
+    func可以是lambda、闭包等普通pickle不支持的函数。
+    """
+
+    def __init__(self, func, processes_num=-1, chunk_size=1000, error_mode='raise'):
+        """
+        :param func: 处理单条record的函数
+        :param int processes_num: 进程数，-1表示使用全部cpu
+        :param int chunk_size: 每次提交给子进程的记录数，func很轻量时要设大一些，减少进程通信开销
+        :param str error_mode: func报错时的处理方式
+            raise（默认）: 在主进程抛出RuntimeError，信息里带有子进程的完整报错
+            skip: 该条结果当成None处理，报错记录在self.errors里
+        """
+        self.func = func
+        self.processes_num = _get_workers_num(processes_num)
+        self.chunk_size = chunk_size
+        self.error_mode = error_mode
+        self.errors = []  # [(记录序号, 报错信息), ...]
+
+    def imap(self, records):
+        """ 按原顺序逐条返回每个record的处理结果 """
+        from pyxllib.prog.specialist.xlexecutor import XlExecutor
+
+        # 都用skip模式逐条捕获异常，避免一条数据出错就丢掉整块的结果，raise模式由这里转成RuntimeError
+        executor = XlExecutor(self.processes_num, 'process', chunk_size=self.chunk_size, error_mode='skip')
+        executor.errors = self.errors
+        offset = len(self.errors)
+        results = executor.map(self.func, records)
+        try:
+            for y in results:
+                if self.error_mode == 'raise' and len(self.errors) > offset:
+                    i, msg = self.errors[offset]
+                    raise RuntimeError(f'第{i}条记录处理出错：\n{msg}')
+                yield y
+        finally:
+            results.close()
+
+
 class JsonlDataFile:
     """ 通用的jsonl文件处理类 """
 
-    def __init__(self, filepath=None, num_records=None):
+    def __init__(self, filepath=None, num_records=None, *, lazy=False):
         """
         从指定的jsonl文件中读取数据。可以选择读取全部数据或只读取前N条数据。
 
         :param str filepath: jsonl文件的路径
         :param int num_records: 指定读取的记录数量，如果为None则读取全部数据
+        :param bool lazy: 懒加载模式，不把数据全部读入内存，而是建立行偏移量索引，按需读取记录
+            适合几个G的大文件做browse_record等随机查看操作，此时records是只读的LazyJsonlRecords
         """
         self.infile = None
         self.records = []
@@ -47,7 +132,9 @@ class JsonlDataFile:
                 self.infile = filepath
 
         if self.infile and self.infile.is_file():  # 机制上文件也可能不存在的，有可能只是一个预设目录~
-            if num_records is None:
+            if lazy:
+                self.records = LazyJsonlRecords(self.infile)
+            elif num_records is None:
                 # 读取全部数据
                 if self.infile.is_file():
                     self.records = self.infile.read_jsonl()
@@ -75,7 +162,10 @@ class JsonlDataFile:
             if end is not None and end < 0:
                 end = total_records + end
 
-        iterator = islice(self.records, start, end, step)
+        if isinstance(self.records, LazyJsonlRecords):
+            iterator = self.records.islice(start, end, step)
+        else:
+            iterator = islice(self.records, start, end, step)
         while True:
             batch = list(islice(iterator, batch_size))
             if not batch:
@@ -91,15 +181,18 @@ class JsonlDataFile:
         :param key: 一个函数，对record的映射，通过这个映射规则来分组
         :param sort_mode:
             keep: 保留原本的相对顺序
-            id: 按照id的值进行排序
+            id: 按照id的值进行排序，数值id排在字符串id前面，缺少id的记录排在最后
             sort: 按照key的值进行排序
+
+        records本来就全部在内存里，这里直接在内存分组；
+        数据量超过内存时，应该用JsonlDataDir.yield_group(global_group=True)走外存分组
         """
         # 1 创建一个默认字典来保存分组
         grouped_data = OrderedDict()
 
         records = self.records
         if sort_mode == 'id':
-            records = sorted(records, key=lambda x: x['id'])
+            records = sorted(records, key=lambda x: JsonlExternalGrouper.id_sortkey(x.get('id')))
 
         # 2 对数据进行分组
         for record in records:
@@ -280,6 +373,9 @@ class JsonlDataFile:
                             timeout=None,
                             print_mode=0,
                             threads_num=1,
+                            processes_num=1,
+                            chunk_size=1000,
+                            error_mode='raise',
                             **kwargs):
         """ 对records中的每个record应用函数func，可以选择是否在原地修改，以及是否显示进度条
 
@@ -288,22 +384,33 @@ class JsonlDataFile:
         :param int print_mode: 是否显示处理过程的进度条，0表示不显示（默认），1表示显示
         :return JsonlDataFile or None: 如果inplace为False，则返回新的JsonlDataFile，否则返回None
         :param int threads_num: 线程数，默认为1，即单线程
+        :param int processes_num: 进程数，默认为1，不为1时使用RecordsChunkProcessor多进程分块处理，
+            适合cpu密集的func，此时threads_num、timeout参数无效
+        :param int chunk_size: 多进程时每次提交给子进程的记录数
+        :param str error_mode: 多进程时func报错的处理方式，详见RecordsChunkProcessor
 
         遍历self.records，对每个record执行func函数，如果func返回None，则不包含该record到新的records中。
         """
+        if processes_num != 1:
+            engine = RecordsChunkProcessor(func, processes_num, chunk_size, error_mode)
+            results = engine.imap(self.records)
+            new_records = [y for y in tqdm(results, total=len(self.records), disable=not print_mode, **kwargs) if y]
+            if inplace:
+                self.records = new_records
+            return new_records
+
         backend = 'threading' if threads_num != 1 else 'sequential'
+        tasks = (delayed(func)(record) for record in self.records)  # 用生成器，让joblib按需分派任务
 
         if print_mode:
             parallel = Parallel(n_jobs=threads_num, backend=backend,
                                 timeout=timeout, return_as='generator')
-            tasks = [delayed(func)(record) for record in self.records]
             new_records = []
             for y in tqdm(parallel(tasks), total=len(self.records), **kwargs):
                 if y:
                     new_records.append(y)
         else:
             parallel = Parallel(n_jobs=threads_num, backend=backend, timeout=timeout)
-            tasks = [delayed(func)(record) for record in self.records]
             new_records = parallel(tasks)
             new_records = [y for y in new_records if y]
 
@@ -324,6 +431,150 @@ class JsonlDataFile:
                                         threads_num=threads_num)
 
 
+class JsonlExternalGrouper:
+    """ 外存分组：数据量超过内存时，对jsonl记录按key分组，内存占用有上限
+
+    原理是外部排序：
+        1、流式读取记录，每攒够run_bytes的数据，就在内存里按(key, 序号)排序后写到一个临时的有序文件
+        2、对所有有序文件做k路归并，相同key的记录就会连续出现，依次拼成一组
+        3、如果要保留各组首次出现的顺序，再以各组首条记录的序号为key，对组做一轮同样的外部排序
+
+    内存里只需要存放一个run的数据，以及当前正在拼接的一组数据
+    """
+
+    SEP = '\x1e'  # 组内多行记录的分隔符，合法的json文本里不会出现未转义的控制字符
+
+    def __init__(self, key=None, sort_mode='keep', *, tmp_dir=None,
+                 run_bytes=256 * 1024 * 1024, max_open_files=128):
+        """
+        :param key: 对record的映射函数，返回值会转成str作为分组依据；None时每条记录单独一组
+        :param sort_mode:
+            keep: 保留原本的相对顺序，各组按首次出现的位置排列
+            id: 组内按record['id']排序，各组按组内最小id排列
+                id允许int、str混用，数值排在字符串前面，缺少id的记录排在最后
+            sort: 各组按key的str值排序，组内保留原本的相对顺序
+        :param tmp_dir: 临时文件存放目录，默认使用系统临时目录，数据量大时建议放在数据所在的磁盘
+        :param run_bytes: 每个有序临时文件的大约字节数，即内存占用的上限
+        :param max_open_files: k路归并时最多同时打开的文件数，超过时会分多层归并
+        """
+        self.key = key
+        self.sort_mode = sort_mode
+        self.tmp_dir = tmp_dir
+        self.run_bytes = run_bytes
+        self.max_open_files = max_open_files
+
+    @staticmethod
+    def id_sortkey(v):
+        """ 把record['id']转成可以相互比较、且能json序列化的排序键
+
+        jsonl里的id可能int、str混用，甚至缺失，直接比较会报TypeError
+        """
+        if v is None:
+            return [2, '']
+        if isinstance(v, (int, float)):
+            return [0, v]
+        return [1, str(v)]
+
+    @staticmethod
+    def _write_run(items, tmp_dir):
+        """ 把已经有序的(sortkey, text)写成一个临时文件，text里不能有换行符 """
+        fd, run_file = tempfile.mkstemp(suffix='.txt', dir=tmp_dir)
+        with open(fd, 'w', encoding='utf8') as f:
+            for sortkey, text in items:
+                f.write(f'{json.dumps(sortkey, ensure_ascii=False)}\t{text}\n')
+        return run_file
+
+    def _write_runs(self, items, tmp_dir):
+        """ 每攒够run_bytes的数据，排序后写出一个有序临时文件
+
+        :return list: 各个有序临时文件的路径
+        """
+        runs, buffer, nbytes = [], [], 0
+        for sortkey, text in items:
+            buffer.append((sortkey, text))
+            nbytes += len(text)
+            if nbytes >= self.run_bytes:
+                buffer.sort(key=lambda x: x[0])
+                runs.append(self._write_run(buffer, tmp_dir))
+                buffer, nbytes = [], 0
+        if buffer:
+            buffer.sort(key=lambda x: x[0])
+            runs.append(self._write_run(buffer, tmp_dir))
+        return runs
+
+    @staticmethod
+    def _read_run(run_file):
+        with open(run_file, 'r', encoding='utf8') as f:
+            for line in f:
+                sortkey, text = line.rstrip('\n').split('\t', 1)
+                yield json.loads(sortkey), text
+
+    def _merge_runs(self, runs, tmp_dir):
+        """ k路归并，返回按sortkey有序的(sortkey, text)迭代器 """
+        # 文件太多时先分批归并成更大的有序文件，避免同时打开过多文件
+        while len(runs) > self.max_open_files:
+            new_runs = []
+            for batch in chunked(runs, self.max_open_files):
+                merged = heapq.merge(*[self._read_run(f) for f in batch], key=lambda x: x[0])
+                new_runs.append(self._write_run(merged, tmp_dir))
+                for f in batch:
+                    os.remove(f)
+            runs = new_runs
+        return heapq.merge(*[self._read_run(f) for f in runs], key=lambda x: x[0])
+
+    def _keyed_lines(self, lines):
+        seq = 0
+        for line in lines:
+            line = line.rstrip('\r\n')
+            if not line:
+                continue
+            try:
+                record = jsonl_loads(line)
+            except json.decoder.JSONDecodeError:
+                continue
+            k = str(self.key(record)) if self.key else str(seq)
+            order = self.id_sortkey(record.get('id')) if self.sort_mode == 'id' else seq
+            yield [k, order, seq], line
+            seq += 1
+
+    def group_lines(self, lines):
+        """ 对jsonl文本行分组
+
+        :param lines: 可迭代的jsonl文本行，比如打开的文件句柄，空行和非法json行会被跳过
+        :return: 生成器，每次返回一组数据的文本行list
+        """
+        with tempfile.TemporaryDirectory(dir=self.tmp_dir) as tmp_dir:
+            # 1 按(key, 组内顺序, 序号)外部排序，相同key的行会连续出现
+            merged = self._merge_runs(self._write_runs(self._keyed_lines(lines), tmp_dir), tmp_dir)
+
+            def iter_groups():
+                cur_key, first, group = None, None, []
+                for (k, order, seq), line in merged:
+                    if group and k != cur_key:
+                        yield first, group
+                        group = []
+                    if not group:
+                        cur_key, first = k, [order, seq]
+                    group.append(line)
+                if group:
+                    yield first, group
+
+            if self.sort_mode == 'sort':
+                for first, group in iter_groups():
+                    yield group
+                return
+
+            # 2 再按各组首条记录的位置，对组做一轮外部排序
+            groups = ((first, self.SEP.join(group)) for first, group in iter_groups())
+            for _, text in self._merge_runs(self._write_runs(groups, tmp_dir), tmp_dir):
+                yield text.split(self.SEP)
+
+    def group_records(self, lines):
+        """ 同group_lines，但返回的是解析后的records """
+        for group in self.group_lines(lines):
+            yield [jsonl_loads(line) for line in group]
+
+
 class JsonlDataDir:
     """ 注意这个类开发目标，应该是尽量去模拟JsonDataFile，让下游工作更好衔接统一 """
 
@@ -368,53 +619,22 @@ class JsonlDataDir:
         c = cls(dst_dir)
         return c
 
+    def _yield_lines(self):
+        for file in self.files:
+            with file.open('r', encoding='utf-8') as f:
+                yield from f
+
     def _rearrange_group(self, lines_per_file=10000,
                          group_key=None, sort_mode='keep',
                          print_mode=1):
-        # 1 使用sqlite3存储数据和分组信息
-        # 创建一个临时文件来作为SQLite数据库
-        temp_db_file = self.root / 'data.sqlite3'
-        temp_db_file.delete()
-
-        # 使用临时文件创建SQLite数据库连接
-        conn = sqlite3.connect(temp_db_file)
-        cursor = conn.cursor()
-
-        # 创建一个临时表来存储jsonl数据
-        cursor.execute('CREATE TABLE records (id INTEGER PRIMARY KEY AUTOINCREMENT,'
-                       'data TEXT, group_key TEXT)')
-        # 给group_key添加索引
-        cursor.execute('CREATE INDEX idx_group_key ON records(group_key)')
-
-        # 从jsonl文件加载数据到SQLite数据库
-        commit_interval = 2000  # 多少记录执行一次commit
-        count = 0
-        for record in tqdm(self.yield_record(), desc='计算每个record分组', disable=not print_mode):
-            count += 1
-            group = group_key(record) if group_key else count
-            group = str(group)
-            cursor.execute('INSERT INTO records (data, group_key) VALUES (?, ?)',
-                           (json.dumps(record, ensure_ascii=False), group))
-            if count % commit_interval == 0:
-                conn.commit()
-        conn.commit()
-
-        # 2 查询数据库以进行排序和分组，并将结果写入新的jsonl文件
+        # 1 外存分组，临时文件放在数据目录下，一般磁盘空间更有保障
+        grouper = JsonlExternalGrouper(group_key, sort_mode, tmp_dir=self.root)
+
+        # 2 按组依次写入新的jsonl文件，同一组的数据不会被拆到两个文件里
         new_file_count = 0
         lines_written = 0
         current_file = None
-        sort_sql = ''
-        if sort_mode == 'id':
-            sort_sql = 'ORDER BY id'
-        elif sort_mode == 'sort':
-            sort_sql = f'ORDER BY {group_key}'
-
-        for group, in tqdm(cursor.execute('SELECT DISTINCT group_key FROM records').fetchall(),
-                           desc='提取每一组数据',
-                           disable=not print_mode):
-            query = f'SELECT data FROM records WHERE group_key = ? {sort_sql}'
-            cursor.execute(query, (group,))
-
+        for group in tqdm(grouper.group_lines(self._yield_lines()), desc='提取每一组数据', disable=not print_mode):
             if current_file is None or lines_written >= lines_per_file:
                 if current_file:
                     current_file.close()
@@ -424,22 +644,13 @@ class JsonlDataDir:
                 new_file_count += 1
                 lines_written = 0
 
-            while True:
-                row = cursor.fetchone()
-                if row is None:
-                    break
-
-                current_file.write(row[0] + '\n')
-                lines_written += 1
+            current_file.write('\n'.join(group) + '\n')
+            lines_written += len(group)
 
         if current_file:
             current_file.close()
 
-        # 3 关闭数据库连接并删除临时文件
-        conn.close()
-        temp_db_file.delete()
-
-        # 4 删除旧文件，重命名新文件
+        # 3 删除旧文件，重命名新文件
         for f in self.files:
             f.delete()
 
@@ -447,6 +658,7 @@ class JsonlDataDir:
         for temp_file in self.root.glob('temp_*.jsonl'):
             n = int(re.search(r'\d+', temp_file.name).group())
             temp_file.rename(self.root / f'_{n:0{widths}}.jsonl')
+        self.update_subfiles()
 
     def rearrange(self, lines_per_file=10000, group_key=None,
                   sort_mode='keep', print_mode=1):
@@ -521,18 +733,33 @@ class JsonlDataDir:
                 else:
                     yield batch
 
-    def yield_group(self, key, sort_mode='keep'):
+    def yield_group(self, key, sort_mode='keep', *, global_group=False):
         """ 分组提取数据
 
         :param key: 一个函数，对record的映射，通过这个映射规则来分组
-
-        注意：这个分组只会对每个分文件单独执行，不会全局性质检索
-            一般要用self.rearrange对全局的文件进行检索重排后再使用这个函数
+        :param global_group: 是否跨文件全局分组
+            False（默认），这个分组只会对每个分文件单独执行，不会全局性质检索
+                一般要用self.rearrange对全局的文件进行检索重排后再使用这个函数
+            True，使用JsonlExternalGrouper外存分组，数据总量超过内存也能运行，
+                此时key的返回值会转成str来比较，sort_mode规则详见JsonlExternalGrouper
         """
+        if global_group:
+            yield from JsonlExternalGrouper(key, sort_mode, tmp_dir=self.root).group_records(self._yield_lines())
+            return
+
         for filepath in self.files:
             jdf = JsonlDataFile(filepath)
             yield from jdf.yield_group(key, sort_mode)
 
+    def _select_files(self, subfiles=None):
+        """ subfiles规则详见process_each_record """
+        if subfiles is None:
+            subfiles = [0, len(self.files)]
+        elif not isinstance(subfiles, (list, tuple)):
+            subfiles = [subfiles, subfiles + 1]
+        a, b = subfiles
+        return self.files[a:b]
+
     def process_each_file(self, func=None, *,
                           print_mode=0, desc='process_each_file',
                           processes_num=1,
@@ -542,12 +769,7 @@ class JsonlDataDir:
         backend = 'loky' if processes_num != 1 else 'sequential'
 
         # 2 tasks
-        if subfiles is None:
-            subfiles = [0, len(self.files)]
-        elif not isinstance(subfiles, (list, tuple)):
-            subfiles = [subfiles, subfiles + 1]
-        a, b = subfiles
-        tasks = [delayed(func)(file) for file in self.files[a:b]]
+        tasks = [delayed(func)(file) for file in self._select_files(subfiles)]
 
         # 3 run
         if print_mode:
@@ -563,7 +785,8 @@ class JsonlDataDir:
                             timeout=None,
                             processes_num=1, threads_num=1,
                             dst_dir=None, json_encoder=None,
-                            subfiles=None):
+                            subfiles=None,
+                            chunk_size=None, error_mode='raise'):
         """ 封装的对每个record进行操作的函数
 
         :param func: 外部传入的处理函数
@@ -583,7 +806,20 @@ class JsonlDataDir:
         :param subfiles: 只跑部分子文件
             a，只有文件编号为a的才运行
             [a, b]，跑左闭右开的区间内的文件
+        :param chunk_size: 默认None，每个文件为单独一个进程
+            设置后改为记录分块模式：所有文件共用一个进程池，每个文件的记录按chunk_size分块提交，
+            结果按原顺序流式写入目标文件，内存占用跟文件大小无关，适合cpu密集的func。
+            此时print_mode=2显示的是全部记录的处理进度，threads_num、timeout参数无效
+        :param error_mode: 记录分块模式下，func报错时的处理方式，详见RecordsChunkProcessor
         """
+        if chunk_size:
+            return self._process_each_record_chunks(func, inplace=inplace, reset=reset,
+                                                    print_mode=print_mode, desc=desc,
+                                                    processes_num=processes_num,
+                                                    dst_dir=dst_dir, json_encoder=json_encoder,
+                                                    subfiles=subfiles,
+                                                    chunk_size=chunk_size, error_mode=error_mode)
+
         files_num = len(self.files)
 
         def process_jsonl_file(srcfile):
@@ -620,6 +856,59 @@ class JsonlDataDir:
                                processes_num=processes_num,
                                print_mode=print_mode == 1, desc=desc)
 
+    def _process_each_record_chunks(self, func, *,
+                                    inplace=False, reset=False,
+                                    print_mode=2, desc=None,
+                                    processes_num=-1,
+                                    dst_dir=None, json_encoder=None,
+                                    subfiles=None,
+                                    chunk_size=1000, error_mode='raise'):
+        """ process_each_record的记录分块模式
+
+        :return RecordsChunkProcessor: 可以从其errors属性查看error_mode='skip'时跳过的报错
+        """
+        engine = RecordsChunkProcessor(func, processes_num, chunk_size, error_mode)
+        files = self._select_files(subfiles)
+        if print_mode == 2:
+            total = sum(f.get_total_lines(skip_blank=True) for f in files)
+        else:
+            total = len(files)
+        pbar = tqdm(total=total, desc=desc, disable=not print_mode)
+
+        for srcfile in files:
+            dstfile = XlPath(dst_dir) / srcfile.name if dst_dir else None
+            if not reset and dstfile and dstfile.is_file():
+                if print_mode == 2:
+                    pbar.update(srcfile.get_total_lines(skip_blank=True))
+                continue
+
+            # 都先写到临时文件，处理完再替换：原地修改时避免读写同一个文件，
+            # 中途出错时也不会留下半成品的dstfile，被下次运行误当成已处理完的结果跳过
+            targets = ([dstfile] if dstfile else []) + ([srcfile] if inplace else [])
+            outfiles = [f.with_name(f.name + '.tmp') for f in targets]
+            writers = [StreamJsonlWriter(f, chunk_size, delete_origin_file=True, json_default=json_encoder)
+                       for f in outfiles]
+
+            for y in engine.imap(srcfile.read_jsonl(batch_size=chunk_size)):
+                if y:
+                    for w in writers:
+                        w.append_line(y)
+                if print_mode == 2:
+                    pbar.update(1)
+
+            for w in writers:
+                w.flush()
+                if not w.total_lines:  # 结果为空时也要有个空文件，标记已处理过
+                    w.file_path.parent.mkdir(parents=True, exist_ok=True)
+                    w.file_path.write_text('')
+            for tmpfile, f in zip(outfiles, targets):
+                os.replace(tmpfile, f)
+            if print_mode == 1:
+                pbar.update(1)
+
+        pbar.close()
+        return engine
+
     def process_each_group(self, func, group_key, sort_mode='keep', *,
                            inplace=False, reset=False,
                            print_mode=1, desc=None,
@@ -277,7 +277,8 @@ class Dir(PathBase):
         for x in subs:
             yield self._path / x
 
-    def procpaths(self, func, start=None, end=None, ref_dir=None, pinterval=None, max_workers=1, interrupt=True):
+    def procpaths(self, func, start=None, end=None, ref_dir=None, pinterval=None, max_workers=1, interrupt=True,
+                  *, backend='thread'):
         """ 对选中的文件迭代处理
 
         :param func: 对每个文件进行处理的自定义接口函数
@@ -286,6 +287,7 @@ class Dir(PathBase):
                 TODO 以后可以返回字典结构，用不同的key表示不同的功能，可以控制些高级功能
         :param ref_dir: 使用该参数时，则每次会给func传递两个路径参数
             第一个是原始的file，第二个是ref_dir目录下对应路径的file
+        :param backend: 并发后端，thread、process、asyncio，见Iterate.run
 
         TODO 增设可以bfs还是dfs的功能？
 
@@ -303,7 +305,7 @@ class Dir(PathBase):
         if ref_dir:
             ref_dir = Dir(ref_dir)
             paths1 = self.subpaths()
-            paths2 = [(ref_dir / self.subs[i]) for i in range(len(self.subs))]
+            paths2 = ((ref_dir / sub) for sub in self.subs)
 
             def wrap_func(data):
                 func(*data)
@@ -314,8 +316,8 @@ class Dir(PathBase):
             data = self.subpaths()
             wrap_func = func
 
-        Iterate(data).run(wrap_func, start=start, end=end, pinterval=pinterval,
-                          max_workers=max_workers, interrupt=interrupt)
+        Iterate(data, total=len(self.subs)).run(wrap_func, start=start, end=end, pinterval=pinterval,
+                                                max_workers=max_workers, interrupt=interrupt, backend=backend)
 
     def select_invert(self, patter='**/*', nsort=True, **kwargs):
         """ 反选，在"全集"中，选中当前状态下没有被选中的那些文件
@@ -6,6 +6,7 @@
 
 
 from typing import Callable, Any
+import hashlib
 import io
 import json
 import os
@@ -13,13 +14,18 @@ import pathlib
 import pickle
 import re
 import shutil
+import sqlite3
 import subprocess
 import tempfile
 import ujson
-from collections import defaultdict, Counter
+from array import array
+from bisect import bisect_right
+from collections import defaultdict, Counter, deque
+import concurrent.futures
 import math
 from itertools import islice
 import datetime
+import struct
 
 import charset_normalizer
 import qiniu
@@ -35,6 +41,11 @@ from pyxllib.prog.pupil import is_url, is_file, DictTool
 from pyxllib.algo.pupil import Groups
 from pyxllib.file.pupil import struct_unpack, gen_file_filter
 
+try:  # 有orjson时，jsonl的解析会快很多
+    import orjson
+except ModuleNotFoundError:
+    orjson = None
+
 
 def __1_judge():
     pass
@@ -66,7 +77,12 @@ class GetEtag:
         return qiniu.utils.etag_stream(io.BytesIO(_bytes))
 
     @classmethod
-    def from_file(cls, file):
+    def from_file(cls, file, use_cache=False):
+        """
+        :param use_cache: 使用FileHashCache缓存，文件没有变化时不用重新读取计算
+        """
+        if use_cache:
+            return FileHashCache().get_hashes([file])[0]
         return qiniu.etag(file)
 
     @classmethod
@@ -96,6 +112,285 @@ def get_etag(arg):
         raise TypeError('不识别的数据类型')
 
 
+class FileHashCache:
+    """ 文件内容hash值的持久化缓存
+
+    以文件路径+(inode, size, mtime)为键，存储在sqlite文件里，文件没变化的时候不需要重新读文件计算hash。
+    查找重复文件时，先按文件大小分组，再比较头尾部分内容的hash，最后才对仍然可能重复的文件计算完整etag。
+
+    >> cache = FileHashCache()
+    >> cache.get_hashes(files)  # 每个文件的etag
+    >> cache.find_duplicates(files)  # {etag: [file1, file2, ...], ...}
+    """
+    PARTIAL_BYTES = 64 * 1024
+
+    def __init__(self, db_file=None):
+        """
+        :param db_file: 缓存数据库文件，默认存储在临时目录下
+        """
+        if db_file is None:
+            db_file = XlPath.tempdir() / 'pyxllib_filehash.sqlite3'
+        self.db_file = XlPath(db_file)
+        self.conn = sqlite3.connect(str(self.db_file), timeout=60)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS file_hash (path TEXT, algo TEXT, '
+                          'inode INTEGER, size INTEGER, mtime_ns INTEGER, value TEXT, '
+                          'PRIMARY KEY (path, algo))')
+        self.conn.commit()
+
+    @classmethod
+    def partial_hash(cls, file):
+        """ 文件头尾各64KB内容的hash，用于快速排除内容不同的文件 """
+        h = hashlib.blake2b(digest_size=16)
+        with open(file, 'rb') as f:
+            h.update(f.read(cls.PARTIAL_BYTES))
+            size = f.seek(0, 2)
+            if size > cls.PARTIAL_BYTES:
+                f.seek(max(size - cls.PARTIAL_BYTES, cls.PARTIAL_BYTES))
+                h.update(f.read())
+        return h.hexdigest()
+
+    HASH_FUNCS = {'etag': lambda f: qiniu.etag(f),
+                  'partial': lambda f: FileHashCache.partial_hash(f)}
+
+    def get_hashes(self, files, algo='etag', *, threads_num=8, print_mode=False):
+        """ 计算一组文件的hash值，优先使用缓存
+
+        :param files: 文件清单
+        :param str algo: 'etag'（七牛etag） 或 'partial'（头尾部分内容hash）
+        :param int threads_num: 未命中缓存的文件，使用多线程读取计算
+        :return list: 跟files一一对应的hash值
+        """
+        paths = [os.path.abspath(f) for f in files]
+        stats = [os.stat(p) for p in paths]
+        keys = [(st.st_ino, st.st_size, st.st_mtime_ns) for st in stats]
+
+        # 1 查缓存
+        values = [None] * len(paths)
+        path2idx = defaultdict(list)
+        for i, p in enumerate(paths):
+            path2idx[p].append(i)
+        for batch in chunked(path2idx.keys(), 500):
+            sql = (f'SELECT path, inode, size, mtime_ns, value FROM file_hash '
+                   f'WHERE algo=? AND path IN ({",".join("?" * len(batch))})')
+            for p, *key, value in self.conn.execute(sql, [algo, *batch]):
+                for i in path2idx[p]:
+                    if tuple(key) == keys[i]:
+                        values[i] = value
+
+        # 2 未命中的用多线程计算，并写回缓存
+        misses = [i for i, v in enumerate(values) if v is None]
+        if misses:
+            func = self.HASH_FUNCS[algo]
+            with concurrent.futures.ThreadPoolExecutor(threads_num) as executor:
+                results = executor.map(func, [paths[i] for i in misses])
+                for i, v in zip(misses, tqdm(results, total=len(misses), desc=f'get {algo}',
+                                             disable=not print_mode)):
+                    values[i] = v
+            self.conn.executemany('INSERT OR REPLACE INTO file_hash VALUES (?, ?, ?, ?, ?, ?)',
+                                  [(paths[i], algo, *keys[i], values[i]) for i in misses])
+            self.conn.commit()
+
+        return values
+
+    def find_duplicates(self, files, *, threads_num=8, print_mode=False):
+        """ 查找内容相同的文件
+
+        :return dict: {etag: [file1, file2, ...], ...}，只返回有重复的组，组内保留输入的顺序
+        """
+
+        def regroup(groups, algo):
+            cands = [f for fs in groups if len(fs) > 1 for f in fs]
+            res = defaultdict(list)
+            for f, v in zip(cands, self.get_hashes(cands, algo, threads_num=threads_num, print_mode=print_mode)):
+                res[v].append(f)
+            return res
+
+        # 1 大小不同的文件肯定不重复
+        size2files = defaultdict(list)
+        for f in files:
+            size2files[os.path.getsize(f)].append(f)
+
+        # 2 头尾部分内容不同的也不重复
+        partial2files = regroup(size2files.values(), 'partial')
+
+        # 3 剩下的才计算完整的etag
+        etag2files = regroup(partial2files.values(), 'etag')
+        return {k: vs for k, vs in etag2files.items() if len(vs) > 1}
+
+    def clear_missing(self):
+        """ 删除已经不存在的文件的缓存记录 """
+        paths = [p for p, in self.conn.execute('SELECT DISTINCT path FROM file_hash') if not os.path.isfile(p)]
+        self.conn.executemany('DELETE FROM file_hash WHERE path=?', [(p,) for p in paths])
+        self.conn.commit()
+        return len(paths)
+
+
+class DirManifest:
+    """ 目录的文件清单：每个文件的 (相对路径, 大小, 修改时间, etag)
+
+    FileHashCache是按单个文件缓存hash，这里则是以整个目录为单位持久化，能跟上一次的清单比较出增删改、重命名的情况。
+    再次扫描时，大小、修改时间都没变的文件直接沿用记录的etag，没有变化的大目录只需要stat一遍。
+
+    >> m = DirManifest('data/images')
+    >> diff = m.scan()  # 跟上次保存的清单比较，并保存新的清单
+    >> diff['added'], diff['removed'], diff['changed'], diff['renamed']
+    >> m.entries  # {相对路径: (size, mtime_ns, etag)}
+    """
+
+    def __init__(self, root, name='default', db_file=None):
+        """
+        :param root: 目录
+        :param name: 同一个目录，不同用途（比如同步到不同的远程位置）需要各自记录上一次的状态，用name区分
+        :param db_file: 清单的sqlite文件，默认存储在临时目录下
+        """
+        self.root = XlPath(root)
+        if db_file is None:
+            key = hashlib.md5(f'{os.path.abspath(root)}|{name}'.encode('utf8')).hexdigest()[:16]
+            db_file = XlPath.tempdir() / 'pyxllib_manifest' / f'{key}.sqlite3'
+        self.db_file = XlPath(db_file)
+        self.db_file.parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(str(self.db_file), timeout=60)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS manifest (relpath TEXT PRIMARY KEY, '
+                          'size INTEGER, mtime_ns INTEGER, etag TEXT)')
+        self.conn.commit()
+        self._saved = {p: tuple(x) for p, *x in self.conn.execute('SELECT * FROM manifest')}
+        self.entries = dict(self._saved)
+
+    def stat_files(self):
+        """ 只stat不读内容，获得目录下所有文件的 {相对路径: (size, mtime_ns)} """
+        res = {}
+        db_files = {os.path.abspath(self.db_file) + x for x in ('', '-wal', '-shm', '-journal')}
+        dirs = [('', os.fspath(self.root))]
+        while dirs:
+            rel, path = dirs.pop()
+            with os.scandir(path) as it:
+                for entry in it:
+                    relpath = f'{rel}/{entry.name}' if rel else entry.name
+                    if entry.is_dir(follow_symlinks=False):
+                        dirs.append((relpath, entry.path))
+                    elif entry.is_file() and os.path.abspath(entry.path) not in db_files:
+                        st = entry.stat()
+                        res[relpath] = (st.st_size, st.st_mtime_ns)
+        return res
+
+    def scan(self, *, save=True, threads_num=8, print_mode=False):
+        """ 重新扫描目录，只对新增、大小或修改时间有变化的文件计算etag
+
+        :param save: 是否把扫描结果保存为新的清单
+            比如同步场景，可以等同步成功后再调用save，失败时下次扫描仍能得到这次的变化
+        :return dict: 跟上一次保存的清单的差异，格式见diff
+        """
+        old = self._saved
+        new, todo = {}, []
+        for p, (size, mtime_ns) in self.stat_files().items():
+            x = old.get(p)
+            if x and x[0] == size and x[1] == mtime_ns:
+                new[p] = x
+            else:
+                todo.append(p)
+                new[p] = (size, mtime_ns, None)
+
+        if todo:
+            with concurrent.futures.ThreadPoolExecutor(threads_num) as executor:
+                etags = executor.map(qiniu.etag, [os.fspath(self.root / p) for p in todo])
+                for p, etag in zip(todo, tqdm(etags, total=len(todo), desc='get etag', disable=not print_mode)):
+                    new[p] = (*new[p][:2], etag)
+
+        self.entries = new
+        if save:
+            self.save()
+        return self.diff(old, new)
+
+    def update_files(self, files, *, threads_num=8, print_mode=False):
+        """ 只刷新指定文件的记录并保存，不扫描整个目录
+
+        适合只关心目录里一小部分文件的场景，大小、修改时间没变的文件同样沿用记录的etag
+
+        :param files: 目录下的文件路径，不在目录下的文件会被忽略
+        """
+        root = os.path.abspath(self.root)
+        todo = []
+        for f in files:
+            try:
+                relpath = os.path.relpath(os.path.abspath(f), root).replace(os.sep, '/')
+            except ValueError:  # windows下不同盘符的路径
+                continue
+            if relpath == '..' or relpath.startswith('../'):
+                continue
+            st = os.stat(f)
+            x = self.entries.get(relpath)
+            if not (x and x[0] == st.st_size and x[1] == st.st_mtime_ns):
+                todo.append(relpath)
+                self.entries[relpath] = (st.st_size, st.st_mtime_ns, None)
+
+        if todo:
+            with concurrent.futures.ThreadPoolExecutor(threads_num) as executor:
+                etags = executor.map(qiniu.etag, [os.fspath(self.root / p) for p in todo])
+                for p, etag in zip(todo, tqdm(etags, total=len(todo), desc='get etag', disable=not print_mode)):
+                    self.entries[p] = (*self.entries[p][:2], etag)
+        self.save()
+
+    def save(self):
+        """ 把当前的entries保存为清单，只写入有变化的记录 """
+        removed = [(p,) for p in self._saved if p not in self.entries]
+        upserts = [(p, *x) for p, x in self.entries.items() if self._saved.get(p) != x]
+        self.conn.executemany('DELETE FROM manifest WHERE relpath=?', removed)
+        self.conn.executemany('INSERT OR REPLACE INTO manifest VALUES (?, ?, ?, ?)', upserts)
+        self.conn.commit()
+        self._saved = dict(self.entries)
+
+    @classmethod
+    def diff(cls, old, new):
+        """ 比较两份清单
+
+        :param dict old: {相对路径: (size, mtime_ns, etag)}，也可以是两个不同目录的清单
+        :param dict new: 同上
+        :return dict:
+            added: 新增的文件
+            removed: 删除的文件
+            changed: 路径相同，但etag不同的文件（只是修改时间变化，内容没变的不算）
+            renamed: [(旧路径, 新路径), ...]，删除的文件和新增的文件etag一样时，认为是重命名，不再计入added、removed
+        """
+        added = [p for p in new if p not in old]
+        removed = [p for p in old if p not in new]
+        changed = [p for p in new if p in old and new[p][2] != old[p][2]]
+
+        etag2removed = defaultdict(deque)
+        for p in removed:
+            etag2removed[old[p][2]].append(p)
+        renamed = []
+        for p in added:
+            olds = etag2removed.get(new[p][2])
+            if olds:
+                renamed.append((olds.popleft(), p))
+        if renamed:
+            src, dst = {a for a, _ in renamed}, {b for _, b in renamed}
+            added = [p for p in added if p not in dst]
+            removed = [p for p in removed if p not in src]
+
+        return {'added': added, 'removed': removed, 'changed': changed, 'renamed': renamed}
+
+    @classmethod
+    def touched_files(cls, diff):
+        """ diff里内容有更新、需要处理的文件：新增、修改、重命名后的新路径 """
+        return diff['added'] + diff['changed'] + [b for _, b in diff['renamed']]
+
+    def get_etags(self, files):
+        """ 从当前清单里获得一组文件的etag，不在清单里的文件是None """
+        root = os.path.abspath(self.root)
+        res = []
+        for f in files:
+            try:
+                relpath = os.path.relpath(os.path.abspath(f), root).replace(os.sep, '/')
+            except ValueError:  # windows下不同盘符的路径
+                relpath = None
+            x = self.entries.get(relpath)
+            res.append(x[2] if x else None)
+        return res
+
+
 def is_etag(s):
     """ 字母、数字和-、_共64种字符构成的长度28的字符串 """
     return re.match(r'[a-zA-Z0-9\-_]{28}$', s)
@@ -794,6 +1089,66 @@ class File(PathBase):
         return self._path.exists()
 
 
+def jsonl_loads(line):
+    """ 解析jsonl的一行数据，优先使用orjson/ujson，解析失败时再用标准库json兜底
+
+    兜底是为了保持跟json.loads一致的兼容性，比如NaN等orjson不支持的写法
+    注意orjson会把超过64位的整数解析成float，有这类数据的话要卸载orjson或直接用json.loads
+    """
+    try:
+        return orjson.loads(line) if orjson else ujson.loads(line)
+    except ValueError:
+        return json.loads(line)
+
+
+def split_file_byte_ranges(file, chunk_size=32 * 1024 * 1024):
+    """ 将文件按约chunk_size字节切分成若干区间，每个区间的边界都对齐在换行符之后
+
+    切分只依赖b'\n'，适用于utf8、gbk等换行符不会出现在多字节字符中间的编码，不适用于utf16
+
+    :return list[tuple]: [(a, b), ...]，左闭右开的字节区间
+    """
+    size = os.path.getsize(file)
+    ranges = []
+    with open(file, 'rb') as f:
+        a = 0
+        while a < size:
+            b = a + chunk_size
+            if b < size:
+                f.seek(b)
+                f.readline()
+                b = f.tell()
+            else:
+                b = size
+            ranges.append((a, b))
+            a = b
+    return ranges
+
+
+def read_jsonl_range(file, a, b, encoding='utf8', errors='strict'):
+    """ 读取jsonl文件[a, b)字节区间内的数据，主要给多进程读取时的子进程使用 """
+    with open(file, 'rb') as f:
+        f.seek(a)
+        s = f.read(b - a).decode(encoding, errors=errors)
+
+    data = []
+    for line in s.split('\n'):
+        line = line.rstrip('\r')
+        if line:
+            try:  # 注意，这里可能会有数据读取失败
+                data.append(jsonl_loads(line))
+            except json.decoder.JSONDecodeError:
+                pass
+    return data
+
+
+def _get_workers_num(n):
+    """ 跟joblib的n_jobs规则一致，负数表示 cpu_count+1+n，比如-1表示使用全部cpu """
+    if n is None or n < 0:
+        n = (os.cpu_count() or 1) + 1 + (n or -1)
+    return max(n, 1)
+
+
 def make_filter():
     """ 从filesmatch """
 
@@ -965,14 +1320,46 @@ class XlPath(type(pathlib.Path())):
                 line_count += 1
         return line_count
 
-    def yield_line(self, start=0, end=None, step=1, batch_size=None, encoding='utf-8'):
+    def line_index(self, build=True):
+        """ 获取文件的行偏移量索引，详见 LineOffsetIndex
+
+        :param bool build: 索引不存在时是否新建，为False时没有现成索引会返回None
+        """
+        index = LineOffsetIndex(self)
+        if not build and not index.index_file.is_file():
+            return None
+        index.refresh()
+        return index
+
+    def yield_line(self, start=0, end=None, step=1, batch_size=None, encoding='utf-8', *, use_index=None):
         """ 返回指定区间的文件行
 
         :param int start: 起始行，默认为0
         :param int end: 结束行，默认为None（读取到文件末尾）
         :param int step: 步长，默认为1
         :param int batch_size: 每批返回的行数，如果为None，则逐行返回
-        """
+        :param use_index: 是否使用行偏移量索引，直接seek到start行
+            None（默认），已有旁路索引文件时才使用
+            True，没有索引时会先建立索引，适合对大文件反复随机读取的场景
+            False，不使用索引，从头逐行遍历
+        """
+        index = None if use_index is False else self.line_index(build=bool(use_index))
+        if index is not None:
+            iterator = index.iter_lines(start, end, step, encoding=encoding)
+        else:
+            iterator = self._iter_line_text(start, end, step, encoding)
+
+        while True:
+            batch = list(islice(iterator, batch_size))
+            if not batch:
+                break
+            if batch_size is None:
+                yield from batch
+            else:
+                yield batch
+
+    def _iter_line_text(self, start=0, end=None, step=1, encoding='utf-8'):
+        """ 不使用索引，从头遍历文件获得区间内的行 """
         total_lines = None  # 使用局部变量缓存总行数
         # 处理负索引
         if start < 0 or (end is not None and end < 0):
@@ -983,16 +1370,8 @@ class XlPath(type(pathlib.Path())):
                 end = total_lines + end
 
         with open(self, 'r', encoding=encoding) as file:
-            iterator = islice(file, start, end, step)
-            while True:
-                batch = list(islice(iterator, batch_size))
-                if not batch:
-                    break
-                batch = [line.rstrip('\n') for line in batch]  # 删除每行末尾的换行符
-                if batch_size is None:
-                    yield from batch
-                else:
-                    yield batch
+            for line in islice(file, start, end, step):
+                yield line.rstrip('\n')  # 删除每行末尾的换行符
 
     def split_to_dir(self, lines_per_file, dst_dir=None, encoding='utf-8',
                      filename_template="_{index}{suffix}"):
@@ -1197,7 +1576,7 @@ class XlPath(type(pathlib.Path())):
             json.dump(data, f, **kwargs)
 
     def read_jsonl(self, encoding='utf8', max_items=None, *,
-                   errors='strict', return_mode=0, batch_size=None):
+                   errors='strict', return_mode=0, batch_size=None, processes_num=1):
         """ 从文件中读取JSONL格式的数据
 
         :param str encoding: 文件编码格式，默认为utf8
@@ -1210,11 +1589,33 @@ class XlPath(type(pathlib.Path())):
             默认为None，表示一次性读取所有数据
             如果设置了数值，则会流式读取，常用于太大，超过内存大小等的jsonl文件读取
                 注意如果设置了大小，只是底层每次一批读取的大小，但返回的data仍然是一维的数据格式迭代器
+        :param int processes_num: 解析json的进程数，默认为1，-1表示使用全部cpu
+            多进程时会把文件按换行符边界切成若干字节区间，分给子进程解析，结果仍按原文件顺序返回
+            需要明确指定encoding，且不支持utf16这类换行符会出现在多字节字符里的编码
         :return: 返回读取到的数据列表，如果return_mode为True，则同时返回文件编码格式
 
         >> read_jsonl('data.jsonl', max_items=10)  # 读取前10条数据
+        >> read_jsonl('data.jsonl', processes_num=8)  # 8进程解析大文件
         """
-        if batch_size is None:
+        if batch_size is None and max_items is not None and encoding and errors == 'strict':
+            # 只需要前若干条数据时，流式读取文件开头部分即可，不用载入全文
+            data = []
+            if max_items > 0:
+                for line in self.yield_line(encoding=encoding):
+                    if line:
+                        try:
+                            data.append(jsonl_loads(line))
+                        except json.decoder.JSONDecodeError:
+                            pass
+                    if len(data) >= max_items:
+                        break
+        elif processes_num != 1 and encoding and max_items is None:
+            chunks = self.yield_jsonl_chunks(encoding, errors, processes_num=processes_num)
+            if batch_size is None:
+                data = [x for chunk in chunks for x in chunk]
+            else:
+                data = (x for chunk in chunks for x in chunk)
+        elif batch_size is None:
             s, encoding = self.read_text(encoding=encoding, errors=errors, return_mode=True)
 
             data = []
@@ -1222,7 +1623,7 @@ class XlPath(type(pathlib.Path())):
             for line in s.split('\n'):
                 if line:
                     try:  # 注意，这里可能会有数据读取失败
-                        data.append(json.loads(line))
+                        data.append(jsonl_loads(line))
                     except json.decoder.JSONDecodeError:
                         pass
                 # 如果达到了限制的条目数，就停止读取
@@ -1233,7 +1634,7 @@ class XlPath(type(pathlib.Path())):
                 for batch in self.yield_line(batch_size=batch_size, encoding=encoding):
                     for line in batch:
                         try:  # 注意，这里可能会有数据读取失败
-                            yield json.loads(line)
+                            yield jsonl_loads(line)
                         except json.decoder.JSONDecodeError:
                             pass
 
@@ -1244,10 +1645,41 @@ class XlPath(type(pathlib.Path())):
         else:
             return data
 
-    def write_jsonl(self, list_data, ensure_ascii=False, default=None, mode='w', errors=None):
-        """ 由于这种格式主要是跟商汤这边对接，就尽量跟它们的格式进行兼容 """
-        content = '\n'.join([json.dumps(x, ensure_ascii=ensure_ascii, default=default) for x in list_data])
-        self.write_text_unix(content + '\n', mode=mode, errors=errors)
+    def yield_jsonl_chunks(self, encoding='utf8', errors='strict', *,
+                           processes_num=-1, chunk_size=32 * 1024 * 1024):
+        """ 按字节区间分块并行解析jsonl，按原文件顺序逐块返回解析后的数据列表
+
+        同时在跑的区间数会限制在进程数的2倍以内，所以即使是几十G的文件，内存占用也是有上限的
+
+        :param int processes_num: 进程数，默认-1使用全部cpu
+        :param int chunk_size: 每块的大约字节数
+        """
+        ranges = split_file_byte_ranges(self, chunk_size)
+        processes_num = _get_workers_num(processes_num)
+        if processes_num == 1 or len(ranges) < 2:
+            for a, b in ranges:
+                yield read_jsonl_range(self, a, b, encoding, errors)
+            return
+
+        with concurrent.futures.ProcessPoolExecutor(processes_num) as executor:
+            futures = deque()
+            for a, b in ranges:
+                futures.append(executor.submit(read_jsonl_range, str(self), a, b, encoding, errors))
+                if len(futures) >= processes_num * 2:
+                    yield futures.popleft().result()
+            while futures:
+                yield futures.popleft().result()
+
+    def write_jsonl(self, list_data, ensure_ascii=False, default=None, mode='w', errors=None, *,
+                    batch_size=2000):
+        """ 由于这种格式主要是跟商汤这边对接，就尽量跟它们的格式进行兼容
+
+        :param list_data: 要写入的数据，也可以是生成器
+        :param int batch_size: 每攒够这么多条就序列化写入一次，不会在内存中拼接出整个文件的文本
+        """
+        with open(self, mode, encoding='utf8', errors=errors, newline='\n') as f:
+            for batch in chunked(list_data, batch_size):
+                f.write('\n'.join([json.dumps(x, ensure_ascii=ensure_ascii, default=default) for x in batch]) + '\n')
 
     def add_json_line(self, data, ensure_ascii=False, default=None, mode='a'):
         """ 在文件末尾添加一行JSON数据 """
@@ -1579,30 +2011,38 @@ class XlPath(type(pathlib.Path())):
         """ 检查目录里的各种文件情况 """
 
     def glob_repeat_files(self, pattern='*', *, sort_mode='count', print_mode=False,
-                          files=None, hash_func=None):
+                          files=None, hash_func=None, threads_num=8, use_manifest=False):
         """ 返回重复的文件组
 
         :param files: 直接指定候选文件清单，此时pattern默认失效
         :param hash_func: hash规则，默认使用etag规则
+        :param threads_num: 默认etag规则下，读取文件计算hash的线程数
+        :param use_manifest: 默认etag规则下，使用DirManifest记录整个目录的etag
+            只有新增、修改过的文件才需要计算etag，适合反复检查的大目录
         :param sort_mode:
             count: 按照重复的文件数量从多到少排序
             size: 按照空间总占用量从大到小排序
         :return: [(etag, files, per_file_size), ...]
         """
-        # 0 文件清单和hash方法
+        # 0 文件清单
         if files is None:
             files = list(self.glob_files(pattern))
 
-        if hash_func is None:
-            def hash_func(f):
-                return get_etag(str(f))
-
         # 1 获取所有etag，这一步比较费时
-        hash2files = defaultdict(list)
-
-        for f in tqdm(files, desc='get etags', disable=not print_mode):
-            etag = hash_func(f)
-            hash2files[etag].append(f)
+        if hash_func is None and use_manifest:
+            manifest = DirManifest(self)
+            manifest.scan(threads_num=threads_num, print_mode=print_mode)
+            hash2files = defaultdict(list)
+            for f, etag in zip(files, manifest.get_etags(files)):
+                hash2files[etag or get_etag(str(f))].append(f)
+        elif hash_func is None:
+            # 默认的etag规则，使用FileHashCache按大小、头尾内容逐层筛选，且有持久化缓存
+            hash2files = FileHashCache().find_duplicates(files, threads_num=threads_num, print_mode=print_mode)
+        else:
+            hash2files = defaultdict(list)
+            for f in tqdm(files, desc='get etags', disable=not print_mode):
+                etag = hash_func(f)
+                hash2files[etag].append(f)
 
         # 2 转格式，排序
         hash2files = [(k, vs, vs[0].size()) for k, vs in hash2files.items() if len(vs) > 1]
@@ -1825,7 +2265,7 @@ class XlPath(type(pathlib.Path())):
         """ 对文件夹情况进行通用的状态检查
 
         :param hash_func: 可以传入自定义的hash函数，用于第四块的重复文件运算
-            其实默认的get_etag就没啥问题，只是有时候为了性能考虑，可能会传入一个支持，提前有缓存知道etag的函数
+            其实默认的get_etag就没啥问题，且默认规则会使用FileHashCache，目录文件没变化时重复检查不用重新读文件
         :param int run_mode: 只运行编号内的功能
         """
         if not self.is_dir():
@@ -2135,6 +2575,150 @@ class XlPath(type(pathlib.Path())):
         return file
 
 
+class LineOffsetIndex:
+    """ 文本文件的行偏移量索引，主要用于超大jsonl文件的随机访问
+
+    索引存储在同目录下的旁路文件 "文件名.lineidx" 中，记录每一行起始位置的字节偏移量，
+    有了这个就可以直接seek到第n行，不用每次都从头遍历整个文件。
+
+    索引文件里同时记录了建索引时原文件的size、mtime，以此判断索引是否失效：
+        1、文件变小，或size不变但mtime变了，视为文件被改写，重建索引
+        2、文件变大，视为在末尾追加了内容（StreamJsonlWriter、add_json_line等的常见用法），只增量扫描新增部分
+    注意这套机制假设文件是只追加写入的，如果原地修改了中间内容同时又变大了，需要手动调用rebuild
+    """
+    MAGIC = b'XLLIDX01'
+    HEADER = struct.Struct('<8sQqQQ')  # magic, size, mtime_ns, 偏移量数, 空行数
+    SUFFIX = '.lineidx'
+    CHUNK_SIZE = 16 * 1024 * 1024
+
+    def __init__(self, file):
+        self.file = XlPath(file)
+        self.index_file = self.file.with_name(self.file.name + self.SUFFIX)
+        self.size = 0
+        self.mtime_ns = 0
+        # 每行的起始位置，末尾多存一个已索引到的文件结束位置，所以行数是len(offsets)-1
+        self.offsets = array('Q', [0])
+        self.blanks = array('Q')  # 空行（只有换行符）的行号，jsonl按记录访问时需要跳过
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def num_records(self):
+        """ 非空行的数量 """
+        return len(self) - len(self.blanks)
+
+    def load(self):
+        """ 读取旁路索引文件，成功返回True """
+        try:
+            with open(self.index_file, 'rb') as f:
+                magic, size, mtime_ns, n, m = self.HEADER.unpack(f.read(self.HEADER.size))
+                if magic != self.MAGIC:
+                    return False
+                offsets, blanks = array('Q'), array('Q')
+                offsets.fromfile(f, n)
+                blanks.fromfile(f, m)
+        except (OSError, EOFError, struct.error):
+            return False
+
+        self.size, self.mtime_ns, self.offsets, self.blanks = size, mtime_ns, offsets, blanks
+        return True
+
+    def save(self):
+        """ 写入旁路索引文件，目录没有写权限等情况下只在内存里使用索引 """
+        tmp_file = self.index_file.with_name(self.index_file.name + '.tmp')
+        try:
+            with open(tmp_file, 'wb') as f:
+                f.write(self.HEADER.pack(self.MAGIC, self.size, self.mtime_ns,
+                                         len(self.offsets), len(self.blanks)))
+                self.offsets.tofile(f)
+                self.blanks.tofile(f)
+            os.replace(tmp_file, self.index_file)
+        except OSError:
+            pass
+
+    def _scan(self, st):
+        """ 从最后一行的起始位置开始，扫描到文件末尾，追加新的行偏移量 """
+        offsets, blanks = self.offsets, self.blanks
+        with open(self.file, 'rb') as f:
+            pos = offsets[-1]
+            f.seek(pos)
+            prev_byte = b''  # 上一个chunk的最后一个字节，判断跨chunk的'\r\n'空行
+            while True:
+                chunk = f.read(self.CHUNK_SIZE)
+                if not chunk:
+                    break
+                i = chunk.find(b'\n')
+                while i != -1:
+                    line_len = pos + i - offsets[-1]
+                    if line_len == 0 or (line_len == 1 and (chunk[i - 1:i] if i else prev_byte) == b'\r'):
+                        blanks.append(len(offsets) - 1)
+                    offsets.append(pos + i + 1)
+                    i = chunk.find(b'\n', i + 1)
+                pos += len(chunk)
+                prev_byte = chunk[-1:]
+
+        if offsets[-1] != pos:  # 末尾没有换行符的最后一行
+            offsets.append(pos)
+        self.size, self.mtime_ns = pos, st.st_mtime_ns
+
+    def rebuild(self):
+        self.offsets, self.blanks = array('Q', [0]), array('Q')
+        self._scan(os.stat(self.file))
+        self.save()
+
+    def refresh(self):
+        """ 检查原文件是否有变化，按需增量更新或重建索引 """
+        st = os.stat(self.file)
+        if not self.size and not self.load():
+            return self.rebuild()
+
+        if st.st_size == self.size and st.st_mtime_ns == self.mtime_ns:
+            return
+        elif st.st_size > self.size:
+            # 原来最后一行如果没有换行符，追加的内容可能是接在这一行后面的，要从这一行开头重新扫描
+            if len(self.offsets) > 1:
+                with open(self.file, 'rb') as f:
+                    f.seek(self.size - 1)
+                    if f.read(1) != b'\n':
+                        self.offsets.pop()
+            self._scan(st)
+            self.save()
+        else:
+            self.rebuild()
+
+    def line_no(self, record_index):
+        """ 跳过空行后的第record_index条记录，对应的实际行号 """
+        n = self.num_records
+        if record_index < 0:
+            record_index += n
+        if not 0 <= record_index < n:
+            raise IndexError(f'记录索引越界：{record_index}，共{n}条')
+
+        k = 0
+        while True:
+            line_no = record_index + k
+            k2 = bisect_right(self.blanks, line_no)
+            if k2 == k:
+                return line_no
+            k = k2
+
+    def read_line(self, line_no, encoding='utf-8'):
+        with open(self.file, 'rb') as f:
+            f.seek(self.offsets[line_no])
+            return f.read(self.offsets[line_no + 1] - self.offsets[line_no]).decode(encoding).rstrip('\r\n')
+
+    def iter_lines(self, start=0, end=None, step=1, encoding='utf-8'):
+        """ 跟XlPath.yield_line相同的区间语义，但会直接seek到start行 """
+        start, end, step = slice(start, end, step).indices(len(self))
+        if start >= end:
+            return
+        with open(self.file, 'rb') as f:
+            f.seek(self.offsets[start])
+            for line in islice(f, 0, end - start, step):
+                yield line.decode(encoding).rstrip('\r\n')
+
+
 class StreamJsonlWriter:
     """ 流式存储，主要用于存储文本化、jsonl格式数据 """
 
@@ -2313,6 +2897,8 @@ class PathGroups(Groups):
 def cache_file(file, make_data_func: Callable[[], Any] = None, *,
                mode='read_first',
                cache_time=None,
+               hash_args=False,
+               max_bytes=None,
                **kwargs):
     """ 能将局部函数功能结果缓存进文件的功能
 
@@ -2327,22 +2913,59 @@ def cache_file(file, make_data_func: Callable[[], Any] = None, *,
         generate_first: 函数生成优先
     :param cache_time: 文件缓存时间，单位为秒，默认为None，表示始终使用缓存文件
         如果设置60，表示超过60秒后，需要重新优先从函数获得更新内容
+    :param hash_args: 作为装饰器时，是否按调用参数区分缓存文件
+        开启后实际文件名为 "stem-参数hash.suffix"，不同参数的调用结果不会互相覆盖
+    :param max_bytes: 开启hash_args时，同一个file模板下所有缓存文件的总大小上限，超出时删除最久没使用的文件
     :param kwargs: 可以传递read、write支持的扩展参数
     :return: 读取到的数据
+
+    多进程同时生成同一个缓存文件时，会使用XlFileLock保证写入的完整性
     """
     from datetime import datetime, timedelta
     from pyxllib.prog.pupil import format_exception
+    from pyxllib.prog.filelock import XlFileLock
+    from pyxllib.prog.cachetools import _lock_name
 
     def decorator(func):
+        def get_file(args2, kwargs2):
+            f = XlPath.init(file, XlPath.tempdir())
+            if hash_args:
+                from pyxllib.prog.cachetools import make_args_key
+                key = make_args_key(func, args2, kwargs2)[:16]
+                f = f.with_name(f'{f.stem}-{key}{f.suffix}')
+            return f
+
+        def write(f, data):
+            with XlFileLock(_lock_name(f.as_posix())):
+                f.write_auto(data, **kwargs)
+                if hash_args and max_bytes:
+                    evict(f)
+
+        def evict(f):
+            stem = f.stem.rsplit('-', 1)[0]
+            files = [(x.stat().st_atime, x.stat().st_size, x) for x in f.parent.glob(f'{stem}-*{f.suffix}')]
+            total = sum(x[1] for x in files)
+            for atime, size, x in sorted(files):
+                if total <= max_bytes:
+                    break
+                if x != f:
+                    x.delete()
+                    total -= size
+
+        def read(f):
+            if hash_args and max_bytes:  # 用atime记录最近使用时间，mtime还要用来判断cache_time
+                os.utime(f, (datetime.now().timestamp(), f.stat().st_mtime))
+            return f.read_auto(**kwargs)
+
         def wrapper(*args2, **kwargs2):
 
-            f = XlPath.init(file, XlPath.tempdir())
+            f = get_file(args2, kwargs2)
             f.parent.mkdir(exist_ok=True, parents=True)
 
             # 1 优先看是不是需要先从文件读取数据
             if mode == 'read_first' and f.is_file():
                 if cache_time is None:
-                    return f.read_auto(**kwargs)
+                    return read(f)
 
                 current_time = datetime.now()
                 last_modified = datetime.fromtimestamp(f.mtime())  # 获取文件的修改时间
@@ -2352,22 +2975,22 @@ def cache_file(file, make_data_func: Callable[[], Any] = None, *,
                     cache_time2 = cache_time
 
                 if cache_time is None or (current_time - last_modified <= cache_time2):
-                    return f.read_auto(**kwargs)
+                    return read(f)
 
             # 2 如果需要重新生成数据，且没有已存在的保底文件
             if not f.is_file():
                 data = func(*args2, **kwargs2)
-                f.write_auto(data, **kwargs)
+                write(f, data)
                 return data
 
             # 3 需要重新生成，但是有保底文件
             try:
                 data = func(*args2, **kwargs2)
-                f.write_auto(data, **kwargs)
+                write(f, data)
                 return data
             except Exception as e:
                 print(format_exception(e))
-                return f.read_auto(**kwargs)
+                return read(f)
 
         return wrapper
 
@@ -13,9 +13,11 @@ import time
 from collections import Counter, OrderedDict, defaultdict
 import csv
 import datetime
+import hashlib
 from itertools import islice
 import json
 import math
+import os
 from pathlib import Path
 import random
 import re
@@ -28,8 +30,13 @@ import openpyxl
 from openpyxl import Workbook
 from openpyxl.cell.cell import MergedCell
 from openpyxl.styles import Font, Alignment
-from openpyxl.utils.cell import get_column_letter, column_index_from_string
+from openpyxl.styles.numbers import BUILTIN_FORMATS, BUILTIN_FORMATS_MAX_SIZE
+from openpyxl.utils.cell import get_column_letter, column_index_from_string, range_boundaries
+from openpyxl.worksheet.cell_range import CellRange
 import openpyxl.worksheet.formula
+from openpyxl.worksheet._read_only import ReadOnlyWorksheet
+from openpyxl.worksheet._reader import WorkSheetParser
+import numpy as np
 import pandas as pd
 
 try:
@@ -221,6 +228,16 @@ def xlfmt2pyfmt_datetime(xl_fmt):
     return py_fmt
 
 
+def normalize_number_format(fmt):
+    """ 对openpyxl读到的数字格式做些细节修正 """
+    # openpyxl的机制，如果没有配置日期格式，读取到的是默认的'mm-dd-yy'，其实在中文场景，默认格式应该是后者
+    if fmt == 'mm-dd-yy':
+        return 'yyyy/m/d'  # 中文的默认日期格式
+    elif fmt == r'yyyy\-mm\-dd':  # 不知道为什么会有提取到这种\的情况，先暴力替换了
+        fmt = 'yyyy-mm-dd'
+    return fmt
+
+
 def xl_render_value(x, xl_fmt):
     """ 得到单元格简单渲染后的效果
     py里不可能对excel的所有格式进行全覆盖，只是对场景格式进行处理
@@ -347,8 +364,13 @@ def convert_xls_to_xlsx(xls_file):
     return wb
 
 
-def load_as_xlsx_file(file_path, keep_links=False, keep_vba=False):
-    """ 这个不能全信文件给的扩展名，需要智能判断 """
+def load_as_xlsx_file(file_path, keep_links=False, keep_vba=False, read_only=False):
+    """ 这个不能全信文件给的扩展名，需要智能判断
+
+    :param read_only: xlsx文件是否用openpyxl的read_only模式打开，不会预先构建所有单元格，适合大表格的流式读取
+        注意这种模式打开的wb，用完后要调用wb.close()释放文件句柄
+        xls、csv都是转换出来的普通工作簿，不受这个参数影响
+    """
 
     # 0 工具函数
     @run_once()
@@ -361,6 +383,7 @@ def load_as_xlsx_file(file_path, keep_links=False, keep_vba=False):
             file = io.BytesIO(data)
         try:
             return openpyxl.load_workbook(file,
+                                          read_only=read_only,
                                           keep_links=keep_links,
                                           keep_vba=keep_vba), ''
         except Exception as e:
@@ -511,6 +534,27 @@ def combine_addresses(*addrs):
     return new_addr
 
 
+def expand_bounds_by_merged_cells(bounds, merged_bounds):
+    """ 根据合并单元格的情况扩展区域范围
+
+    :param bounds: (left, top, right, bottom)
+    :param merged_bounds: 合并单元格的边界列表 [(left, top, right, bottom), ...]
+    """
+    left0, top0, right0, bottom0 = left, top, right, bottom = bounds
+    for l, t, r, b in merged_bounds:
+        if top0 <= b <= bottom0 or top0 <= t <= bottom0:
+            if left0 <= r and l < left:
+                left = l
+            if l <= right0 and r > right:
+                right = r
+        if left0 <= r <= right0 or left0 <= l <= right0:
+            if top0 <= b and t < top:
+                top = t
+            if t <= bottom0 and b > bottom:
+                bottom = b
+    return left, top, right, bottom
+
+
 def is_string_type(value):
     """ 检查值是否为字符串类型，不是数值或日期类型 """
     # 首先检查日期类型
@@ -753,13 +797,7 @@ class XlCell(openpyxl.cell.cell.Cell):  # 适用于 openpyxl.cell.cell.MergedCel
 
     def get_number_format(self):
         """ 相比源生的接口，有做了一些细节优化 """
-        fmt = self.number_format
-        # openpyxl的机制，如果没有配置日期格式，读取到的是默认的'mm-dd-yy'，其实在中文场景，默认格式应该是后者
-        if fmt == 'mm-dd-yy':
-            return 'yyyy/m/d'  # 中文的默认日期格式
-        elif fmt == r'yyyy\-mm\-dd':  # 不知道为什么会有提取到这种\的情况，先暴力替换了
-            fmt = 'yyyy-mm-dd'
-        return fmt
+        return normalize_number_format(self.number_format)
 
     def get_render_value(self):
         """ 得到单元格简单渲染后的效果
@@ -789,15 +827,140 @@ inject_members(XlCell, openpyxl.cell.cell.Cell, __members)
 inject_members(XlCell, openpyxl.cell.cell.MergedCell, __members)
 
 
+class XlWorksheetValues:
+    """ 工作表单元格值的快照，用于加速反复的检索、定界操作
+
+    XlWorksheet.search等接口要对每个坐标调用cell、celltype，宽表上反复检索非常慢。
+    这里一次性把所有单元格的值读到numpy的二维数组里，并建好合并单元格的索引，后续检索、判空都是数组运算。
+    注意快照建好后，对工作表的修改不会同步过来，需要重新调用ws.snapshot_values()
+
+    >> ws.snapshot_values()  # 之后ws.search、findrow、get_usedrange、iterrows等会自动使用快照
+    """
+
+    def __init__(self, ws):
+        self.max_row, self.max_column = ws.max_row, ws.max_column
+        n, m = self.max_row, self.max_column
+        # 下标从0开始，[row - 1, col - 1]对应单元格
+        self.values = np.full((n, m), None, dtype=object)
+        self.filled = np.zeros((n, m), dtype=bool)
+        for (row, col), cell in ws._cells.items():
+            if row <= n and col <= m and cell.value is not None:
+                self.values[row - 1, col - 1] = cell.value
+                self.filled[row - 1, col - 1] = True
+
+        # 合并单元格索引：derived是除左上角外的衍生位置，merged_id是所在合并单元格在merged_bounds里的下标
+        self.merged_bounds = [rng.bounds for rng in ws.merged_cells.ranges]
+        self.derived = np.zeros((n, m), dtype=bool)
+        self.merged_id = np.full((n, m), -1, dtype=np.int32)
+        for i, (l, t, r, b) in enumerate(self.merged_bounds):
+            self.derived[t - 1:b, l - 1:r] = True
+            self.derived[t - 1, l - 1] = False
+            self.merged_id[t - 1:b, l - 1:r] = i
+
+        self._codes = self._uniques = None
+        self._match_cache = {}
+
+    def _factorize(self):
+        """ search是对str(cell.value)做匹配，相同的文本只需要匹配一次 """
+        if self._codes is None:
+            texts = [str(v) for v in self.values.ravel()]
+            codes, uniques = pd.factorize(pd.Series(texts, dtype=object))
+            self._codes, self._uniques = codes.reshape(self.values.shape), list(uniques)
+        return self._codes, self._uniques
+
+    def match(self, pattern):
+        """ 所有单元格（跳过合并单元格衍生位置）是否满足正则pattern的bool矩阵 """
+        if isinstance(pattern, str):
+            pattern = re.compile(pattern)
+        if pattern not in self._match_cache:
+            codes, uniques = self._factorize()
+            hits = np.fromiter((bool(pattern.search(x)) for x in uniques), dtype=bool, count=len(uniques))
+            self._match_cache[pattern] = hits[codes] & ~self.derived
+        return self._match_cache[pattern]
+
+    def search(self, pattern, min_row, max_row, min_col, max_col, order=None):
+        """ 跟XlWorksheet.search单个pattern时的规则一致
+
+        :param order: 同product的order参数，决定多个匹配时先返回哪个
+        :return: 第一个匹配的 (row, col)，找不到返回None
+        """
+        max_row, max_col = min(max_row, self.max_row), min(max_col, self.max_column)
+        if min_row > max_row or min_col > max_col:
+            return None
+        rows, cols = np.nonzero(self.match(pattern)[min_row - 1:max_row, min_col - 1:max_col])
+        if not len(rows):
+            return None
+
+        # product遍历时，order里靠前的维度变化最慢，负数表示降序
+        order = list(order or [])
+        for i in (1, 2):
+            if i not in order and -i not in order:
+                order.append(i)
+        keys = [(rows, cols)[abs(i) - 1] * (1 if i > 0 else -1) for i in order]
+        k = np.lexsort(keys[::-1])[0]
+        return int(rows[k]) + min_row, int(cols[k]) + min_col
+
+    def _nonempty(self, start_row, end_row, start_col, end_col, axis):
+        """ 区间内各行（axis=1）或各列（axis=0）是否非空，返回非空的行号或列号数组 """
+        start_row, start_col = max(start_row, 1), max(start_col, 1)
+        sub = self.filled[start_row - 1:end_row, start_col - 1:end_col]
+        return np.flatnonzero(sub.any(axis=axis)) + (start_row if axis == 1 else start_col)
+
+    def find_first_non_empty_row(self, start_row, end_row, start_col, end_col):
+        idx = self._nonempty(start_row, end_row, start_col, end_col, axis=1)
+        return int(idx[0]) if len(idx) else -1
+
+    def find_last_non_empty_row(self, start_row, end_row, start_col, end_col):
+        idx = self._nonempty(start_row, end_row, start_col, end_col, axis=1)
+        return int(idx[-1]) if len(idx) else -1
+
+    def find_first_non_empty_column(self, start_col, end_col, start_row, end_row):
+        idx = self._nonempty(start_row, end_row, start_col, end_col, axis=0)
+        return int(idx[0]) if len(idx) else -1
+
+    def find_last_non_empty_column(self, start_col, end_col, start_row, end_row):
+        idx = self._nonempty(start_row, end_row, start_col, end_col, axis=0)
+        return int(idx[-1]) if len(idx) else -1
+
+    def get_used_bounds(self):
+        """ 精确的非空单元格边界，并根据合并单元格扩展
+
+        :return: (left, top, right, bottom)，空表返回None
+        """
+        rows = np.flatnonzero(self.filled.any(axis=1))
+        if not len(rows):
+            return None
+        cols = np.flatnonzero(self.filled.any(axis=0))
+        bounds = (int(cols[0]) + 1, int(rows[0]) + 1, int(cols[-1]) + 1, int(rows[-1]) + 1)
+        return expand_bounds_by_merged_cells(bounds, self.merged_bounds)
+
+    def get_value(self, row, col):
+        if 1 <= row <= self.max_row and 1 <= col <= self.max_column:
+            return self.values[row - 1, col - 1]
+
+
 class XlWorksheet(openpyxl.worksheet.worksheet.Worksheet):
     """ 扩展标准的Workshhet功能 """
 
+    def snapshot_values(self, enable=True):
+        """ 开启（或刷新）单元格值的快照，详见XlWorksheetValues
+
+        :param enable: False时关闭快照，恢复逐个单元格探测的方式
+        """
+        for name in ['search_cache', 'is_empty_row_cache', 'is_empty_column_cache']:
+            if hasattr(self, name):
+                delattr(self, name)
+        self.values_snapshot = XlWorksheetValues(self) if enable else None
+        return self.values_snapshot
+
     def get_raw_usedrange(self):
         raw_used_range = build_range_address(left=self.min_column, top=self.min_row,
                                              right=self.max_column, bottom=self.max_row)
         return raw_used_range
 
     def is_empty_row(self, row, start_col, end_col):
+        if getattr(self, 'values_snapshot', None) is not None:
+            return not len(self.values_snapshot._nonempty(row, row, start_col, end_col, axis=1))
         if not hasattr(self, 'is_empty_row_cache'):
             self.is_empty_row_cache = {}
         key = (row, start_col, end_col)
@@ -828,6 +991,8 @@ class XlWorksheet(openpyxl.worksheet.worksheet.Worksheet):
         return self.is_empty_row_cache[key]
 
     def is_empty_column(self, col, start_row, end_row):
+        if getattr(self, 'values_snapshot', None) is not None:
+            return not len(self.values_snapshot._nonempty(start_row, end_row, col, col, axis=0))
         if not hasattr(self, 'is_empty_column_cache'):
             self.is_empty_column_cache = {}
         key = (col, start_row, end_row)
@@ -851,6 +1016,9 @@ class XlWorksheet(openpyxl.worksheet.worksheet.Worksheet):
         return self.is_empty_column_cache[key]
 
     def find_last_non_empty_row(self, start_row, end_row, start_col, end_col, m=30):
+        if getattr(self, 'values_snapshot', None) is not None:  # 有快照时直接精确计算
+            return self.values_snapshot.find_last_non_empty_row(start_row, end_row, start_col, end_col)
+
         # 1 如果剩余行数不多（小于等于m），直接遍历这些行
         if end_row - start_row <= m:  # 这里是兼容start_row大于end_row的情况的
             for row in range(end_row, start_row - 1, -1):
@@ -879,6 +1047,9 @@ class XlWorksheet(openpyxl.worksheet.worksheet.Worksheet):
         return -1
 
     def find_last_non_empty_column(self, start_col, end_col, start_row, end_row, m=30):
+        if getattr(self, 'values_snapshot', None) is not None:  # 有快照时直接精确计算
+            return self.values_snapshot.find_last_non_empty_column(start_col, end_col, start_row, end_row)
+
         # dprint(end_col)
 
         # 1 如果剩余列数不多（小于等于m），直接遍历这些列
@@ -907,6 +1078,9 @@ class XlWorksheet(openpyxl.worksheet.worksheet.Worksheet):
         return -1
 
     def find_first_non_empty_row(self, start_row, end_row, start_col, end_col, m=30):
+        if getattr(self, 'values_snapshot', None) is not None:  # 有快照时直接精确计算
+            return self.values_snapshot.find_first_non_empty_row(start_row, end_row, start_col, end_col)
+
         # 1 如果剩余行数不多（小于等于m），直接遍历这些行
         if end_row - start_row <= m:
             for row in range(start_row, end_row + 1):
@@ -933,6 +1107,9 @@ class XlWorksheet(openpyxl.worksheet.worksheet.Worksheet):
         return -1
 
     def find_first_non_empty_column(self, start_col, end_col, start_row, end_row, m=30):
+        if getattr(self, 'values_snapshot', None) is not None:  # 有快照时直接精确计算
+            return self.values_snapshot.find_first_non_empty_column(start_col, end_col, start_row, end_row)
+
         # 1 如果剩余列数不多（小于等于m），直接遍历这些列
         if end_col - start_col <= m:
             for col in range(start_col, end_col + 1):
@@ -984,7 +1161,12 @@ class XlWorksheet(openpyxl.worksheet.worksheet.Worksheet):
 
         :param reset_bounds: 计算出新区域后，是否重置ws的边界值
         """
-        if not hasattr(self, 'usedrange_cache'):
+        if getattr(self, 'values_snapshot', None) is not None:
+            bounds = self.values_snapshot.get_used_bounds()
+            if bounds is None:
+                return 'A1'
+            self.used_range = build_range_address(*bounds)
+        elif not hasattr(self, 'usedrange_cache'):
             # 初始化边界值
             left, right, top, bottom = self.min_column, self.max_column, self.min_row, self.max_row
 
@@ -1008,19 +1190,8 @@ class XlWorksheet(openpyxl.worksheet.worksheet.Worksheet):
 
             # 2 然后还要再扩范围（根据合并单元格情况）
             # start_time = time.time()
-            top0, bottom0, left0, right0 = top, bottom, left, right
-            for merged_range in self.merged_cells.ranges:
-                l, t, r, b = merged_range.bounds
-                if top0 <= b <= bottom0 or top0 <= t <= bottom0:
-                    if left0 <= r and l < left:
-                        left = l
-                    if l <= right0 and r > right:
-                        right = r
-                if left0 <= r <= right0 or left0 <= l <= right0:
-                    if top0 <= b and t < top:
-                        top = t
-                    if t <= bottom0 and b > bottom:
-                        bottom = b
+            left, top, right, bottom = expand_bounds_by_merged_cells(
+                (left, top, right, bottom), [rng.bounds for rng in self.merged_cells.ranges])
             # get_global_var('expandrange_time')[-1] += time.time() - start_time
 
             self.used_range = build_range_address(left=left, top=top, right=right, bottom=bottom)
@@ -1085,13 +1256,17 @@ class XlWorksheet(openpyxl.worksheet.worksheet.Worksheet):
         if isinstance(pattern, list):
             pattern = tuple(pattern)
 
+        if order is not None:
+            order = tuple(order)
         key = (pattern, min_row, max_row, min_col, max_col, order, direction)
 
         def get_search_core():
             nonlocal pattern
-            # 1 定界
-            x1, x2 = max(min_row or 1, 1), min(max_row or self.max_row, self.max_row)
-            y1, y2 = max(min_col or 1, 1), min(max_col or self.max_column, self.max_column)
+            # 1 定界，ws.max_row、max_column每次都要遍历所有单元格，有快照时用快照的尺寸
+            snapshot = getattr(self, 'values_snapshot', None)
+            n, m = (snapshot.max_row, snapshot.max_column) if snapshot is not None else (self.max_row, self.max_column)
+            x1, x2 = max(min_row or 1, 1), min(max_row or n, n)
+            y1, y2 = max(min_col or 1, 1), min(max_col or m, m)
 
             # 2 遍历
             if isinstance(pattern, datetime.date):
@@ -1119,7 +1294,10 @@ class XlWorksheet(openpyxl.worksheet.worksheet.Worksheet):
                 return cel
             else:
                 if isinstance(pattern, str): pattern = re.compile(pattern)
-                for x, y in product(range(x1, x2 + 1), range(y1, y2 + 1), order=order):
+                if snapshot is not None:
+                    pos = snapshot.search(pattern, x1, x2, y1, y2, order)
+                    return self.cell(*pos) if pos else None
+                for x, y in product(range(x1, x2 + 1), range(y1, y2 + 1), order=order and list(order)):
                     cell = self.cell(x, y)
                     if cell.celltype() == 1: continue  # 过滤掉合并单元格位置
                     if pattern.search(str(cell.value)): return cell  # 返回满足条件的第一个值
@@ -1546,14 +1724,9 @@ class XlWorksheet(openpyxl.worksheet.worksheet.Worksheet):
                 raise ValueError('Not find cell')
 
         # 2 智能 column
-        if isinstance(column, int):
-            pass
-        elif isinstance(column, str) and re.match(r'[A-Z]+$', column):
-            column = column_index_from_string(column)
-        else:
-            column = self.findcol(column)
-            if not column:
-                return None
+        column = self._resolve_column(column)
+        if not column:
+            return None
 
         # 3 单元格
         # cell = self.cell(row, column, value)  # 这种写法好像有bug，写长文本的时候，后丢掉后半部分
@@ -1562,6 +1735,15 @@ class XlWorksheet(openpyxl.worksheet.worksheet.Worksheet):
             cell.value = value
         return cell
 
+    def _resolve_column(self, column):
+        """ cell2里column参数的解析规则，找不到时返回0 """
+        if isinstance(column, int):
+            return column
+        elif isinstance(column, str) and re.match(r'[A-Z]+$', column):
+            return column_index_from_string(column)
+        else:
+            return self.findcol(column)
+
     def iterrows(self, key_column_name, mode='auto', *, to_dict=None):
         """ 通过某个属性列作为key，判断数据所在行
 
@@ -1582,15 +1764,24 @@ class XlWorksheet(openpyxl.worksheet.worksheet.Worksheet):
 
         # 2 终止行
         max_row = self.max_row
+        snapshot = getattr(self, 'values_snapshot', None)
 
         if mode == 'default':
             col = cel.column
+            if snapshot is not None:
+                values = snapshot.values[min_row:max_row, col - 1]
+                idx = np.flatnonzero([bool(v) for v in values])
+                max_row = int(idx[-1]) + min_row + 1 if len(idx) else min_row
             while max_row > min_row:
                 if self.cell(max_row, col).value:
                     break
                 max_row -= 1
         elif mode == 'any_content':
             max_column = self.max_column
+            if snapshot is not None:
+                values = snapshot.values[min_row:max_row]
+                idx = np.flatnonzero([any(row) for row in values])
+                max_row = int(idx[-1]) + min_row + 1 if len(idx) else min_row
             while max_row > min_row:
                 empty_line = True
                 for j in range(1, max_column + 1):
@@ -1599,6 +1790,7 @@ class XlWorksheet(openpyxl.worksheet.worksheet.Worksheet):
                         break
                 if not empty_line:
                     break
+                max_row -= 1
         elif mode == 'auto':
             rng = parse_range_address(self.get_usedrange())
             max_row = rng['bottom']
@@ -1606,11 +1798,14 @@ class XlWorksheet(openpyxl.worksheet.worksheet.Worksheet):
             raise NotImplementedError(f'{mode}')
 
         if to_dict:
+            # 字段所在列只需要解析一次
+            cols = {k: self._resolve_column(k) for k in to_dict}
             data = []
             for i in range(min_row, max_row + 1):
-                msg = {}
-                for k in to_dict:
-                    msg[k] = self.cell2(i, k).value
+                if snapshot is not None:
+                    msg = {k: snapshot.get_value(i, c) for k, c in cols.items()}
+                else:
+                    msg = {k: self.cell(i, c).value for k, c in cols.items()}
                 data.append([i, msg])
             return data
         else:
@@ -1944,14 +2139,20 @@ class XlWorkbook(openpyxl.Workbook):
             ws.autofit()
 
     def extract_summary(self, *, samples_num=5, limit_length=2500):
-        """ 更新后的函数：提取整个Excel工作簿的摘要信息 """
+        """ 更新后的函数：提取整个Excel工作簿的摘要信息
+
+        read_only模式打开的工作簿，会使用SheetStreamSummary流式提取，大表格要快很多，内存也不会随行数增长
+        """
         wb = self
 
         all_sheets_summary = []
 
         for ws in wb._sheets:  # 非数据表，也要遍历出来，所以使用了_sheets
+            # read_only模式的工作表，使用流式的摘要提取机制
+            if isinstance(ws, ReadOnlyWorksheet):
+                summary = SheetStreamSummary(ws, samples_num=samples_num).parse().get_summary()
             # 如果是标准工作表（Worksheet），使用现有的摘要提取机制
-            if isinstance(ws, openpyxl.worksheet.worksheet.Worksheet):
+            elif isinstance(ws, openpyxl.worksheet.worksheet.Worksheet):
                 # 找到使用范围和表头范围
                 used_range = ws.get_usedrange()
                 if used_range:
@@ -2006,14 +2207,20 @@ class XlWorkbook(openpyxl.Workbook):
         return workbook_summary
 
     def extract_summary2(self):
-        """ 另一套按照单元格提取摘要的程序 """
+        """ 另一套按照单元格提取摘要的程序
+
+        read_only模式打开的工作簿，会使用SheetStreamSummary流式提取
+        """
         wb = self
 
         all_sheets_summary = []
 
         for ws in wb._sheets:  # 非数据表，也要遍历出来，所以使用了_sheets
+            # read_only模式的工作表，使用流式的摘要提取机制
+            if isinstance(ws, ReadOnlyWorksheet):
+                summary = SheetStreamSummary(ws, keep_cells=True).parse().get_summary2()
             # 如果是标准工作表（Worksheet），使用现有的摘要提取机制
-            if isinstance(ws, (openpyxl.worksheet.worksheet.Worksheet)):
+            elif isinstance(ws, (openpyxl.worksheet.worksheet.Worksheet)):
                 # 找到使用范围和表头范围
                 used_range = ws.get_usedrange()
                 if used_range:
@@ -2078,6 +2285,17 @@ def score_row(row):
     return score
 
 
+def pick_header_row(row_scores):
+    """ 根据各行的得分，返回表头最后一行的下标 """
+    # 计算行与行之间分数变化的加权
+    weighted_scores = []
+    for i, score in enumerate(row_scores):
+        b = score - row_scores[i + 1] if i < len(row_scores) - 1 else 0
+        y = score + b
+        weighted_scores.append(y)
+    return weighted_scores.index(max(weighted_scores))
+
+
 def find_header_row(ws, used_range, max_rows_to_check=10):
     """ 找到工作表中的表头行 """
     range_details = parse_range_address(used_range)
@@ -2093,15 +2311,8 @@ def find_header_row(ws, used_range, max_rows_to_check=10):
                             min_col=range_details['left'], max_col=range_details['right']):
         row_scores.append(score_row(row))
 
-    # 计算行与行之间分数变化的加权
-    weighted_scores = []
-    for i, score in enumerate(row_scores):
-        b = score - row_scores[i + 1] if i < len(row_scores) - 1 else 0
-        y = score + b
-        weighted_scores.append(y)
-
     # 确定表头行的位置
-    header_row = weighted_scores.index(max(weighted_scores)) + range_details['top']
+    header_row = pick_header_row(row_scores) + range_details['top']
 
     # 从used_range的起始行到找到的表头行都视为表头
     header_range = build_range_address(left=range_details['left'], top=range_details['top'],
@@ -2414,40 +2625,44 @@ class WorkbookSummary:
 
 
 def extract_workbook_summary(file_path, mode=0,
-                             samples_num=5, limit_length=2500, ignore_errors=False):
+                             samples_num=5, limit_length=2500, ignore_errors=False, *, read_only=True):
     """ 更新后的函数：提取整个Excel工作簿的摘要信息
 
     :param mode:
         -1，提取全量摘要（详细信息，全部样本）
         0, 标准的提取摘要（详细信息，随机抽5个样本）
         1，精简摘要，在保留逻辑完整性的前提下，随机的修改一些摘要的结构内容
+    :param read_only: 默认用read_only模式打开，单遍流式提取摘要；False则是原来完整加载工作簿的方式
     """
     try:
-        wb: XlWorkbook = openpyxl.load_workbook(file_path)
+        wb: XlWorkbook = openpyxl.load_workbook(file_path, read_only=read_only)
     except Exception as e:
         if ignore_errors:
             return {}
         else:
             raise e
 
-    if mode == -1:
-        res = wb.extract_summary(samples_num=1000, limit_length=-1)
-        res['fileName'] = Path(file_path).name
-    elif mode == 0:
-        res = wb.extract_summary(samples_num=samples_num, limit_length=limit_length)
-        res['fileName'] = Path(file_path).name
-
-    elif mode == 1:
-        res = wb.extract_summary(samples_num=samples_num)
-
-        wb_summary = WorkbookSummary(res)
-        wb_summary.random_filename()
-        wb_summary.random_delete()
-        wb_summary.reduce_summarys(limit_length=limit_length)
-
-        res = wb_summary.data
-    else:
-        raise ValueError('mode参数值不正确')
+    try:
+        if mode == -1:
+            res = wb.extract_summary(samples_num=1000, limit_length=-1)
+            res['fileName'] = Path(file_path).name
+        elif mode == 0:
+            res = wb.extract_summary(samples_num=samples_num, limit_length=limit_length)
+            res['fileName'] = Path(file_path).name
+
+        elif mode == 1:
+            res = wb.extract_summary(samples_num=samples_num)
+
+            wb_summary = WorkbookSummary(res)
+            wb_summary.random_filename()
+            wb_summary.random_delete()
+            wb_summary.reduce_summarys(limit_length=limit_length)
+
+            res = wb_summary.data
+        else:
+            raise ValueError('mode参数值不正确')
+    finally:
+        wb.close()
 
     return res
 
@@ -2457,15 +2672,15 @@ def extract_workbook_summary2(file_path, *,
                               keep_vba=False,
                               mode=0,
                               return_mode=0,
+                              read_only=True,
                               **kwargs):
     """
     :param keep_links: 是否保留外部表格链接数据。如果保留，打开好像会有点问题。
     :param mode:
         0，最原始的summary2摘要
         1，添加当前工作表、单元格位置的信息
+    :param read_only: xlsx文件默认用read_only模式打开，单遍流式提取摘要，不用预先构建所有单元格
     :param kwargs: 捕捉其他参数，主要是向下兼容，其实现在并没有用
-
-    注意这里没有提供read_only可选参数，是因为read_only=True模式在我这里是运行不了的。
     """
 
     # 1 读取文件wb
@@ -2473,7 +2688,7 @@ def extract_workbook_summary2(file_path, *,
     res = {}
     res['fileName'] = file_path.name
     start_time = time.time()
-    wb, suffix = load_as_xlsx_file(file_path, keep_links=keep_links, keep_vba=keep_vba)
+    wb, suffix = load_as_xlsx_file(file_path, keep_links=keep_links, keep_vba=keep_vba, read_only=read_only)
     if wb is None:
         res['error'] = f'Load file error。{suffix}'
     else:
@@ -2487,13 +2702,16 @@ def extract_workbook_summary2(file_path, *,
             return res
 
     # 2 提取摘要
-    summary2 = wb.extract_summary2()
-    DictTool.ior(res, summary2)
-    if mode == 1:
-        ws = wb.active
-        res['ActiveSheet'] = ws.title
-        if hasattr(ws, 'selected_cell'):
-            res['Selection'] = ws.selected_cell
+    try:
+        summary2 = wb.extract_summary2()
+        DictTool.ior(res, summary2)
+        if mode == 1:
+            ws = wb.active
+            res['ActiveSheet'] = ws.title
+            if hasattr(ws, 'selected_cell'):
+                res['Selection'] = ws.selected_cell
+    finally:
+        wb.close()
 
     # res = convert_to_json_compatible(res)
 
@@ -3120,3 +3338,753 @@ def extract_workbook_summary3b(file_path,
         return res, time_dict, summary2_res
 
     return res
+
+
+def __4_stream_summary():
+    """ 流式提取表格摘要
+
+    openpyxl的完整模式会给每个单元格都建Cell对象，上百万行的表，光读取就要几分钟、几个G内存，
+    get_usedrange等再去逐个探测单元格也很慢。
+    这里基于read_only模式，直接流式解析sheet的xml，只遍历一遍单元格，就把数据区间、表头、字段摘要、抽样行都统计出来。
+    除了summary2本身就要输出所有单元格，其他情况内存只跟列数、表头检查行数、抽样数有关，跟数据总行数无关。
+    """
+
+
+def _render_value(value, fmt):
+    """ 跟XlCell.get_render_value一样的渲染规则 """
+    if isinstance(value, openpyxl.worksheet.formula.ArrayFormula):
+        return value.text
+    return xl_render_value(value, fmt)
+
+
+class _FieldStats:
+    """ 一列数据的流式统计量，对应determine_field_type_and_summary里需要的全量信息 """
+
+    def __init__(self, next_row):
+        self.formats = {}  # 数字格式 -> [出现次数, 首次出现的行号]
+        self.ranges = {}  # 数字格式 -> [最小值, 最大值]，出现无法比较的值时为None
+        self.next_row = next_row  # 下一个期望出现单元格的行号，用来发现没有存储的空单元格
+        self.gap_row = None  # 首个没有存储的空单元格所在行号
+
+    def add_format(self, fmt, row, count=1):
+        if fmt in self.formats:
+            self.formats[fmt][0] += count
+        else:
+            self.formats[fmt] = [count, row]
+
+    def add_value(self, fmt, value):
+        """ 跟原来 min(values)、max(values) 的效果一致，出现不可比较的类型，该格式就不算数值范围 """
+        if value is None or isinstance(value, str):
+            return
+        if fmt not in self.ranges:
+            self.ranges[fmt] = [value, value]
+            return
+        rng = self.ranges[fmt]
+        if rng is None:
+            return
+        try:
+            if value < rng[0]:
+                rng[0] = value
+            if value > rng[1]:
+                rng[1] = value
+        except TypeError:
+            self.ranges[fmt] = None
+
+    def mark_row(self, row):
+        """ 记录本列在row行有存储的单元格 """
+        if row > self.next_row and self.gap_row is None:
+            self.gap_row = self.next_row
+        self.next_row = row + 1
+
+    def get_summary(self, rows_num, bottom, sample_values):
+        """
+        :param rows_num: 数据总行数，没有存储的单元格按General格式计数
+        :param bottom: 数据区间的最后一行
+        """
+        formats = {k: list(v) for k, v in self.formats.items()}
+        general_num = rows_num - sum(v[0] for v in formats.values())
+        if general_num > 0:
+            gap_row = self.gap_row if self.gap_row is not None else self.next_row
+            if 'General' in formats:
+                formats['General'][0] += general_num
+                formats['General'][1] = min(formats['General'][1], gap_row)
+            else:
+                formats['General'] = [general_num, gap_row]
+        number_formats = [k for k, v in sorted(formats.items(), key=lambda item: (-item[1][0], item[1][1]))]
+
+        numeric_range = None
+        for fmt in number_formats:
+            rng = self.ranges.get(fmt)
+            if rng:
+                numeric_range = [xl_render_value(rng[0], fmt), xl_render_value(rng[1], fmt)]
+                break
+
+        return {
+            "number_formats": number_formats,
+            "numeric_range": numeric_range,
+            "sample_values": sample_values,
+        }
+
+
+class SheetStreamSummary:
+    """ 流式提取一个read_only工作表的摘要
+
+    >> wb = openpyxl.load_workbook(file, read_only=True)
+    >> SheetStreamSummary(wb.worksheets[0]).parse().get_summary()
+
+    结果跟完整模式下的 XlWorkbook.extract_summary、extract_summary2 里每个sheet的摘要结构一致，
+    有两个细微差别：
+    1、usedRange是精确遍历得到的，不是get_usedrange的采样估计，个别极端表格的结果会更准确
+    2、位于数据区间之后的"有格式但没值"的单元格，不计入字段的数字格式统计
+    """
+
+    def __init__(self, ws, *, samples_num=5, max_rows_to_check=50, keep_cells=False):
+        """
+        :param ws: read_only模式下的ReadOnlyWorksheet
+        :param samples_num: 每个字段要抽样的数据行数
+        :param max_rows_to_check: 检查表头的最大行数，跟split_header_and_data一致
+        :param keep_cells: 是否保留所有非空单元格，get_summary2需要
+        """
+        self.ws = ws
+        self.samples_num = samples_num
+        self.max_rows_to_check = max_rows_to_check
+        self.keep_cells = keep_cells
+
+        self.raw_bounds = None  # 所有存储的单元格边界，对应ws.min_row等 [left, top, right, bottom]
+        self.bounds = None  # 非空单元格边界
+        self.merged_bounds = []  # 合并单元格的边界 [(left, top, right, bottom), ...]
+        self.head_rows = {}  # 首个非空行开始，检查表头要用到的前若干行 {行号: {列号: (值, 格式)}}
+        self.fields = {}  # 表头检查范围之后的数据，每列的统计量 {列号: _FieldStats}
+        self.pending = {}  # 暂存"整行都没值"的单元格格式 {(列号, 格式): [数量, 首次行号]}，后面出现非空行才确认计入
+        self.samples = []  # 蓄水池抽样的数据行 [(行号, {列号: (值, 格式)}), ...]
+        self.samples_total = 0  # 参与蓄水池抽样的行数
+        self.last_sampled_row = None
+        self.cells = {}  # keep_cells时存储所有非空单元格的渲染值 {行号: {列号: 渲染值}}
+
+    @property
+    def stream_start(self):
+        """ 这一行开始的数据，一定位于表头之后，可以直接流式统计 """
+        return self.bounds[1] + self.max_rows_to_check
+
+    def iter_rows(self):
+        """ 流式遍历xml里存储的单元格
+
+        :return: 生成器，每次返回 (行号, [(列号, 值, 数字格式), ...])，没有存储单元格的行会跳过
+            遍历完后，会更新merged_bounds，以及给ws补上selected_cell属性
+        """
+        ws = self.ws
+        wb = ws.parent
+        fmts = {}  # style_id -> 数字格式
+
+        def get_fmt(style_id):
+            if style_id not in fmts:
+                try:
+                    num_fmt_id = wb._cell_styles[style_id].numFmtId
+                except IndexError:
+                    num_fmt_id = 0
+                if num_fmt_id < BUILTIN_FORMATS_MAX_SIZE:
+                    fmt = BUILTIN_FORMATS.get(num_fmt_id, 'General')
+                else:
+                    fmt = wb._number_formats[num_fmt_id - BUILTIN_FORMATS_MAX_SIZE]
+                fmts[style_id] = normalize_number_format(fmt)
+            return fmts[style_id]
+
+        with ws._get_source() as src:
+            parser = WorkSheetParser(src, ws._shared_strings,
+                                     data_only=wb.data_only, epoch=wb.epoch,
+                                     date_formats=wb._date_formats, timedelta_formats=wb._timedelta_formats)
+            for idx, row in parser.parse():
+                if row:
+                    yield idx, [(cell['column'], cell['value'], get_fmt(cell['style_id'])) for cell in row]
+
+        if parser.merged_cells:
+            self.merged_bounds = [range_boundaries(x.ref) for x in parser.merged_cells.mergeCell]
+
+        # read_only的ws没有sheet_view，补上selected_cell，跟完整模式的接口一致
+        selected_cell = 'A1'
+        views = getattr(parser, 'views', None)
+        if views and views.sheetView and views.sheetView[0].selection:
+            selected_cell = views.sheetView[0].selection[0].sqref
+        ws.selected_cell = selected_cell
+
+    def parse(self):
+        for row, cells in self.iter_rows():
+            # 1 更新边界
+            cols = [x[0] for x in cells]
+            self.raw_bounds = self._update_bounds(self.raw_bounds, row, cols)
+            values = [x for x in cells if x[1] is not None]
+            if values:
+                self.bounds = self._update_bounds(self.bounds, row, [x[0] for x in values])
+                if self.keep_cells:
+                    self.cells[row] = {col: _render_value(v, fmt) for col, v, fmt in values}
+
+            # 2 首个非空行之前的行，只有格式没有值，不影响摘要
+            if self.bounds is None:
+                continue
+
+            # 3 表头检查范围内的行先缓存，其他数据行直接流式统计
+            if row < self.stream_start:
+                self.head_rows[row] = {col: (v, fmt) for col, v, fmt in cells}
+            else:
+                self._update_data_row(row, cells, bool(values))
+
+        self._finish()
+        return self
+
+    @classmethod
+    def _update_bounds(cls, bounds, row, cols):
+        if bounds is None:
+            return [min(cols), row, max(cols), row]
+        bounds[0] = min(bounds[0], *cols)
+        bounds[2] = max(bounds[2], *cols)
+        bounds[3] = row
+        return bounds
+
+    def _get_field(self, col):
+        if col not in self.fields:
+            self.fields[col] = _FieldStats(self.stream_start)
+        return self.fields[col]
+
+    def _update_data_row(self, row, cells, nonempty):
+        """ 统计表头检查范围之后的一行数据 """
+        if nonempty:
+            # 出现了非空行，前面暂存的空行都确认在数据区间内
+            for (col, fmt), (n, first_row) in self.pending.items():
+                self._get_field(col).add_format(fmt, first_row, n)
+            self.pending = {}
+            self._feed_samples(row, {col: (v, fmt) for col, v, fmt in cells})
+
+        for col, v, fmt in cells:
+            field = self._get_field(col)
+            field.mark_row(row)
+            if nonempty:
+                field.add_format(fmt, row)
+                field.add_value(fmt, v)
+            elif (col, fmt) in self.pending:
+                self.pending[(col, fmt)][0] += 1
+            else:
+                self.pending[(col, fmt)] = [1, row]
+
+    def _feed_samples(self, row, cells=None):
+        """ 蓄水池抽样，把上次抽样之后到row的行都加入，中间没有值的行也要算进去 """
+        start = self.stream_start if self.last_sampled_row is None else self.last_sampled_row + 1
+        k = self.samples_num
+        for i in range(start, row + 1):
+            self.samples_total += 1
+            if len(self.samples) < k:
+                idx = len(self.samples)
+                self.samples.append(None)
+            else:
+                idx = random.randrange(self.samples_total)
+                if idx >= k:
+                    continue
+            # 只有被抽中的行才保留单元格内容
+            self.samples[idx] = (i, cells if i == row else None)
+        self.last_sampled_row = row
+
+    def _finish(self):
+        """ 遍历完后，确定最终的数据区间、表头位置，并合并表头检查范围内的数据统计 """
+        # 1 数据区间
+        if self.raw_bounds is None:
+            self.raw_bounds = [1, 1, 1, 1]
+        if self.merged_bounds:
+            for l, t, r, b in self.merged_bounds:
+                self.raw_bounds = [min(self.raw_bounds[0], l), min(self.raw_bounds[1], t),
+                                   max(self.raw_bounds[2], r), max(self.raw_bounds[3], b)]
+
+        if self.bounds is None:  # 空表返回A1占位
+            self.bounds = [1, 1, 1, 1]
+            self.used_bounds = (1, 1, 1, 1)
+        else:
+            self.used_bounds = expand_bounds_by_merged_cells(self.bounds, self.merged_bounds)
+        left, top, right, bottom = self.used_bounds
+
+        # 合并单元格往下扩展出来的行，也要参与抽样
+        if bottom >= self.stream_start:
+            self._feed_samples(bottom)
+
+        # 2 表头位置
+        n = min(bottom - top + 1, self.max_rows_to_check)
+        row_scores = []
+        for row in range(top, top + n):
+            score = 0
+            for col, (v, fmt) in self.head_rows.get(row, {}).items():
+                if v is not None and left <= col <= right:
+                    score += 1 if is_string_type(v) else -1
+            row_scores.append(score)
+        self.header_bottom = pick_header_row(row_scores) + top
+
+        # 3 表头检查范围内，位于表头之后的数据行，补充到字段统计里
+        end_row = min(self.stream_start - 1, bottom)
+        for col in range(left, right + 1):
+            field = self._get_field(col)
+            gap_row = None
+            for row in range(self.header_bottom + 1, end_row + 1):
+                cell = self.head_rows.get(row, {}).get(col)
+                if cell is None:
+                    if gap_row is None:
+                        gap_row = row
+                    continue
+                v, fmt = cell
+                field.add_format(fmt, row)
+                field.add_value(fmt, v)
+            # 之前流式统计时的空单元格，可能位于数据区间之后
+            if field.gap_row is not None and field.gap_row > bottom:
+                field.gap_row = None
+            if gap_row is not None:
+                field.gap_row = gap_row
+
+    def _get_head_cell(self, row, col):
+        return self.head_rows.get(row, {}).get(col, (None, 'General'))
+
+    def get_sample_rows(self):
+        """ 从表头之后的所有数据行里，等概率抽取samples_num行
+
+        :return: [(行号, {列号: (值, 格式)}), ...]
+        """
+        k = self.samples_num
+        end_row = min(self.stream_start - 1, self.used_bounds[3])
+        head_rows = [(row, self.head_rows.get(row, {})) for row in range(self.header_bottom + 1, end_row + 1)]
+        total = len(head_rows) + self.samples_total
+        if total <= k:
+            rows = head_rows + self.samples
+        else:
+            # 蓄水池里的样本是数据后半段的均匀抽样，再按两段的行数比例，决定最终各抽几行
+            idxs = random.sample(range(total), k)
+            rows = [head_rows[i] for i in idxs if i < len(head_rows)]
+            rows += random.sample(self.samples, k - len(rows))
+        rows = [(row, cells or {}) for row, cells in rows]
+        rows.sort(key=lambda x: x[0])
+        return rows
+
+    def get_header_structure(self):
+        """ 对应extract_header_structure """
+        left, top, right, bottom = self.used_bounds
+        header_bottom = self.header_bottom
+
+        header_structure = {}
+        merged_addresses = set()
+        for l, t, r, b in self.merged_bounds:
+            if t <= header_bottom and b >= top:
+                address = build_range_address(left=l, top=t, right=r, bottom=b)
+                header_structure[address] = _render_value(*self._get_head_cell(t, l))
+                for row in range(t, b + 1):
+                    for col in range(l, r + 1):
+                        merged_addresses.add((row, col))
+
+        for row in range(top, header_bottom + 1):
+            for col in range(left, right + 1):
+                if (row, col) not in merged_addresses:
+                    header_structure[f'{get_column_letter(col)}{row}'] = _render_value(*self._get_head_cell(row, col))
+
+        return header_structure
+
+    def get_field_summaries(self):
+        """ 对应extract_field_summaries """
+        left, top, right, bottom = self.used_bounds
+        header_bottom = self.header_bottom
+        rows_num = max(bottom - header_bottom, 0)
+        sample_rows = self.get_sample_rows()
+
+        # 表头最后一行里，合并单元格的衍生单元格不作为字段
+        derived_cols = set()
+        for l, t, r, b in self.merged_bounds:
+            if t <= header_bottom <= b:
+                derived_cols.update(col for col in range(l, r + 1) if (header_bottom, col) != (t, l))
+
+        field_summaries = {}
+        for col in range(left, right + 1):
+            if col in derived_cols:
+                continue
+            sample_values = []
+            for row, cells in sample_rows:
+                value = _render_value(*cells.get(col, (None, 'General')))
+                if isinstance(value, str) and len(value) > 20:
+                    value = value[:17] + '...'
+                sample_values.append(value)
+            field_summaries[f'{get_column_letter(col)}{header_bottom}'] = \
+                self._get_field(col).get_summary(rows_num, bottom, sample_values)
+
+        return field_summaries
+
+    def get_summary(self):
+        """ XlWorkbook.extract_summary里一个sheet的摘要 """
+        left, top, right, bottom = self.used_bounds
+        used_range = build_range_address(left=left, top=top, right=right, bottom=bottom)
+        header_range = build_range_address(left=left, top=top, right=right, bottom=self.header_bottom)
+        data_range = build_range_address(left=left, top=self.header_bottom + 1, right=right, bottom=bottom)
+        filterRange = re.sub(r'\d+',
+                             lambda m: str(max(int(m.group()) - 1, 1)),
+                             data_range, count=1)
+
+        summary = {
+            "sheetName": self.ws.title,
+            "sheetType": "Worksheet",
+            "usedRange": used_range,
+            "headerRange": header_range,
+            "header": self.get_header_structure(),
+            'dataRange': data_range,
+            'filterRange': filterRange,
+            'sortRange': filterRange,
+            'data': self.get_field_summaries(),
+        }
+
+        if not summary['data']:  # 如果没有数据，则大概率是数据透视表，是计算出来的，读取不到~
+            summary['sheetType'] = 'PivotTable'
+            del summary['data']
+
+        return summary
+
+    def get_cells_content(self):
+        """ 对应extract_cells_content，需要keep_cells=True """
+        left, top, right, bottom = self.used_bounds
+        sorted_merged_cells_stack = sorted(self.merged_bounds, key=lambda x: (x[1], x[0]))[::-1]
+        used_cells_set = set()
+        cells = {}
+
+        for i in range(top, bottom + 1):
+            row_cells = self.cells.get(i, {})
+            for j in range(left, right + 1):
+                # 合并单元格的衍生单元格，直接跳过
+                if (i, j) in used_cells_set:
+                    used_cells_set.remove((i, j))
+                    continue
+
+                # cell归属某组合并单元格
+                if (sorted_merged_cells_stack
+                        and sorted_merged_cells_stack[-1][1] == i
+                        and sorted_merged_cells_stack[-1][0] == j):
+                    l, t, r, b = sorted_merged_cells_stack.pop()
+                    for rng_i in range(t, b + 1):
+                        for rng_j in range(l, r + 1):
+                            used_cells_set.add((rng_i, rng_j))
+                    used_cells_set.remove((i, j))
+                    cells[CellRange(min_col=l, min_row=t, max_col=r, max_row=b).coord] = row_cells.get(j, '')
+                    continue
+
+                # 普通单元格
+                cells[f'{get_column_letter(j)}{i}'] = row_cells.get(j, '')
+
+        return cells
+
+    def get_summary2(self):
+        """ XlWorkbook.extract_summary2里一个sheet的摘要 """
+        summary = {
+            "sheetName": self.ws.title,
+            "sheetType": "Worksheet",
+            "rawUsedRange": build_range_address(*self.raw_bounds),
+            "usedRange": build_range_address(*self.used_bounds),
+            'cells': self.get_cells_content(),
+        }
+
+        if not summary['cells']:
+            summary['sheetType'] = 'PivotTable'
+            del summary['cells']
+
+        return summary
+
+
+def __5_batch_summary():
+    """ 批量提取表格摘要
+
+    extract_workbook_summary3b里的Timeout是信号机制，程序卡在c扩展等地方时是打断不了的，
+    一个畸形的表格就可能把调用方整个卡死。
+    这里每个worker是一个独立的子进程，由主进程计时，超时直接杀掉子进程再补一个新的，
+    再配合内存上限、按excel2md5的结果缓存、jsonl断点续传，用于成批表格的摘要提取。
+    """
+
+
+def _summary_cache_key(md5, summary_kwargs):
+    from pyxllib.prog.cachetools import make_args_key
+    return make_args_key('extract_workbook_summary3b', (md5,), summary_kwargs)
+
+
+def _file_stat_key(file):
+    """ 文件没有变化时，可以直接复用上次算出的excel2md5 """
+    st = os.stat(file)
+    return f'excel2md5:{os.path.abspath(file)}:{st.st_size}:{st.st_mtime_ns}'
+
+
+def _get_excel_md5(file, store):
+    """ 计算excel2md5，并借助缓存尽量避免重复计算
+
+    excel2md5只用作摘要缓存的键，只在有缓存时调用
+    excel2md5要完整加载工作簿再序列化，比提取摘要本身还慢得多，所以缓存了两层映射：
+    文件路径+大小+修改时间 -> excel2md5，文件内容md5 -> excel2md5，原样复制的文件也不用重算
+    """
+    stat_key = _file_stat_key(file)
+    try:  # 文件没变化时，连文件内容都不用读
+        return store.get(stat_key)
+    except KeyError:
+        pass
+
+    content_key = 'excel2md5:' + hashlib.md5(Path(file).read_bytes()).hexdigest()
+    try:
+        md5 = store.get(content_key)
+    except KeyError:
+        # xls、csv等openpyxl读不了的，退化为按文件内容计算md5
+        md5 = excel2md5(file) or content_key[10:]
+        store.set(content_key, md5)
+    store.set(stat_key, md5)
+    return md5
+
+
+def _summarize_one_file(file, store, summary_kwargs):
+    """ 在worker子进程里提取一个文件的摘要
+
+    :return dict: 日志记录，status是ok、cached、error之一
+    """
+    start_time = time.time()
+    record = {'status': 'ok'}
+    try:
+        res, md5 = None, None
+        if store is not None:  # 不用缓存时不需要excel2md5，省掉一次完整加载工作簿
+            md5 = _get_excel_md5(file, store)
+            record['md5'] = md5
+        if md5:
+            try:
+                res, time_dict = store.get(_summary_cache_key(md5, summary_kwargs))
+                record['status'] = 'cached'
+            except KeyError:
+                pass
+        if res is None:
+            # 超时由主进程负责，这里关掉3b自带的信号超时机制
+            res, time_dict = extract_workbook_summary3b(file, timeout_seconds=0, return_mode=1, **summary_kwargs)
+            if 'error' in res:
+                record['status'] = 'error'
+            elif md5:
+                store.set(_summary_cache_key(md5, summary_kwargs), (res, time_dict))
+        record['time'] = time_dict
+        record['summary'] = res
+    except Exception as e:
+        record['status'] = 'error'
+        record['error'] = format_exception(e, 2)
+    record['elapsed'] = round(time.time() - start_time, 3)
+    return record
+
+
+def _summary_worker_main(conn, cache_file, max_memory_mb, summary_kwargs):
+    """ worker子进程的主循环，从管道接收文件路径，返回日志记录，收到None时退出 """
+    if max_memory_mb:
+        try:
+            import resource  # windows没有这个模块，不支持内存上限
+            limit = int(max_memory_mb * 1024 * 1024)
+            resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+        except (ImportError, ValueError, OSError):
+            pass
+
+    from pyxllib.prog.cachetools import SqliteMemoStore
+    store = SqliteMemoStore(cache_file) if cache_file else None
+    while True:
+        try:
+            file = conn.recv()
+        except EOFError:
+            break
+        if file is None:
+            break
+        conn.send(_summarize_one_file(file, store, summary_kwargs))
+
+
+class _SummaryWorker:
+    """ 主进程里对一个worker子进程的管理 """
+
+    def __init__(self, ctx, args):
+        self.ctx = ctx
+        self.args = args
+        self.file = None  # 正在处理的文件
+        self.start_time = self.deadline = None
+        self.start()
+
+    def start(self):
+        self.conn, child_conn = self.ctx.Pipe()
+        self.process = self.ctx.Process(target=_summary_worker_main, args=(child_conn, *self.args), daemon=True)
+        self.process.start()
+        child_conn.close()
+
+    def submit(self, file, path, timeout):
+        self.file = file
+        self.start_time = time.time()
+        self.deadline = self.start_time + timeout if timeout else math.inf
+        self.conn.send(str(path))
+
+    def restart(self):
+        """ 超时或崩溃的worker，直接杀掉重开 """
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+        self.start()
+
+    def close(self):
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+        self.process.join(1)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.conn.close()
+
+
+def _list_summary_files(src):
+    """ 获得要提取摘要的文件清单
+
+    :param src: 目录，或者jsonl格式的清单文件，每行是一个文件路径，或者含有file字段的dict
+    :return: (根目录, 文件相对路径清单)
+    """
+    src = XlPath(src)
+    if src.is_dir():
+        files = [f.relpath(src).as_posix() for f in src.rglob_files()
+                 if f.suffix.lower() in ('.xlsx', '.xlsm', '.xls', '.csv') and not f.name.startswith('~$')]
+        return src, sorted(files)
+
+    files = []
+    for x in src.read_jsonl():
+        files.append(x['file'] if isinstance(x, dict) else x)
+    return src.parent, files
+
+
+def batch_extract_workbook_summary3b(src, out_file=None, *,
+                                     max_workers=None,
+                                     timeout=60,
+                                     max_memory_mb=None,
+                                     cache_file=None,
+                                     print_mode=True,
+                                     **summary_kwargs):
+    """ 多进程批量提取表格摘要，结果按jsonl格式存储
+
+    >> batch_extract_workbook_summary3b('data/excels', max_workers=8, timeout=30, max_memory_mb=4096)
+    命令行: python -m pyxllib.file.xlsxlib batch_extract_workbook_summary3b data/excels --timeout=30
+
+    :param src: 存放表格的目录（会递归找xlsx、xlsm、xls、csv文件），或者jsonl格式的文件清单
+        清单里的相对路径，是相对清单文件所在目录
+    :param out_file: 结果文件，默认是src目录下的'_summary3b.jsonl'，或清单文件同目录下的'清单名_summary3b.jsonl'
+        每处理完一个文件就会追加写入，中断后再次运行，会跳过结果文件里已经有的文件
+        每条记录：{'file', 'status', 'md5', 'time', 'elapsed', 'summary'或'error'}，md5只在使用缓存时有
+        status有ok、cached、error、timeout、crash，后两种是worker被杀掉、意外退出的情况
+    :param max_workers: 进程数，默认cpu数
+    :param timeout: 每个文件的硬性时间上限（秒），超时会杀掉worker进程，0表示不限制
+    :param max_memory_mb: 每个worker进程的内存上限（MB），超出时这个文件会报MemoryError，仅支持linux等有resource模块的系统
+    :param cache_file: 摘要缓存的sqlite文件，以excel2md5为键，内容相同的表格不用重复提取，None表示不使用缓存
+    :param summary_kwargs: 传给extract_workbook_summary3b的其他参数，如summary_limit_len、enum_values
+        timeout_seconds、return_mode由这里控制，不能再传
+    :return dict: 本次运行的统计信息
+    """
+    import multiprocessing
+    import multiprocessing.connection
+    from collections import deque
+    from tqdm import tqdm
+    from pyxllib.file.specialist import StreamJsonlWriter
+    from pyxllib.prog.cachetools import SqliteMemoStore
+
+    reserved = {'timeout_seconds', 'return_mode'} & set(summary_kwargs)
+    if reserved:
+        raise ValueError(f'{reserved}由批处理自己控制，超时请用timeout参数')
+
+    # 1 文件清单、断点续传
+    root, files = _list_summary_files(src)
+    if out_file is None:
+        src = XlPath(src)
+        out_file = src / '_summary3b.jsonl' if src.is_dir() else src.with_name(f'{src.stem}_summary3b.jsonl')
+    out_file = XlPath(out_file)
+    done = set()
+    if out_file.is_file():
+        done = {x['file'] for x in out_file.read_jsonl()}
+    todo = deque(f for f in files if f not in done)
+
+    writer = StreamJsonlWriter(out_file, batch_size=1)
+    store = SqliteMemoStore(cache_file) if cache_file else None
+    elapsed_list = []
+    status_counter = Counter()
+    pbar = tqdm(total=len(todo), desc='提取摘要', disable=not print_mode)
+
+    def emit(file, record):
+        record = {'file': file, **record}
+        if isinstance(record.get('summary'), dict):  # 命中缓存时，摘要里是首次提取时的文件名
+            record['summary']['fileName'] = XlPath(file).name
+        writer.append_line(record)
+        elapsed_list.append(record.get('elapsed', 0))
+        status_counter[record['status']] += 1
+        pbar.update(1)
+
+    def get_cached(file):
+        """ 文件没变化、且缓存里有摘要的，主进程里就能直接拿到结果，不用派给worker """
+        try:
+            md5 = store.get(_file_stat_key(root / file))
+            res, time_dict = store.get(_summary_cache_key(md5, summary_kwargs))
+        except (KeyError, OSError):
+            return None
+        return {'status': 'cached', 'md5': md5, 'time': time_dict, 'summary': res, 'elapsed': 0}
+
+    # 2 调度worker
+    start_time = time.time()
+    workers = []
+    try:
+        if store is not None:
+            rest = deque()
+            for file in todo:
+                record = get_cached(file)
+                if record:
+                    emit(file, record)
+                else:
+                    rest.append(file)
+            todo = rest
+
+        ctx = multiprocessing.get_context()
+        n = min(max_workers or os.cpu_count() or 1, len(todo))
+        workers = [_SummaryWorker(ctx, (cache_file, max_memory_mb, summary_kwargs)) for _ in range(n)]
+        idle, busy = list(workers), {}  # busy: conn -> worker
+
+        while todo or busy:
+            while idle and todo:
+                w = idle.pop()
+                file = todo.popleft()
+                w.submit(file, root / file, timeout)
+                busy[w.conn] = w
+
+            wait_time = max(min(w.deadline for w in busy.values()) - time.time(), 0)
+            ready = multiprocessing.connection.wait(list(busy), None if wait_time == math.inf else wait_time)
+
+            for conn in ready:
+                w = busy.pop(conn)
+                try:
+                    record = conn.recv()
+                except (EOFError, OSError):
+                    record = {'status': 'crash', 'error': f'worker进程意外退出，exitcode={w.process.exitcode}',
+                              'elapsed': round(time.time() - w.start_time, 3)}
+                    w.restart()
+                emit(w.file, record)
+                idle.append(w)
+
+            now = time.time()
+            for conn, w in list(busy.items()):
+                if w.deadline <= now:
+                    del busy[conn]
+                    w.restart()
+                    emit(w.file, {'status': 'timeout', 'error': f'超时，未完成摘要提取：{timeout}秒',
+                                  'elapsed': round(now - w.start_time, 3)})
+                    idle.append(w)
+    finally:
+        for w in workers:
+            w.close()
+        writer.flush()
+        pbar.close()
+
+    # 3 统计
+    total_time = time.time() - start_time
+    stats = {'files': len(elapsed_list), 'skipped': len(done), 'total_time': round(total_time, 2),
+             'files_per_second': round(safe_div(len(elapsed_list), total_time), 2),
+             **dict(status_counter)}
+    if elapsed_list:
+        elapsed_list.sort()
+        for k, q in [('p50', 0.5), ('p95', 0.95), ('max', 1)]:
+            stats[f'elapsed_{k}'] = elapsed_list[min(int(len(elapsed_list) * q), len(elapsed_list) - 1)]
+    if print_mode:
+        print(stats)
+    return stats
+
+
+if __name__ == '__main__':
+    import fire
+
+    fire.Fire()
@@ -8,17 +8,55 @@
 我们自己的一套利用后端服务进行文件同步的工具
 """
 
+import concurrent.futures
 import os
+import re
+import threading
 import time
 
 from loguru import logger
 from tqdm import tqdm
 import requests
+from requests.adapters import HTTPAdapter
 
-from pyxllib.file.specialist import XlPath, GetEtag
+from pyxllib.file.specialist import XlPath, GetEtag, FileHashCache, DirManifest
+from pyxllib.prog.newbie import human_readable_size
 from pyxllib.prog.pupil import format_exception
 
 
+class _TransferStats:
+    """ 目录传输过程中的统计，多线程共享 """
+
+    def __init__(self, desc, total_bytes=None):
+        self.lock = threading.Lock()
+        self.files = self.skipped = self.failed = self.bytes = 0
+        self.start_time = time.time()
+        self.pbar = tqdm(total=total_bytes, desc=desc, unit='B', unit_scale=True, unit_divisor=1024)
+
+    def add_bytes(self, n):
+        with self.lock:
+            self.bytes += n
+        self.pbar.update(n)
+
+    def skip_bytes(self, n):
+        """ 续传时已经传过的部分，只更新进度条，不计入传输速度 """
+        self.pbar.update(n)
+
+    def add(self, name, n=1):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + n)
+
+    def report(self):
+        self.pbar.close()
+        elapsed = time.time() - self.start_time
+        speed = human_readable_size(self.bytes / elapsed) if elapsed else '-'
+        msg = (f'{self.pbar.desc}：传输{self.files}个文件，跳过{self.skipped}个，失败{self.failed}个，'
+               f'共{human_readable_size(self.bytes)}，用时{elapsed:.1f}秒，{speed}/s')
+        logger.info(msg)
+        return {'files': self.files, 'skipped': self.skipped, 'failed': self.failed,
+                'bytes': self.bytes, 'seconds': round(elapsed, 2)}
+
+
 class SyncFileClient:
     """
 
@@ -30,14 +68,23 @@ class SyncFileClient:
     def __1_basic(self):
         pass
 
-    def __init__(self, host, token=None):
+    def __init__(self, host, token=None, *, max_workers=8, chunk_size=8 * 1024 * 1024):
         """
         :param host: 可以只写主机名
+        :param max_workers: 目录上传、下载时的并发数，也是连接池的大小
+        :param chunk_size: 超过这个大小的文件，分块上传、下载，中断后可以续传
         """
         token = token or os.getenv("XL_COMMON_SERVER_TOKEN")
         self.headers = {
             'Authorization': f'Bearer {token}',
         }
+        self.max_workers = max_workers
+        self.chunk_size = chunk_size
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
         self.local_root = None
         self.remote_root = None
         self.host = self.link_host(host)
@@ -46,12 +93,12 @@ class SyncFileClient:
         from requests.exceptions import Timeout
 
         host = f'{os.getenv("MAIN_WEBSITE")}/{hostname}'
-        resp = requests.get(f'{host}/common/get_local_server', headers=self.headers)
+        resp = self.session.get(f'{host}/common/get_local_server')
         ip = resp.json()['ip']
 
         if ip:
             try:
-                resp = requests.get(f'{ip}/healthz', timeout=5)
+                resp = self.session.get(f'{ip}/healthz', timeout=5)
                 if resp.status_code == 200 and resp.json()['status'] == 'ok':
                     host = ip
             except Timeout:
@@ -59,7 +106,7 @@ class SyncFileClient:
             except Exception as e:
                 raise e
 
-        remote_root = requests.get(f'{host}/common/get_wkdir', headers=self.headers).json()['wkdir']
+        remote_root = self.session.get(f'{host}/common/get_wkdir').json()['wkdir']
         self.remote_root = XlPath(remote_root)
 
         return host
@@ -132,9 +179,11 @@ class SyncFileClient:
         files3 = [('files', (remote_file, open(local_file, 'rb'))) for local_file, remote_file in files2]
 
         # 4 发送请求
-        resp = requests.post(f'{self.host}/common/upload_files',
-                             headers=self.headers,
-                             files=files3)
+        try:
+            resp = self.session.post(f'{self.host}/common/upload_files', files=files3)
+        finally:
+            for _, (_, f) in files3:
+                f.close()
         return resp.json()
 
     def download_file(self, remote_file=None, local_file=None, relpath=True):
@@ -154,8 +203,7 @@ class SyncFileClient:
 
         data = {'file': remote_file.as_posix()}
         # 使用 stream=True 开启流式处理
-        with requests.post(f'{self.host}/common/download_file',
-                           headers=self.headers, json=data, stream=True) as resp:
+        with self.session.post(f'{self.host}/common/download_file', json=data, stream=True) as resp:
             if resp.status_code == 200:
                 # 以二进制方式写入文件
                 with open(local_file, 'wb') as f:
@@ -182,9 +230,7 @@ class SyncFileClient:
             return {'match': False}
         local_etag = GetEtag.from_file(local_file)
         json_data = {'file': remote_file.as_posix(), 'etag': local_etag}
-        resp = requests.post(f'{self.host}/common/check_file_etag',
-                             headers=self.headers,
-                             json=json_data)
+        resp = self.session.post(f'{self.host}/common/check_file_etag', json=json_data)
         return resp.json()
 
     def upload_dir(self,
@@ -193,13 +239,23 @@ class SyncFileClient:
                    *,
                    delete_local_file=False,
                    verify_etag=False,
-                   relpath=True):
+                   relpath=True,
+                   incremental=False,
+                   max_workers=None,
+                   retries=0,
+                   retry_interval=60):
         """
         :param local_dir: 本地目录
         :param remote_dir: 远程目录
         :param delete_local_file: 每个文件上传成功后，是否删除本地文件
             默认不删除，一般不删除是配合etag校验使用的
         :param verify_etag: 上传前是否校验etag，如果服务器上对应位置已经有对应etag的文件，其实就不用上传了
+            整个目录只请求一次远程清单进行比对，本地etag使用FileHashCache缓存
+        :param incremental: 用DirManifest记录上次成功上传时本地目录的状态，只上传之后新增、修改、重命名的文件
+            没有变化的文件只需要stat一遍，不用读取内容，也不用请求服务器
+        :param max_workers: 并发上传数，默认使用初始化时的配置
+        :param retries: 单个文件上传失败时的重试次数
+        :return dict: 传输统计
 
         该方法已修改以支持上传子目录和空目录
         """
@@ -209,24 +265,49 @@ class SyncFileClient:
             # /home/chenkunze/data/temp2
             remote_dir = self.get_abs_remote_path(remote_dir, local_dir)
 
-        for root, dirs, files in os.walk(local_dir):
-            # root拿到的是这样的绝对路径：D:\home\chenkunze\data\temp2\数值问题
-            # '数值问题'
-            subdir = XlPath(root).relpath(local_dir)
-            if not files and not dirs:
-                # 如果该目录为空，则在远程服务器上创建空目录
-                self.create_remote_dir(remote_dir / subdir, relpath=False)
-
-            for file in tqdm(files, desc=f'上传目录：{root}'):
-                local_path = local_dir / subdir / file
-                remote_path = remote_dir / subdir / file
-                if verify_etag and self.verify_etag(local_path, remote_path, relpath=False):
-                    pass  # 如果etag校验通过，跳过上传
-                else:
-                    self.upload_file(local_path, remote_path, relpath=False)
-
-                if delete_local_file:
-                    os.remove(local_path)
+        # 1 本地文件清单
+        files, empty_dirs = [], []
+        for root, dirs, names in os.walk(local_dir):
+            subdir = os.path.relpath(root, local_dir).replace(os.sep, '/')
+            subdir = '' if subdir == '.' else subdir
+            if not names and not dirs:
+                empty_dirs.append(subdir)
+            files += [f'{subdir}/{x}' if subdir else x for x in names]
+
+        for subdir in empty_dirs:
+            # 如果该目录为空，则在远程服务器上创建空目录
+            self.create_remote_dir(remote_dir / subdir, relpath=False)
+
+        # 2 跳过没有变化、远程已有相同etag的文件
+        skipped, local_etags, manifest = set(), None, None
+        if incremental:
+            manifest = DirManifest(local_dir, name=f'upload|{self.host}|{remote_dir.as_posix()}')
+            touched = set(DirManifest.touched_files(manifest.scan(save=False)))
+            skipped = {f for f in files if f not in touched}
+            local_etags = {f: x[2] for f, x in manifest.entries.items()}
+        if verify_etag and len(skipped) < len(files):
+            remote_files, _ = self.get_remote_manifest(remote_dir, relpath=False)
+            skipped |= self._match_etags(local_dir, remote_dir, [f for f in files if f not in skipped],
+                                         remote_files, local_etags)
+
+        # 3 并发上传
+        total_bytes = sum((local_dir / f).stat().st_size for f in files if f not in skipped)
+        stats = _TransferStats(f'上传目录：{local_dir}', total_bytes)
+        stats.add('skipped', len(skipped))
+
+        def upload(file):
+            local_file = local_dir / file
+            if file not in skipped:
+                self._retry(self._upload_one, local_file, remote_dir / file, stats,
+                            retries=retries, retry_interval=retry_interval)
+                stats.add('files')
+            if delete_local_file:
+                os.remove(local_file)
+
+        res = self._run_transfer(upload, files, stats, max_workers)
+        if manifest:  # 全部上传成功后，才更新清单
+            manifest.save()
+        return res
 
     def create_remote_dir(self, remote_dir, relpath=True):
         """
@@ -235,18 +316,19 @@ class SyncFileClient:
         if relpath:
             remote_dir = self.get_abs_remote_path(remote_dir)
         json_data = {'dir': remote_dir.as_posix()}
-        resp = requests.post(f'{self.host}/common/create_dir',
-                             headers=self.headers,
-                             json=json_data)
+        resp = self.session.post(f'{self.host}/common/create_dir', json=json_data)
         return resp.json()
 
-    def download_dir(self, remote_dir=None, local_dir=None, *, verify_etag=False, relpath=True):
+    def download_dir(self, remote_dir=None, local_dir=None, *, verify_etag=False, relpath=True,
+                     max_workers=None, retries=100, retry_interval=60):
         """
         下载远程目录到本地
         :param remote_dir: 远程目录路径，相对路径或绝对路径都支持
         :param local_dir: 本地保存目录，默认会自动映射到对应的远程位置
         :param verify_etag: 是否进行etag校验，跳过已经在本地存在并且未修改的文件
-        :return:
+        :param max_workers: 并发下载数，默认使用初始化时的配置
+        :param retries: 单个文件下载失败时的重试次数，开发机senseserver3好像不稳定，默认重试较多次
+        :return dict: 传输统计
 
         示例：
         sfc = SyncFileClient('codepc_mi15')
@@ -258,55 +340,31 @@ class SyncFileClient:
             remote_dir = self.get_abs_remote_path(remote_dir, local_dir)
 
         # 2. 从服务器获取远程目录的文件和子目录结构
-        json_data = {'dir': remote_dir.as_posix()}
-        resp = requests.post(f'{self.host}/common/list_dir', headers=self.headers, json=json_data)
-        if resp.status_code != 200:
-            raise Exception(f"Failed to list remote directory: {resp.text}")
-
-        dir_structure = resp.json()  # 期望返回格式为 {'dirs': [...], 'files': [...]}
+        remote_files, remote_dirs = self.get_remote_manifest(remote_dir, relpath=False)
 
         # 3. 创建本地目录
-        if not local_dir.exists():
-            local_dir.mkdir(parents=True)
+        for subdir in [''] + list(remote_dirs):
+            (local_dir / subdir).mkdir(parents=True, exist_ok=True)
 
-        # 4. 先处理子目录
-        for subdir in dir_structure.get('dirs', []):
-            local_subdir = local_dir / subdir
-            if not local_subdir.exists():
-                local_subdir.mkdir(parents=True)
+        # 4. 跳过本地已有相同etag的文件
+        files = list(remote_files)
+        skipped = set()
+        if verify_etag:
+            exists = [f for f in files if (local_dir / f).is_file()]
+            skipped = self._match_etags(local_dir, remote_dir, exists, remote_files)
 
-            # 递归下载子目录中的文件
-            for i in range(100):  # 开发机senseserver3好像不稳定，加了重试机制
-                try:
-                    self.download_dir(remote_dir / subdir, local_dir / subdir, verify_etag=verify_etag)
-                    break
-                except requests.exceptions.RequestException as e:
-                    logger.warning(format_exception(e, 3))
-                    time.sleep(60)
-                    continue
-            else:
-                raise requests.exceptions.RequestException
+        # 5. 并发下载文件
+        stats = _TransferStats(f'下载目录：{remote_dir}')
+        stats.add('skipped', len(skipped))
 
-        # 5. 下载文件
-        for file in tqdm(dir_structure.get('files', []), desc=f'下载目录：{remote_dir}'):
-            remote_file = remote_dir / file
-            local_file = local_dir / file
+        def download(file):
+            if file in skipped:
+                return
+            self._retry(self._download_one, remote_dir / file, local_dir / file, stats, remote_files[file],
+                        retries=retries, retry_interval=retry_interval)
+            stats.add('files')
 
-            for i in range(100):
-                try:
-                    # 校验etag，如果verify_etag为True并且校验成功，则跳过下载
-                    if verify_etag and self.verify_etag(local_file, remote_file, relpath=False)['match']:
-                        break
-
-                    # 下载文件
-                    logger.info(f'下载文件中：{local_file}')
-                    self.download_file(remote_file, local_file, relpath=False)
-                    break
-                except requests.exceptions.RequestException:
-                    time.sleep(60)
-                    continue
-            else:
-                raise requests.exceptions.RequestException
+        return self._run_transfer(download, files, stats, max_workers)
 
     def download_path(self, remote_path=None, local_path=None, *, verify_etag=False, relpath=True):
         """
@@ -323,7 +381,7 @@ class SyncFileClient:
 
         # 判断是文件还是目录
         json_data = {'path': remote_path.as_posix()}
-        resp = requests.post(f'{self.host}/common/check_path_type', headers=self.headers, json=json_data)
+        resp = self.session.post(f'{self.host}/common/check_path_type', json=json_data)
 
         if resp.status_code != 200:
             raise Exception(f"Failed to check remote path type: {resp.text}")
@@ -339,3 +397,210 @@ class SyncFileClient:
                               verify_etag=verify_etag, relpath=False)
         else:
             raise ValueError(f"Unknown path type: {path_info['type']}")
+
+    def __3_transfer(self):
+        """ 目录级传输用到的底层功能
+
+        需要服务端支持以下接口，旧版服务端没有的接口，会自动退化到原来逐个文件的处理方式
+        dir_manifest：{'dir'} -> {'files': {相对路径: etag}, 'dirs': [相对路径]}，一次拿到整个目录树
+        upload_status：{'file'} -> {'size'}，分块上传时服务端已收到的字节数
+        upload_chunk：表单{'file', 'offset', 'total'} + 文件块'chunk'，收齐total字节后服务端完成文件写入
+            offset跟服务端已收到的字节数对不上时，返回409和{'size'}
+        download_file：支持Range请求头，返回206时是从指定位置开始的续传内容，并带上Content-Range
+            最好也支持If-Range，文件已经变化时返回200和完整内容
+        """
+        pass
+
+    def _list_dir(self, remote_dir):
+        json_data = {'dir': remote_dir.as_posix()}
+        resp = self.session.post(f'{self.host}/common/list_dir', json=json_data)
+        if resp.status_code != 200:
+            raise Exception(f"Failed to list remote directory: {resp.text}")
+        return resp.json()  # 期望返回格式为 {'dirs': [...], 'files': [...]}
+
+    def get_remote_manifest(self, remote_dir=None, relpath=True):
+        """ 获得远程目录下所有文件的清单
+
+        :return: (files, dirs)
+            files: {相对remote_dir的文件路径: etag}，服务端不支持dir_manifest时，etag都是None
+            dirs: [相对remote_dir的子目录路径, ...]
+        """
+        if relpath:
+            remote_dir = self.get_abs_remote_path(remote_dir)
+
+        resp = self.session.post(f'{self.host}/common/dir_manifest', json={'dir': remote_dir.as_posix()})
+        if resp.status_code == 200:
+            data = resp.json()
+            return data['files'], data.get('dirs', [])
+        elif resp.status_code not in (404, 405):
+            raise Exception(f"Failed to get remote manifest: {resp.text}")
+
+        # 旧版服务端，多线程逐层list_dir
+        files, dirs = {}, []
+        level = ['']
+        with concurrent.futures.ThreadPoolExecutor(self.max_workers) as executor:
+            while level:
+                next_level = []
+                for subdir, data in zip(level, executor.map(lambda d: self._list_dir(remote_dir / d), level)):
+                    for x in data.get('files', []):
+                        files[f'{subdir}/{x}' if subdir else x] = None
+                    for x in data.get('dirs', []):
+                        x = f'{subdir}/{x}' if subdir else x
+                        dirs.append(x)
+                        next_level.append(x)
+                level = next_level
+        return files, dirs
+
+    def _match_etags(self, local_dir, remote_dir, files, remote_files, local_etags=None):
+        """ 找出本地、远程内容一致的文件
+
+        :param files: 要比较的相对路径清单，本地需要都存在
+        :param remote_files: get_remote_manifest得到的远程清单
+        :param local_etags: 已知的本地etag {相对路径: etag}，比如DirManifest里的记录，没有的才需要计算
+        :return set: etag一致的相对路径
+        """
+        files = [f for f in files if f in remote_files]
+        known = [f for f in files if remote_files[f] is not None]
+        unknown = [f for f in files if remote_files[f] is None]
+
+        matched = set()
+        if known:
+            if local_etags is not None and all(f in local_etags for f in known):
+                etags = [local_etags[f] for f in known]
+            else:
+                etags = FileHashCache().get_hashes([local_dir / f for f in known], threads_num=self.max_workers)
+            matched = {f for f, etag in zip(known, etags) if etag == remote_files[f]}
+        if unknown:  # 远程清单没有etag，只能逐个文件请求校验
+            with concurrent.futures.ThreadPoolExecutor(self.max_workers) as executor:
+                res = executor.map(lambda f: self.verify_etag(local_dir / f, remote_dir / f, relpath=False), unknown)
+                matched |= {f for f, x in zip(unknown, res) if x.get('match')}
+        return matched
+
+    def _upload_one(self, local_file, remote_file, stats):
+        """ 上传单个文件，大文件分块上传，支持续传 """
+        size = local_file.stat().st_size
+        remote = remote_file.as_posix()
+        if size > self.chunk_size:
+            resp = self.session.post(f'{self.host}/common/upload_status', json={'file': remote})
+            if resp.status_code == 200:
+                offset = resp.json()['size']
+                offset = offset if offset <= size else 0
+                stats.skip_bytes(offset)
+                with open(local_file, 'rb') as f:
+                    while offset < size:
+                        f.seek(offset)
+                        data = f.read(self.chunk_size)
+                        resp = self.session.post(f'{self.host}/common/upload_chunk',
+                                                 data={'file': remote, 'offset': offset, 'total': size},
+                                                 files={'chunk': ('chunk', data)})
+                        if resp.status_code == 409:  # 跟服务端的进度对不上，按服务端的进度继续
+                            offset2 = resp.json()['size']
+                            stats.skip_bytes(offset2 - offset)
+                            offset = offset2
+                            continue
+                        resp.raise_for_status()
+                        offset += len(data)
+                        stats.add_bytes(len(data))
+                return
+            elif resp.status_code not in (404, 405):
+                resp.raise_for_status()
+
+        res = self.upload_files([[local_file, remote_file]], relpath=False)
+        stats.add_bytes(size)
+        return res
+
+    def _download_one(self, remote_file, local_file, stats, etag=None):
+        """ 下载单个文件，先写到.part临时文件，中断后再次下载时用Range请求续传
+
+        :param etag: 远程清单里的etag，用来确认.part是不是同一版本文件的前半段
+
+        .part旁边会存一个.part.etag记录其版本，续传时带上If-Range，
+        版本对不上或者无从确认时，都从头重新下载，避免把新旧两个版本的内容拼在一起
+        """
+        part_file = local_file.with_name(local_file.name + '.part')
+        etag_file = local_file.with_name(local_file.name + '.part.etag')
+
+        def restart():
+            for f in (part_file, etag_file):
+                if f.is_file():
+                    os.remove(f)
+
+        # 1 确认.part能否续传
+        offset, part_etag = 0, None
+        if part_file.is_file():
+            part_etag = etag_file.read_text() if etag_file.is_file() else None
+            if part_etag and (etag is None or part_etag == etag):
+                offset = part_file.stat().st_size
+            else:
+                restart()
+
+        # 2 请求数据
+        headers = {'Range': f'bytes={offset}-', 'If-Range': part_etag} if offset else {}
+        data = {'file': remote_file.as_posix()}
+        with self.session.post(f'{self.host}/common/download_file',
+                               json=data, headers=headers, stream=True) as resp:
+            content_range = resp.headers.get('Content-Range', '')
+            m = re.match(r'bytes (?:(\d+)-\d+|\*)/(\d+)', content_range)
+            if resp.status_code == 416:  # 之前其实已经下载完了
+                total = int(m.group(2)) if m else offset
+            elif resp.status_code in (200, 206):
+                if resp.status_code == 206:
+                    if m and m.group(1) is not None and int(m.group(1)) != offset:
+                        restart()
+                        raise requests.exceptions.HTTPError(f'续传位置不对，已清除.part重新下载：{remote_file}')
+                    total = int(m.group(2)) if m else None
+                    mode = 'ab'
+                else:  # 服务端不支持Range，或者If-Range判断文件已变化时，会返回完整内容
+                    total = resp.headers.get('Content-Length')
+                    total = int(total) if total and not resp.headers.get('Content-Encoding') else None
+                    mode = 'wb'
+                    version = etag or resp.headers.get('ETag')
+                    if version:
+                        etag_file.write_text(version)
+                    elif etag_file.is_file():
+                        os.remove(etag_file)
+                with open(part_file, mode) as f:
+                    for chunk in resp.iter_content(chunk_size=1024 * 1024):
+                        if chunk:  # 忽略keep-alive的空块
+                            f.write(chunk)
+                            stats.add_bytes(len(chunk))
+            else:
+                raise requests.exceptions.HTTPError(f'下载失败，状态码{resp.status_code}：{remote_file}')
+
+        # 3 大小对得上才算下载完成
+        size = part_file.stat().st_size if part_file.is_file() else 0
+        if total is not None and size != total:
+            if size > total:
+                restart()
+            raise requests.exceptions.HTTPError(f'下载不完整，{size}/{total}字节：{remote_file}')
+        os.replace(part_file, local_file)
+        if etag_file.is_file():
+            os.remove(etag_file)
+
+    @classmethod
+    def _retry(cls, func, *args, retries=0, retry_interval=60):
+        for i in range(retries + 1):
+            try:
+                return func(*args)
+            except requests.exceptions.RequestException as e:
+                if i == retries:
+                    raise
+                logger.warning(format_exception(e, 3))
+                time.sleep(retry_interval)
+
+    def _run_transfer(self, func, files, stats, max_workers=None):
+        """ 并发执行目录里每个文件的传输，全部结束后汇报统计，有失败的文件时抛出异常 """
+        failed = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers or self.max_workers) as executor:
+            futures = {executor.submit(func, f): f for f in files}
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    future.result()
+                except requests.exceptions.RequestException as e:
+                    stats.add('failed')
+                    failed.append(futures[future])
+                    logger.warning(f'{futures[future]}：{format_exception(e, 1)}')
+        res = stats.report()
+        if failed:
+            raise requests.exceptions.RequestException(f'{len(failed)}个文件传输失败：{failed[:5]}')
+        return res
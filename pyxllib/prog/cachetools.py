@@ -5,8 +5,16 @@
 # @Date   : 2024/05/29
 
 # 对于普通函数，一般用lru_cache即可
-from functools import lru_cache
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from functools import wraps
+import hashlib
+import os
+import pickle
+import sqlite3
+import tempfile
 import threading
+import time
 
 from cachetools import cached, LRUCache, TTLCache
 
@@ -21,18 +29,31 @@ from cached_property import threaded_cached_property_with_ttl  # 线程 + 限时
 
 # 进一步封装的更通用、自己常用的装饰器
 
-def xlcache(maxsize=128, *, ttl=None, lock=None, property=False):
+def xlcache(maxsize=128, *, ttl=None, lock=None, property=False,
+            backend=None, path=None, max_bytes=None):
     """ 那些工具接口太复杂难记，自己封装一个统一的工具
 
     就是一个装饰器，最大缓存多少项，然后是否要开多线程安全，是否要设置限时重置，是否是作为类成员属性修饰
 
     :param property: 是否作为类成员属性修饰，不过一般不建议通过这里设置，
         而是外部再加一层@property，不然IDE会识别不了这是一个property，影响开发
+    :param backend: 默认None，使用cachetools的内存缓存
+        设置后使用memoize记忆化缓存，可以跨进程、持久化，详见get_memo_store
+            memory: 内存LRU
+            sqlite: 存储在一个sqlite文件里
+            pickle: 一个目录下，每个结果存成一个pkl文件
+    :param path: sqlite、pickle后端的存储位置
+    :param max_bytes: 缓存的最大字节数，超出时按LRU规则淘汰
 
+    >> @xlcache(backend='sqlite', ttl=3600, max_bytes=1024 ** 3)
+    >> def ocr(image_file): ...
     """
 
     def decorator(func):
-        if property:
+        if backend is not None:
+            store = get_memo_store(backend, path=path, maxsize=maxsize, ttl=ttl, max_bytes=max_bytes)
+            return memoize(store)(func)
+        elif property:
             if ttl is not None:
                 if lock:
                     # 使用带有时间限制和线程安全的缓存属性
@@ -56,3 +77,278 @@ def xlcache(maxsize=128, *, ttl=None, lock=None, property=False):
                 return cached(cache, lock=lock2)(func)
 
     return decorator
+
+
+def make_args_key(func, args=(), kwargs=None):
+    """ 根据函数和调用参数生成缓存键
+
+    参数能pickle的时候按pickle序列化的内容计算，否则退化为按repr计算
+    """
+    prefix = func if isinstance(func, str) else f'{func.__module__}.{func.__qualname__}'
+    items = (args, sorted((kwargs or {}).items()))
+    try:
+        data = pickle.dumps(items, protocol=4)
+    except Exception:
+        data = repr(items).encode('utf8')
+    return hashlib.sha1(prefix.encode('utf8') + b'\0' + data).hexdigest()
+
+
+class MemoStore(ABC):
+    """ memoize的存储后端基类
+
+    get找不到或已过期时抛出KeyError，并统计命中情况
+    """
+
+    def __init__(self, ttl=None, max_bytes=None):
+        """
+        :param ttl: 缓存有效期，单位秒
+        :param max_bytes: 缓存的最大字节数（按pickle后的大小计算），超出时淘汰最久没使用的条目
+        """
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    def _expired(self, created):
+        return self.ttl is not None and time.time() - created > self.ttl
+
+    @abstractmethod
+    def get(self, key):
+        pass
+
+    @abstractmethod
+    def set(self, key, value):
+        pass
+
+    @abstractmethod
+    def clear(self):
+        pass
+
+    def info(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+class MemoryMemoStore(MemoStore):
+    """ 内存LRU，线程安全 """
+
+    def __init__(self, maxsize=128, ttl=None, max_bytes=None):
+        super().__init__(ttl, max_bytes)
+        self.maxsize = maxsize
+        self.data = OrderedDict()  # key: (value, nbytes, created)
+        self.nbytes = 0
+        self.lock = threading.RLock()
+
+    def get(self, key):
+        with self.lock:
+            if key in self.data:
+                value, nbytes, created = self.data[key]
+                if not self._expired(created):
+                    self.data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                self._pop(key)
+            self.misses += 1
+            raise KeyError(key)
+
+    def _pop(self, key):
+        self.nbytes -= self.data.pop(key)[1]
+
+    def set(self, key, value):
+        nbytes = len(pickle.dumps(value)) if self.max_bytes else 0
+        with self.lock:
+            if key in self.data:
+                self._pop(key)
+            self.data[key] = (value, nbytes, time.time())
+            self.nbytes += nbytes
+            while self.data and ((self.maxsize and len(self.data) > self.maxsize)
+                                 or (self.max_bytes and self.nbytes > self.max_bytes)):
+                self._pop(next(iter(self.data)))
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.nbytes = 0
+
+    def info(self):
+        return {**super().info(), 'count': len(self.data), 'bytes': self.nbytes}
+
+
+class SqliteMemoStore(MemoStore):
+    """ 存储在一个sqlite文件里，多个进程可以共享同一份缓存 """
+
+    def __init__(self, path=None, ttl=None, max_bytes=None):
+        super().__init__(ttl, max_bytes)
+        self.path = str(path or os.path.join(tempfile.gettempdir(), 'pyxllib_memo.sqlite3'))
+        self._conn, self._pid = None, None
+
+    @property
+    def conn(self):
+        # sqlite连接不能跨进程使用，fork出的子进程要重新连接
+        if self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS memo (key TEXT PRIMARY KEY, value BLOB, '
+                               'nbytes INTEGER, created REAL, accessed REAL)')
+            self._conn.commit()
+            self._pid = os.getpid()
+        return self._conn
+
+    def get(self, key):
+        row = self.conn.execute('SELECT value, created FROM memo WHERE key=?', (key,)).fetchone()
+        if row and not self._expired(row[1]):
+            self.conn.execute('UPDATE memo SET accessed=? WHERE key=?', (time.time(), key))
+            self.conn.commit()
+            self.hits += 1
+            return pickle.loads(row[0])
+        self.misses += 1
+        raise KeyError(key)
+
+    def set(self, key, value):
+        from pyxllib.prog.filelock import XlFileLock
+
+        data = pickle.dumps(value)
+        now = time.time()
+        with XlFileLock(_lock_name(self.path)):
+            conn = self.conn
+            conn.execute('INSERT OR REPLACE INTO memo VALUES (?, ?, ?, ?, ?)', (key, data, len(data), now, now))
+            if self.ttl is not None:
+                conn.execute('DELETE FROM memo WHERE created < ?', (now - self.ttl,))
+            if self.max_bytes:
+                total = conn.execute('SELECT COALESCE(SUM(nbytes), 0) FROM memo').fetchone()[0]
+                if total > self.max_bytes:
+                    drop = []
+                    for k, nbytes in conn.execute('SELECT key, nbytes FROM memo ORDER BY accessed'):
+                        if total <= self.max_bytes:
+                            break
+                        drop.append((k,))
+                        total -= nbytes
+                    conn.executemany('DELETE FROM memo WHERE key=?', drop)
+            conn.commit()
+
+    def clear(self):
+        self.conn.execute('DELETE FROM memo')
+        self.conn.commit()
+
+    def info(self):
+        count, nbytes = self.conn.execute('SELECT COUNT(*), COALESCE(SUM(nbytes), 0) FROM memo').fetchone()
+        return {**super().info(), 'count': count, 'bytes': nbytes}
+
+
+class PickleDirMemoStore(MemoStore):
+    """ 一个目录下，每个缓存结果存成一个pkl文件，文件的mtime记录最近使用时间 """
+
+    def __init__(self, path=None, ttl=None, max_bytes=None):
+        super().__init__(ttl, max_bytes)
+        self.path = str(path or os.path.join(tempfile.gettempdir(), 'pyxllib_memo'))
+        os.makedirs(self.path, exist_ok=True)
+
+    def _file(self, key):
+        return os.path.join(self.path, key + '.pkl')
+
+    def get(self, key):
+        file = self._file(key)
+        try:
+            with open(file, 'rb') as f:
+                created, value = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            pass
+        else:
+            if not self._expired(created):
+                os.utime(file)
+                self.hits += 1
+                return value
+        self.misses += 1
+        raise KeyError(key)
+
+    def set(self, key, value):
+        from pyxllib.prog.filelock import XlFileLock
+
+        file = self._file(key)
+        tmp_file = f'{file}.{os.getpid()}.tmp'
+        with open(tmp_file, 'wb') as f:
+            pickle.dump((time.time(), value), f)
+        os.replace(tmp_file, file)  # 原子替换，其他进程不会读到写了一半的文件
+
+        if self.max_bytes or self.ttl is not None:
+            with XlFileLock(_lock_name(self.path)):
+                self._evict()
+
+    def _evict(self):
+        files = []
+        for entry in os.scandir(self.path):
+            if entry.name.endswith('.pkl'):
+                st = entry.stat()
+                files.append((st.st_mtime, st.st_size, entry.path))
+        files.sort()
+
+        total = sum(x[1] for x in files)
+        for mtime, size, file in files:
+            # mtime是最近使用时间，比创建时间晚，所以按mtime判断过期只会少删，get时还会再精确判断
+            if (self.max_bytes and total > self.max_bytes) or self._expired(mtime):
+                try:
+                    os.remove(file)
+                except OSError:
+                    pass
+                total -= size
+
+    def clear(self):
+        for entry in os.scandir(self.path):
+            if entry.name.endswith('.pkl'):
+                os.remove(entry.path)
+
+    def info(self):
+        sizes = [entry.stat().st_size for entry in os.scandir(self.path) if entry.name.endswith('.pkl')]
+        return {**super().info(), 'count': len(sizes), 'bytes': sum(sizes)}
+
+
+def _lock_name(path):
+    """ 每个存储位置对应一个文件锁，用于跨进程的写入、淘汰操作 """
+    return 'pyxllib_memo_' + hashlib.md5(str(path).encode('utf8')).hexdigest()[:16] + '.lock'
+
+
+def get_memo_store(backend='memory', *, path=None, maxsize=128, ttl=None, max_bytes=None):
+    """
+    :param backend: 'memory'、'sqlite'、'pickle'，也可以直接传入一个MemoStore实例
+    """
+    if isinstance(backend, MemoStore):
+        return backend
+    elif backend == 'memory':
+        return MemoryMemoStore(maxsize, ttl, max_bytes)
+    elif backend == 'sqlite':
+        return SqliteMemoStore(path, ttl, max_bytes)
+    elif backend == 'pickle':
+        return PickleDirMemoStore(path, ttl, max_bytes)
+    else:
+        raise ValueError(f'不支持的缓存后端：{backend}')
+
+
+def memoize(store='memory', key_func=None):
+    """ 按调用参数缓存函数结果的装饰器
+
+    :param store: MemoStore实例，或get_memo_store支持的后端名称
+    :param key_func: 自定义缓存键的函数，def key_func(func, args, kwargs) -> str，默认使用make_args_key
+
+    被修饰的函数会附带cache、cache_info、cache_clear属性
+    注意多个进程同时算同一个参数时不会互相等待，各自算完后都会写入缓存，以后写入的为准
+    """
+    store = get_memo_store(store)
+    key_func = key_func or make_args_key
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            key = key_func(func, args, kwargs)
+            try:
+                return store.get(key)
+            except KeyError:
+                pass
+            value = func(*args, **kwargs)
+            store.set(key, value)
+            return value
+
+        wrapper.cache = store
+        wrapper.cache_info = store.info
+        wrapper.cache_clear = store.clear
+        return wrapper
+
+    return decorator
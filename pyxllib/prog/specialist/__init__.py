@@ -11,6 +11,7 @@ from pyxllib.prog.specialist.browser import *
 from pyxllib.prog.specialist.bc import *
 from pyxllib.prog.specialist.tictoc import *
 from pyxllib.prog.specialist.datetime import *
+from pyxllib.prog.specialist.xlexecutor import *
 
 import concurrent.futures
 import os
@@ -43,8 +44,7 @@ def mtqdm(func, iterable, *args, max_workers=1, check_per_seconds=0.01, **kwargs
         因为对我个人来说，大部分时候需要严谨地分析性能，得到整体平均速度，而不是预估当前速度
     :param mininterval: 官方默认值是0.1，表示显示更新间隔秒数
         这里不用那么频繁，每秒更新就行了~~
-    :param check_per_seconds: 每隔多少秒检查队列
-        有些任务，这个值故意设大一点，可以减少频繁的队列检查时间，提高运行速度
+    :param check_per_seconds: 已弃用，现在用XlExecutor有界提交，不再需要轮询队列
     整体功能类似Iterate
     """
 
@@ -57,37 +57,14 @@ def mtqdm(func, iterable, *args, max_workers=1, check_per_seconds=0.01, **kwargs
         for x in tqdm(iterable, *args, **kwargs):
             func(x)
     else:
-        # 2 默认的多线程运行机制，出错是不会暂停的；这里对原函数功能进行封装，增加报错功能
-        error = False
-
-        def wrap_func(x):
-            nonlocal error
-            try:
-                func(x)
-            except Exception as e:
-                error = e
-
-        # 3 多线程/多进程 和 进度条 功能的结合
-        if max_workers > 1:
-            executor = concurrent.futures.ThreadPoolExecutor(max_workers)
-            for x in tqdm(iterable, *args, **kwargs):
-                while executor._work_queue.qsize():
-                    if check_per_seconds:
-                        time.sleep(check_per_seconds)
-                executor.submit(wrap_func, x)
-                if error:
-                    raise error
+        # 2 多线程/多进程 和 进度条 功能的结合，出错时会停止提交新任务并在这里抛出异常
+        if max_workers is None or max_workers > 1:
+            executor = XlExecutor(max_workers, 'thread')
         else:
-            executor = concurrent.futures.ProcessPoolExecutor(-max_workers)
-            for x in tqdm(iterable, *args, **kwargs):
-                # while executor._call_queue.pending_work_items:
-                #     if check_per_seconds:
-                #         time.sleep(check_per_seconds)
-                executor.submit(wrap_func, x)
-                if error:
-                    raise error
-
-        executor.shutdown()
+            executor = XlExecutor(-max_workers, 'process')
+        if 'total' not in kwargs and hasattr(iterable, '__len__'):
+            kwargs['total'] = len(iterable)
+        executor.run(func, iterable, pbar=tqdm(None, *args, **kwargs))
 
 
 def estimate_package_size(package):
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# @Author : 陈坤泽
+# @Email  : 877362867@qq.com
+# @Date   : 2026/10/16
+
+""" 有界提交的并发执行器
+
+concurrent.futures的executor.submit是不限量的，任务多的时候，要么一口气把所有任务塞进队列撑爆内存，
+要么像以前mtqdm那样轮询私有的_work_queue.qsize()做流控，白白占用一个cpu。
+这里用"同时在跑的任务数上限"来做背压：达到上限时阻塞等待最早的任务完成，再提交新任务。
+"""
+
+import asyncio
+import concurrent.futures
+from contextlib import ExitStack
+import os
+import threading
+
+from more_itertools import chunked
+from tqdm import tqdm
+
+from pyxllib.prog.pupil import format_exception
+
+
+def _call_chunk(func, chunk, error_mode='raise'):
+    """ 在worker里处理一块数据
+
+    :return list: error_mode='raise'时是结果列表，出错直接抛出异常，由future传回主进程
+        否则是[(是否成功, 结果或报错信息), ...]
+    """
+    if error_mode == 'raise':
+        return [func(x) for x in chunk]
+
+    res = []
+    for x in chunk:
+        try:
+            res.append((True, func(x)))
+        except Exception as e:
+            res.append((False, format_exception(e)))
+    return res
+
+
+async def _acall_chunk(func, chunk, error_mode='raise'):
+    """ _call_chunk的协程版本，func是async函数 """
+    if error_mode == 'raise':
+        return [await func(x) for x in chunk]
+
+    res = []
+    for x in chunk:
+        try:
+            res.append((True, await func(x)))
+        except Exception as e:
+            res.append((False, format_exception(e)))
+    return res
+
+
+class XlExecutor:
+    """ 有界提交的并发执行器，支持多线程、多进程、协程三种后端
+
+    >> ex = XlExecutor(8)
+    >> for y in ex.map(func, items, pbar=True): ...  # 按输入顺序返回结果
+    >> ex.run(func, items, ordered=False)  # 只需要执行，不需要结果
+
+    多进程后端使用joblib的loky进程池，func可以是lambda、闭包等普通pickle不支持的函数，
+    子进程里的报错会带着完整的traceback传回主进程。
+    """
+
+    def __init__(self, max_workers=None, backend='thread', *,
+                 max_inflight=None, chunk_size=1, error_mode='raise'):
+        """
+        :param int max_workers: 并发数，None时线程用min(32, cpu+4)，进程用cpu数，协程用100
+            负数跟joblib的n_jobs规则一致，表示 cpu_count+1+n
+        :param str backend: thread、process、asyncio
+            asyncio后端的func要是async函数，会在一个后台线程的事件循环里运行，max_workers是协程并发上限
+        :param int max_inflight: 同时提交在跑的任务块上限，默认是并发数的2倍（协程后端默认等于并发数）
+        :param int chunk_size: 每个任务打包几条数据，func很轻量时设大一些，能大幅减少调度开销
+        :param str error_mode: func报错时的处理方式
+            raise（默认）: 停止提交新任务，在主线程抛出异常
+            skip: 该条结果为None，报错记录在self.errors里，[(序号, 报错信息), ...]
+        """
+        self.backend = backend
+        if max_workers is not None and max_workers < 0:
+            max_workers = max((os.cpu_count() or 1) + 1 + max_workers, 1)
+        if max_workers is None:
+            max_workers = {'thread': min(32, (os.cpu_count() or 1) + 4),
+                           'process': os.cpu_count() or 1,
+                           'asyncio': 100}[backend]
+        self.max_workers = max_workers
+        # 线程、进程池里多排队一些任务，worker做完一个能马上接下一个；协程提交了就会立即开始运行
+        self.max_inflight = max_inflight or (max_workers if backend == 'asyncio' else max_workers * 2)
+        self.chunk_size = chunk_size
+        self.error_mode = error_mode
+        self.errors = []
+
+    def _make_submit(self, stack):
+        """ 返回一个 submit(func, chunk) -> concurrent.futures.Future 的函数 """
+        if self.backend == 'thread':
+            executor = stack.enter_context(concurrent.futures.ThreadPoolExecutor(self.max_workers))
+            return lambda func, chunk: executor.submit(_call_chunk, func, chunk, self.error_mode)
+        elif self.backend == 'process':
+            from joblib.externals.loky import get_reusable_executor
+            executor = get_reusable_executor(max_workers=self.max_workers)
+            return lambda func, chunk: executor.submit(_call_chunk, func, chunk, self.error_mode)
+        elif self.backend == 'asyncio':
+            loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=loop.run_forever, daemon=True)
+            thread.start()
+
+            def close_loop():
+                loop.call_soon_threadsafe(loop.stop)
+                thread.join()
+                loop.close()
+
+            stack.callback(close_loop)
+            return lambda func, chunk: asyncio.run_coroutine_threadsafe(_acall_chunk(func, chunk, self.error_mode),
+                                                                        loop)
+        else:
+            raise ValueError(f'不支持的backend：{self.backend}')
+
+    def _unpack(self, start, results):
+        """ 把一个任务块的结果展开成逐条结果 """
+        if self.error_mode == 'raise':
+            return results
+
+        values = []
+        for i, (ok, value) in enumerate(results):
+            if ok:
+                values.append(value)
+            else:
+                self.errors.append((start + i, value))
+                values.append(None)
+        return values
+
+    def map(self, func, iterable, *, ordered=True, pbar=None, total=None):
+        """ 并发执行func，返回结果的生成器
+
+        :param ordered: 是否按输入顺序返回结果，False时按完成的先后顺序返回，能更早拿到结果
+        :param pbar: 进度条，可以传入一个tqdm对象，或者True自动创建一个
+        :param total: 自动创建进度条时的总数，默认尝试取len(iterable)
+        """
+        if pbar is True:
+            if total is None and hasattr(iterable, '__len__'):
+                total = len(iterable)
+            pbar = tqdm(total=total)
+
+        with ExitStack() as stack:
+            if pbar is not None:
+                stack.callback(pbar.close)
+            submit = self._make_submit(stack)
+            pending = {}  # future -> (起始序号, 条目数)，dict会保留提交的先后顺序
+
+            def pop_done():
+                if ordered:
+                    futures = [next(iter(pending))]
+                else:
+                    futures, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                values = []
+                for future in futures:
+                    start, n = pending.pop(future)
+                    try:
+                        values += self._unpack(start, future.result())
+                    except BaseException:
+                        for f in pending:
+                            f.cancel()
+                        raise
+                    if pbar is not None:
+                        pbar.update(n)
+                return values
+
+            start = 0
+            for chunk in chunked(iterable, self.chunk_size):
+                pending[submit(func, chunk)] = (start, len(chunk))
+                start += len(chunk)
+                if len(pending) >= self.max_inflight:
+                    yield from pop_done()
+
+            while pending:
+                yield from pop_done()
+
+    def run(self, func, iterable, *, ordered=False, pbar=None, total=None):
+        """ 只执行不收集结果，返回处理的条目数 """
+        n = 0
+        for _ in self.map(func, iterable, ordered=ordered, pbar=pbar, total=total):
+            n += 1
+        return n
@@ -5,12 +5,12 @@
 # @Date   : 2020/09/18 22:16
 
 import os
-import concurrent.futures
 import math
 import time
+import random
 import sys
 
-from pyxllib.prog.pupil import EmptyPoolExecutor, format_exception
+from pyxllib.prog.pupil import format_exception
 from pyxllib.text.pupil import shorten
 
 XLLOG_CONF_FILE = 'xllog.yaml'
@@ -65,6 +65,54 @@ def get_xllog(name='xllog', *, log_file=None):
     return logging.getLogger('pyxllib.' + name)
 
 
+def _call_iterate_item(func, data, show_item=False):
+    """ Iterate在worker里处理一个条目
+
+    :return: (序号, 耗时, 条目描述, 报错信息, 异常对象)，没报错时后两项是None
+    """
+    i, item = data
+    t = time.perf_counter()
+    try:
+        func(item)
+        err, exc = None, None
+    except Exception as e:
+        err, exc = format_exception(e), e
+    desc = str(item) if (show_item or err) else None
+    return i, time.perf_counter() - t, desc, err, exc
+
+
+async def _acall_iterate_item(func, data, show_item=False):
+    """ _call_iterate_item的协程版本 """
+    i, item = data
+    t = time.perf_counter()
+    try:
+        await func(item)
+        err, exc = None, None
+    except Exception as e:
+        err, exc = format_exception(e), e
+    desc = str(item) if (show_item or err) else None
+    return i, time.perf_counter() - t, desc, err, exc
+
+
+def _format_latencies(latencies):
+    """ 耗时的p50、p90、p99分位数描述 """
+    if not latencies:
+        return ''
+    values = sorted(latencies)
+    ps = [values[min(len(values) - 1, int(len(values) * p / 100))] for p in (50, 90, 99)]
+    return '，延迟p50/p90/p99：' + '/'.join(f'{v * 1000:.1f}' for v in ps) + 'ms'
+
+
+def _reservoir_add(samples, value, n, k=10000):
+    """ 蓄水池抽样，samples最多保留k个值，n是包括value在内已经见过的值的个数 """
+    if len(samples) < k:
+        samples.append(value)
+    else:
+        j = random.randrange(n)
+        if j < k:
+            samples[j] = value
+
+
 class Iterate:
     """ 迭代器类，用来封装一些特定模式的for循环操作
 
@@ -74,26 +122,38 @@ class Iterate:
         不过后来想想，这个其实就是排列组合，在itertools里有combinations, permutations可以代替
         甚至有放回的组合也有combinations_with_replacement，我实在是不需要再这里写这些冗余的功能
         所以就移除了
+
+    261016周五，items不再预先转成tuple，可以是未知长度的惰性迭代器，
+        并发部分改用XlExecutor有界提交，不再轮询队列占用一个cpu
     """
 
-    def __init__(self, items):
-        # 没有总长度倒也能接受，关键是可能要用start、end切片，所以还是先转成tuple更方便操作
-        self.items = tuple(items)
-        self.n_items = len(self.items)
-        self.format_width = math.ceil(math.log10(self.n_items + 1))
+    def __init__(self, items, total=None):
+        """
+        :param items: 可迭代对象，可以是生成器等惰性数据
+        :param total: 条目总数，默认尝试取len(items)，取不到时进度日志里不显示百分比
+        """
+        self.items = items
+        if total is None and hasattr(items, '__len__'):
+            total = len(items)
+        self.n_items = total
+        self.format_width = math.ceil(math.log10(self.n_items + 1)) if self.n_items else 1
         self.xllog = get_xllog()
 
     def _format_pinterval(self, pinterval=None):
         if isinstance(pinterval, str) and pinterval.endswith('%'):
             # 百分比的情况，重算出间隔元素数
-            return int(round(self.n_items * float(pinterval[:-1]) / 100))
+            if self.n_items is None:
+                self.xllog.warning(f'未知条目总数，无法按百分比{pinterval}输出进度，请设置total参数')
+                return None
+            return max(int(round(self.n_items * float(pinterval[:-1]) / 100)), 1)
         else:  # 其他格式暂不解析，按原格式处理
             return pinterval
 
     def _step1_check_number(self, pinterval, func):
         if pinterval:
             sys.stdout.flush()  # 让逻辑在前的标准输出先print出来，但其实这句也不一定能让print及时输出的~~可能会被日志提前抢输出了
-            self.xllog.info(f"使用 {func.__name__} 处理 {self.n_items} 个数据 {shorten(str(self.items), 30)}")
+            n = '?' if self.n_items is None else self.n_items
+            self.xllog.info(f"使用 {func.__name__} 处理 {n} 个数据 {shorten(str(self.items), 30)}")
 
     def _step2_check_range(self, start, end):
         if start:
@@ -104,77 +164,101 @@ class Iterate:
             # 这里空格是为了对齐，别删
             self.xllog.info(f"使用 end 参数，只处理<{end}的条目")
         else:
-            end = len(self.items)
+            end = self.n_items  # 可能是None，即迭代到数据结束
         return start, end
 
-    def _step3_executor(self, pinterval, max_workers):
-        if max_workers == 1:
-            # workers=1，实际上并不用多线程，用一个假的多线程类代替，能大大提速
-            executor = EmptyPoolExecutor()
-            # executor = concurrent.futures.ThreadPoolExecutor(max_workers)
+    def _step3_executor(self, pinterval, max_workers, backend):
+        """ 返回 map(func, iterable) -> 结果生成器 的函数 """
+        if max_workers == 1 and backend == 'thread':
+            # workers=1，实际上并不用多线程，直接在当前线程串行执行，能大大提速，也方便调试
+            return lambda func, iterable: map(func, iterable)
+
+        from pyxllib.prog.specialist.xlexecutor import XlExecutor
+        executor = XlExecutor(max_workers, backend)
+        if pinterval:
+            name = {'thread': '线程', 'process': '进程', 'asyncio': '协程'}[backend]
+            self.xllog.info(f'并发执行，当前迭代所用{name}数：{executor.max_workers}')
+        # 乱序返回结果，先完成的先统计，进度日志能反映实时情况
+        return lambda func, iterable: executor.map(func, iterable, ordered=False)
+
+    def _step4_report(self, done, total, pinterval, start_time, latencies, desc=None):
+        span = time.time() - start_time
+        speed = f'，速度：{done / span:.2f}it/s' if span else ''
+        if total:
+            progress = f'{done:{self.format_width}d}/{total}={done / total:6.2%}'
         else:
-            executor = concurrent.futures.ThreadPoolExecutor(max_workers)
-            if pinterval:
-                self.xllog.info(f'多线程执行，当前迭代所用线程数：{executor._max_workers}')
-        return executor
-
-    def _step4_iter(self, i, pinterval, executor):
-        # 队列中没有新任务时，才放入新任务，这样能确保pinterval的输出能反应实时情况，而不是一下全部进入队列，把for循环跑完了
-        while executor._work_queue.qsize(): pass
-        if pinterval and (i or pinterval == 1) and i % pinterval == 0:
-            message = f' {self.items[i]}' if pinterval == 1 else ''
-            self.xllog.info(f'{i:{self.format_width}d}/{self.n_items}={i / self.n_items:6.2%}{message}')
-
-    def _step5_finish(self, pinterval, interrupt, start_time):
+            progress = f'{done:{self.format_width}d}/?'
+        message = f' {desc}' if pinterval == 1 and desc else ''
+        self.xllog.info(f'{progress}{speed}{_format_latencies(latencies)}{message}')
+
+    def _step5_finish(self, pinterval, interrupt, start_time, done, latencies):
         from humanfriendly import format_timespan
         end_time = time.time()
         span = end_time - start_time
         if span:
-            speed = self.n_items / span
+            speed = done / span
             msg = f'总用时：{format_timespan(span)}，速度：{speed:.2f}it/s'
         else:
             msg = f'总用时：{format_timespan(span)}'
+        msg += _format_latencies(latencies)
         if not interrupt and pinterval:
-            self.xllog.info(f'{self.n_items / self.n_items:6.2%} 完成迭代，{msg}')
+            self.xllog.info(f'{1:6.2%} 完成迭代{done}条，{msg}')
             sys.stderr.flush()
 
-    def run(self, func, start=0, end=None, pinterval=None, max_workers=1, interrupt=True):
+    def run(self, func, start=0, end=None, pinterval=None, max_workers=1, interrupt=True, *, backend='thread'):
         """
         :param func: 对每个item执行的功能
         :param start: 跳过<start的数据，只处理>=start编号以上
         :param end: 只处理 < end 的数据
         :param pinterval: 每隔多少条目输出进度日志，默认不输出进度日志（但是错误日志依然会输出）
-            支持按百分比进度显示，例如每20%，pinterval='20%'，不过一些底层实现机制原因，会有些许误差
+            支持按百分比进度显示，例如每20%，pinterval='20%'，需要能知道条目总数
+            进度日志里会附带整体速度，以及最近这段条目耗时的p50/p90/p99分位数
             TODO 支持按指定时间间隔显示？ 例如每15秒，pinterval='15s' 感觉这种功能太花哨了，没必要搞
         :param max_workers: 默认线程数，默认1，即串行
         :type max_workers: int, None
-        :param interrupt: 出现错误时是否中断，默认True会终止程序，否则只会输出错误日志
+        :param interrupt: 出现错误时是否中断，默认True会停止提交新任务并抛出异常，否则只会输出错误日志
+        :param backend: 并发后端，thread、process、asyncio，见XlExecutor
+            asyncio时func要是async函数
         :return:
         """
+        import functools
+        import itertools
 
         # 1 统一的参数处理部分
         pinterval = self._format_pinterval(pinterval)
         self._step1_check_number(pinterval, func)
         start, end = self._step2_check_range(start, end)
-        error = False
-        executor = self._step3_executor(pinterval, max_workers)
-
-        # 2 封装的子处理部分
-        def wrap_func(func, i):
-            nonlocal error
-            item = self.items[i]
-            try:
-                func(item)
-            except Exception as e:
-                error = e
-                self.xllog.error(f'💔idx={i}运行出错：{item}\n{format_exception(e)}')
+        total = None
+        if self.n_items is not None:
+            total = max(min(end, self.n_items) - start, 0)
+        map_func = self._step3_executor(pinterval, max_workers, backend)
+
+        # 2 封装的子处理部分，worker只负责执行和计时，统计、日志都在主线程里做
+        call = _acall_iterate_item if backend == 'asyncio' else _call_iterate_item
+        wrap_func = functools.partial(call, func, show_item=pinterval == 1)
+        data = itertools.islice(enumerate(self.items), start, end)
 
         # 3 执行迭代
         start_time = time.time()
-        for i in range(start, end):
-            self._step4_iter(i, pinterval, executor)
-            executor.submit(wrap_func, func, i)
-            if interrupt and error:
-                raise error
-        executor.shutdown()  # 必须等executor结束，error才是准确的
-        self._step5_finish(pinterval, interrupt and error, start_time)
+        done, error = 0, None
+        # 最近一段的耗时、整体的耗时，都用蓄水池抽样，避免条目很多时内存无限增长
+        window, samples = [], []
+        results = map_func(wrap_func, data)
+        try:
+            for i, latency, desc, err, exc in results:
+                done += 1
+                if pinterval:  # 不输出进度日志时，用不到最近一段的耗时
+                    _reservoir_add(window, latency, (done - 1) % pinterval + 1)
+                _reservoir_add(samples, latency, done)
+                if err:
+                    error = exc
+                    self.xllog.error(f'💔idx={i}运行出错：{desc}\n{err}')
+                    if interrupt:
+                        raise exc
+                if pinterval and done % pinterval == 0:
+                    self._step4_report(done, total, pinterval, start_time, window, desc)
+                    window = []
+        finally:
+            if hasattr(results, 'close'):
+                results.close()  # 出错中断时，停止提交新任务，等已提交的任务结束
+        self._step5_finish(pinterval, interrupt and error, start_time, done, samples)
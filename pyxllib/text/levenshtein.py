@@ -19,7 +19,8 @@ import Levenshtein
 import numpy as np
 import pandas as pd
 
-from pyxllib.prog.pupil import run_once
+from pyxllib.prog.pupil import run_once, check_install_package
+from pyxllib.algo.matcher import LevenshteinIndex, sparse_agglomerative_clustering, sparse_cluster_groups
 from pyxllib.prog.specialist import dataframe_str
 from pyxllib.text.pupil import briefstr
 
@@ -68,6 +69,7 @@ class MatchSimString:
         self.origin_str = []  # 原始字符串内容
         self.key_str = []  # 对原始字符串进行处理后的字符
         self.ext_value = []  # 扩展存储一些信息
+        self._index = None  # key_str的LevenshteinIndex，数据变动后置空
 
     def __getitem__(self, item):
         return self.origin_str[item]
@@ -76,6 +78,7 @@ class MatchSimString:
         del self.origin_str[item]
         del self.key_str[item]
         del self.ext_value[item]
+        self._index = None
 
     def __len__(self):
         return len(self.key_str)
@@ -90,29 +93,35 @@ class MatchSimString:
             k = self.preproc(k)
         self.key_str.append(k)
         self.ext_value.append(v)
+        self._index = None
+
+    @property
+    def index(self):
+        """ 候选字符串的倒排索引，用来剪枝，避免每次都跟所有候选计算编辑距离 """
+        if self._index is None or len(self._index) != len(self.key_str):
+            self._index = LevenshteinIndex(self.key_str)
+        return self._index
 
     def match(self, s):
         """ 跟候选字符串进行匹配，返回最佳匹配结果
         """
-        idx, sim = -1, 0
-        for i in range(len(self)):
-            k, v = self.key_str[i], self.ext_value[i]
-            sim_ = Levenshtein.ratio(k, s)
-            if sim_ > sim:
-                sim = sim_
-                idx = i
-            i += 1
-        return idx, sim
+        res = self.index.query(s, 1)
+        if res and res[0][1] > 0:
+            return res[0]
+        return -1, 0
 
-    def match_many(self, s, count=1):
+    def match_many(self, s, count=1, *, score_cutoff=0):
         """跟候选字符串进行匹配，返回多个最佳匹配结果
         :param str s: 待匹配的字符串
         :param int count: 需要返回的匹配数量
+        :param float score_cutoff: 只返回相似度>=score_cutoff的结果
         :return: 匹配结果列表，列表中的元素为(idx, sim)对
         """
-        scores = [(i, Levenshtein.ratio(self.key_str[i], s)) for i in range(len(self))]
-        # 根据相似度排序并返回前count个结果
-        return sorted(scores, key=lambda x: x[1], reverse=True)[:count]
+        return self.index.query(s, count, score_cutoff)
+
+    def match_many_batch(self, strs, count=1, *, score_cutoff=0, max_workers=1, pbar=None):
+        """ 批量版的match_many，max_workers!=1时用多进程并行 """
+        return self.index.query_batch(strs, count, score_cutoff, max_workers=max_workers, pbar=pbar)
 
     def match_test(self, s, count=-1, showstr=lambda x: x[:50]):
         """输入一个字符串s，和候选项做近似匹配
@@ -147,12 +156,20 @@ class MatchSimString:
         s = s.replace('\u2022', '')  # texstudio无法显示会报错的字符
         print(s)
 
-    def agglomerative_clustering(self, threshold=0.5):
+    def agglomerative_clustering(self, threshold=0.5, *, sparse=False, max_workers=1):
         """ 对内部字符串进行层次聚类
 
         :param threshold: 可以理解成距离的阈值，距离小于这个阈值的字符串会被聚为一类
             值越小，分出的类别越多越细
+        :param sparse: 用倒排索引只计算相似度>1-threshold的稀疏图来聚类，距离没有并列值时结果跟稠密矩阵一致，
+            内存跟边数成正比，数据量大时用
+        :param max_workers: sparse模式下计算相似度图的进程数
         """
+        if sparse:
+            index = LevenshteinIndex(self.key_str, q=LevenshteinIndex.suggest_q(1 - threshold))
+            rows, cols, sims = index.similarity_graph(1 - threshold, max_workers=max_workers)
+            return sparse_agglomerative_clustering(len(self), rows, cols, sims, threshold, linkage='complete')
+
         check_install_package('sklearn', 'scikit-learn')
         from sklearn.cluster import AgglomerativeClustering
 
@@ -216,14 +233,24 @@ class HierarchicalMatchSimString(MatchSimString):
         center_idx = max(indices, key=lambda x: sum(get_similarity(x, y) for y in indices))
         return center_idx
 
-    def merge_group(self, indices, threshold=0.5, strategy='center'):
+    def merge_group(self, indices, threshold=0.5, strategy='center', *, sparse=False, max_workers=1):
         """ 对输入的indexs清单，按照threshold的阈值进行合并
         返回的是一个字典，key是代表性样本，value是同组内的数据编号
 
         :param strategy: 代表样本的挑选策略
             center，中心样本
             first，第一个样本
+        :param sparse: 用倒排索引只计算相似度>1-threshold的稀疏图来聚类，距离没有并列值时结果跟稠密矩阵一致，
+            内存跟边数成正比，不再需要n*n的距离矩阵
+        :param max_workers: sparse模式下计算相似度图的进程数
         """
+        if sparse:
+            index = LevenshteinIndex([self.key_str[i] for i in indices],
+                                     q=LevenshteinIndex.suggest_q(1 - threshold))
+            rows, cols, sims = index.similarity_graph(1 - threshold, max_workers=max_workers)
+            labels = sparse_agglomerative_clustering(len(indices), rows, cols, sims, threshold, linkage='complete')
+            return sparse_cluster_groups(indices, labels, rows, cols, sims, strategy)
+
         check_install_package('sklearn', 'scikit-learn')
         from sklearn.cluster import AgglomerativeClustering
 
@@ -266,11 +293,13 @@ class HierarchicalMatchSimString(MatchSimString):
 
         return result
 
-    def init_groups(self, threshold=0.5, batch_size=1000):
+    def init_groups(self, threshold=0.5, batch_size=1000, *, sparse=False, max_workers=1):
         """
         :param threshold: 按照阈值进行分组，在这个距离内的都会归到一组
         :param batch_size: 因为数据可能太大，不可能一次性全量两两比较，这里可以分batch处理
             这样虽然结果不太精确，但能大大减小运算量
+            sparse模式的内存跟边数成正比，batch_size可以设得很大，甚至一次性处理全部数据
+        :param sparse, max_workers: 传给merge_group
         """
         # 1 最开始每个样本都是一个组
         groups = {i: [i] for i in range(len(self))}
@@ -280,7 +309,7 @@ class HierarchicalMatchSimString(MatchSimString):
         while len(groups) > 1:
             for indices in chunked(groups.keys(), batch_size):
                 # 对于这里返回的字典，原groups里的values也要对应拼接的
-                indices2 = self.merge_group(indices, threshold=threshold)
+                indices2 = self.merge_group(indices, threshold=threshold, sparse=sparse, max_workers=max_workers)
                 for idx, idxs in indices2.items():
                     # 获取原始分组中的索引
                     original_idxs = [groups[original_idx] for original_idx in idxs]
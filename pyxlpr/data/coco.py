@@ -31,6 +31,7 @@ import pathlib
 import random
 import sys
 
+import numpy as np
 import pandas as pd
 import PIL
 from tqdm import tqdm
@@ -39,7 +40,7 @@ from pyxllib.file.packlib.zipfile import ZipFile
 from pyxllib.prog.newbie import round_int
 from pyxllib.prog.pupil import DictTool
 from pyxllib.prog.specialist import mtqdm
-from pyxllib.algo.pupil import Groups, make_index_function, matchpairs
+from pyxllib.algo.pupil import Groups, make_index_function, matchpairs, matchpairs_matrix
 from pyxllib.algo.geo import rect_bounds, rect2polygon, reshape_coords, ltrb2xywh, xywh2ltrb, ComputeIou
 from pyxllib.algo.stat import write_dataframes_to_excel
 from pyxllib.file.specialist import PathGroups, XlPath
@@ -987,6 +988,36 @@ class CocoParser(CocoEval):
         mtqdm(func, list(gt_anns.groupby('image_id').__iter__()), 'create labelme gt jsons', max_workers=max_workers)
 
 
+def _match_image_boxes(gt_rows, gt_boxes, dt_rows, dt_boxes):
+    """ 一张图上gt、dt框的贪心匹配
+
+    :param gt_rows: 这张图的gt框在gt_anns里的行号
+    :param gt_boxes: 对应的ltrb框，n*4
+    :return: (gt_idxs, dt_idxs, ious) 匹配表里这张图每一行对应的gt、dt行号，没有对应项时是-1
+        先按gt顺序存每个gt及其匹配的dt，再按顺序存剩余未匹配的dt
+    """
+    n, m = len(gt_rows), len(dt_rows)
+    dt_of_gt, ious = np.full(n, -1), np.zeros(n)
+    if n and m:
+        for i, j, score in matchpairs_matrix(ComputeIou.ltrb_matrix(gt_boxes, dt_boxes)):
+            dt_of_gt[i], ious[i] = j, score
+    used = np.zeros(m, dtype=bool)
+    used[dt_of_gt[dt_of_gt >= 0]] = True
+    rest = np.flatnonzero(~used)
+
+    matched = np.full(n, -1)
+    matched[dt_of_gt >= 0] = dt_rows[dt_of_gt[dt_of_gt >= 0]]
+
+    gt_idxs = np.concatenate([gt_rows, np.full(len(rest), -1)])
+    dt_idxs = np.concatenate([matched, dt_rows[rest]])
+    return gt_idxs, dt_idxs, np.concatenate([ious, np.zeros(len(rest))])
+
+
+def _match_images_chunk(chunk):
+    """ 多进程时，每个进程处理一批图片 """
+    return [_match_image_boxes(*x) for x in chunk]
+
+
 class CocoMatchBase:
     def __init__(self, match_df):
         """ match_df匹配表格相关算法
@@ -997,19 +1028,19 @@ class CocoMatchBase:
         self.match_anns = match_df
 
     def n_gt_box(self):
-        return sum([x != -1 for x in self.match_anns['gt_category_id']])
+        return int((self.match_anns['gt_category_id'] != -1).sum())
 
     def n_dt_box(self):
-        return sum([x != -1 for x in self.match_anns['dt_category_id']])
+        return int((self.match_anns['dt_category_id'] != -1).sum())
 
     def n_match_box(self, iou=0.5):
         """ 不小于iou的框匹配到的数量 """
-        return sum(self.match_anns['iou'] >= iou)
+        return int((self.match_anns['iou'] >= iou).sum())
 
     def n_matchcat_box(self, iou=0.5):
         """ 不仅框匹配到，类别也对应的数量 """
         df = self.match_anns
-        return sum(((df['iou'] >= iou) & (df['gt_category_id'].eq(df['dt_category_id']))))
+        return int(((df['iou'] >= iou) & (df['gt_category_id'].eq(df['dt_category_id']))).sum())
 
     def get_clsmatch_arr(self, iou=0.5):
         """ 返回不小于iou下，框匹配的gt、dt对应的类别编号矩阵arr1, arr2 """
@@ -1060,141 +1091,140 @@ class CocoMatchBase:
 
 
 class CocoMatch(CocoParser, CocoMatchBase):
-    def __init__(self, gt, dt=None, *, min_score=0, eval_im=True, print_mode=False):
+    def __init__(self, gt, dt=None, *, min_score=0, eval_im=True, max_workers=1, print_mode=False):
         """ coco格式相关分析工具，dt不输入也行，当做没有任何识别结果处理~~
 
         :param min_score: 滤除dt中score小余min_score的框
         :param eval_im: 是否对每张图片计算coco分数
+        :param max_workers: gt、dt框匹配时的进程数，见_get_match_anns_df
         """
         # 因为这里 CocoEval、_CocoMatchBase 都没有父级，不会出现初始化顺序混乱问题
         #   所以我直接指定类初始化顺序了，没用super
         CocoParser.__init__(self, gt, dt, min_score=min_score)
-        match_anns = self._get_match_anns_df(print_mode=print_mode)
+        match_anns = self._get_match_anns_df(max_workers=max_workers, print_mode=print_mode)
         CocoMatchBase.__init__(self, match_anns)
         self.images = self._get_match_images_df(eval_im=eval_im, print_mode=print_mode)
         self.categories = self._get_match_categories_df()
 
-    def _get_match_anns_df(self, *, print_mode=False):
+    def _get_match_anns_df(self, *, max_workers=1, print_mode=False):
         """ 将结果的dt框跟gt的框做匹配，注意iou非常低的情况也会匹配上
 
+        :param max_workers: 进程数，默认1在当前进程计算
+            一般图片的框不多时，单进程就够快了，多进程启动、传数据的开销反而更大；每张图有成百上千个框时再开
+
+        gt、dt只转换一次成按image_id排序的numpy数组和偏移表，每张图向量化算出iou矩阵再贪心匹配，
+        最后按行号一次性取出gt、dt的各列拼成匹配表，不再逐行iloc
+
         TODO 有些框虽然没匹配到，但并不是没有iou，只是被其他iou更高的框抢掉了而已，可以考虑新增一个实际最大iou值列
         TODO 这里有个隐患，我找不到的框是用-1的类id来标记。但如果coco数据里恰好有个-1标记的类，就暴雷了~~
         TODO 210512周三11:27，目前新增扩展了label，这个是采用白名单机制加的，后续是可以考虑用黑名单机制来设定
         """
-        from tqdm import tqdm
-
-        # 1 读取数据
-        gt_df, dt_df = self.gt_anns.groupby('image_id'), self.dt_anns.groupby('image_id')
+        from pyxllib.prog.specialist import XlExecutor
 
-        # 2 初始化
-        records = []
+        # 1 初始化列名和没有配对项时填充的默认值
+        gt_anns, dt_anns = self.gt_anns.reset_index(drop=True), self.dt_anns.reset_index(drop=True)
         gt_columns = ['gt_box_id', 'gt_category_id', 'gt_ltrb', 'gt_area']
-        ext = set(self.gt_anns.keys()) - set(gt_columns + ['image_id'])
+        ext = set(gt_anns.keys()) - set(gt_columns + ['image_id', 'label'])
         gt_columns += list(ext)
-        gt_default = [-1, -1, '', 0] + [None] * len(ext)  # 没有配对项时填充的默认值
-        if 'label' in self.gt_anns.columns:
+        gt_default = [-1, -1, '', 0] + [None] * len(ext)
+        if 'label' in gt_anns.columns:
             gt_columns.append('label')
             gt_default.append('')
 
         dt_columns = ['dt_category_id', 'dt_ltrb', 'dt_score', 'dt_segmentation']
-        ext = set(self.dt_anns.keys()) - set(dt_columns + ['image_id', 'iscrowd', 'area', 'id'])
+        ext = set(dt_anns.keys()) - set(dt_columns + ['image_id', 'iscrowd', 'area', 'id'])
         dt_columns += list(ext)
-        dt_default = [-1, '', 0] + [None] * len(ext)
+        dt_default = [-1, '', 0] + [None] * (len(ext) + 1)
 
         columns = ['image_id'] + gt_columns + ['iou'] + dt_columns
 
-        def gt_msg(x=None):
-            if x is None:
-                return [image_id] + gt_default
-            else:
-                return [image_id] + [x[k] for k in gt_columns]
-
-        def dt_msg(y=None, iou_score=0):
-            if y is None:
-                return [0] + dt_default
-            else:
-                return [round(iou_score, 4)] + [y[k] for k in dt_columns]
-
-        # 3 遍历匹配
-        for image_id, image in tqdm(self.images.iterrows(),
-                                    f'_get_match_anns_df, groups={len(self.images)}', disable=not print_mode):
-            # 3.1 计算匹配项
-            # gt和dt关于某张图都有可能没有框
-            # 比如合同检测，有的图可能什么类别对象都没有，gt中这张图本来就没有box；dt检测也是，某张图不一定有结果
-            gt_group_df = gt_df.get_group(image_id) if image_id in gt_df.groups else []
-            dt_group_df = dt_df.get_group(image_id) if image_id in dt_df.groups else []
-            n, m = len(gt_group_df), len(dt_group_df)
-
-            pairs = []
-            if n and m:
-                # 任意多边形相交面积算法速度太慢
-                # gt_bboxes = [ShapelyPolygon.gen(b) for b in gt_group_df['gt_ltrb']]  # noqa 已经用if做了判断过滤
-                # dt_bboxes = [ShapelyPolygon.gen(b) for b in dt_group_df['dt_ltrb']]  # noqa
-                # pairs = matchpairs(gt_bboxes, dt_bboxes, ComputeIou.polygon2, index=True)
-
-                # 改成ltrb的相交面积算法会快一点
-                # gt_bboxes = [ShapelyPolygon.gen(b) for b in gt_group_df['gt_ltrb']]  # noqa 已经用if做了判断过滤
-                # dt_bboxes = [ShapelyPolygon.gen(b) for b in dt_group_df['dt_ltrb']]  # noqa
-                pairs = matchpairs(gt_group_df['gt_ltrb'].to_list(), dt_group_df['dt_ltrb'].to_list(),
-                                   ComputeIou.ltrb, index=True)
-
-            # 3.2 按gt顺序存入每条信息
-            dt_ids = set(range(m))
-            match_ids = {p[0]: (p[1], p[2]) for p in pairs}
-            for i in range(n):
-                x = gt_group_df.iloc[i]
-                if i in match_ids:
-                    # 3.2.1 gt与dt匹配的box
-                    j, iou_score = match_ids[i]
-                    dt_ids.remove(j)
-                    records.append(gt_msg(x) + dt_msg(dt_group_df.iloc[j], iou_score))
-                else:
-                    # 3.2.2 有gt没有对应dt的box
-                    records.append(gt_msg(x) + dt_msg())
-
-            # 3.2.3 还有剩余未匹配到的dt也要记录
-            for j in dt_ids:
-                records.append(gt_msg() + dt_msg(dt_group_df.iloc[j]))
-
-        # 4 保存结果
-        return pd.DataFrame.from_records(records, columns=columns)
+        # 2 按images的顺序，把gt、dt框转成numpy数组，并算出每张图的框在数组里的区间
+        def sort_by_image(df, ltrb_column):
+            # 不在images里的框不参与匹配
+            codes = self.images.index.get_indexer(df['image_id']) if len(df) else np.zeros(0, dtype=int)
+            rows = np.flatnonzero(codes >= 0)
+            rows = rows[np.argsort(codes[rows], kind='stable')]  # 同一张图内保持原来的顺序
+            boxes = np.array(df[ltrb_column].to_list(), dtype=float).reshape(-1, 4)
+            offsets = np.concatenate([[0], np.cumsum(np.bincount(codes[rows], minlength=len(self.images)))])
+            return rows, boxes, offsets
+
+        gt_rows, gt_boxes, gt_offsets = sort_by_image(gt_anns, 'gt_ltrb')
+        dt_rows, dt_boxes, dt_offsets = sort_by_image(dt_anns, 'dt_ltrb')
+
+        tasks = []
+        for k in range(len(self.images)):
+            gi = gt_rows[gt_offsets[k]:gt_offsets[k + 1]]
+            di = dt_rows[dt_offsets[k]:dt_offsets[k + 1]]
+            if len(gi) or len(di):
+                # gt和dt关于某张图都有可能没有框，都没有的图不产生记录
+                tasks.append((k, (gi, gt_boxes[gi], di, dt_boxes[di])))
+
+        # 3 每张图计算匹配项
+        if max_workers == 1:
+            results = (_match_image_boxes(*x) for _, x in tasks)
+        else:
+            chunks = [[x for _, x in tasks[i:i + 256]] for i in range(0, len(tasks), 256)]
+            results = (r for rs in XlExecutor(max_workers, 'process').map(_match_images_chunk, chunks) for r in rs)
+        image_codes, gt_idxs, dt_idxs, ious = [], [], [], []
+        for (k, _), (gi, di, iou) in tqdm(zip(tasks, results), f'_get_match_anns_df, groups={len(self.images)}',
+                                          total=len(tasks), disable=not print_mode):
+            image_codes.append(np.full(len(gi), k))
+            gt_idxs.append(gi)
+            dt_idxs.append(di)
+            ious.append(iou)
+
+        # 4 按行号一次性取出各列，-1行号映射到末尾追加的默认值行
+        def take(df, columns, default, idxs):
+            df = df.reindex(columns=columns)
+            df = pd.concat([df, pd.DataFrame([default], columns=columns)], ignore_index=True)
+            idxs = np.where(idxs >= 0, idxs, len(df) - 1)
+            return df.iloc[idxs].reset_index(drop=True)
+
+        def concat(arrs, dtype):
+            return np.concatenate(arrs).astype(dtype) if arrs else np.zeros(0, dtype=dtype)
+
+        image_codes, ious = concat(image_codes, int), concat(ious, float)
+        match_df = pd.concat([pd.DataFrame({'image_id': self.images.index[image_codes]}),
+                              take(gt_anns, gt_columns, gt_default, concat(gt_idxs, int)),
+                              pd.DataFrame({'iou': ious.round(4)}),
+                              take(dt_anns, dt_columns, dt_default, concat(dt_idxs, int))], axis=1)
+        return match_df[columns]
 
     def _get_match_images_df(self, *, eval_im=True, print_mode=False):
         """ 在原有images基础上，扩展一些图像级别的识别结果情况数据 """
         # 1 初始化，新增字段
-        images, match_anns = self.images.copy(), self.match_anns.groupby('image_id')
+        images, df = self.images.copy(), self.match_anns
         columns = ['coco_score', 'n_gt_box', 'n_dt_box', 'n_match0.5_box', 'n_matchcat0.5_box', 'f1_micro0.5',
                    'ic13_score']
         for c in columns:
             images[c] = -1.0
 
-        # 2 填写扩展字段的值
-        for image_id in tqdm(images.index, '_get_match_images_df', disable=not print_mode):
-            # 2.1 跳过不存在的图
-            if image_id not in match_anns.groups:
-                continue
-            df = match_anns.get_group(image_id)
-
-            # 2.2 增加每张图片的coco分数
-            if eval_im:
+        # 2 框数量、多分类分数这些可以对整张匹配表分组聚合算出来
+        # 单标签多分类的micro f1值就是准确率，所以不用对每张图调sklearn
+        match = df['iou'] >= 0.5
+        stats = pd.DataFrame({'n_gt_box': df['gt_category_id'] != -1,
+                              'n_dt_box': df['dt_category_id'] != -1,
+                              'n_match0.5_box': match,
+                              'n_matchcat0.5_box': match & df['gt_category_id'].eq(df['dt_category_id'])})
+        stats = stats.groupby(df['image_id']).sum()
+        f1 = (stats['n_matchcat0.5_box'] / stats['n_match0.5_box'].where(stats['n_match0.5_box'] > 0)).round(4)
+        stats['f1_micro0.5'] = f1.fillna(-1)
+        stats = stats[stats.index.isin(images.index)]
+        images.loc[stats.index, stats.columns] = stats.astype(float)
+
+        # 3 coco分数、ic13分数只能每张图单独计算
+        if eval_im:
+            match_anns = df.groupby('image_id')
+            for image_id in tqdm(stats.index, '_get_match_images_df', disable=not print_mode):
                 images.loc[image_id, 'coco_score'] = self.eval([image_id])
 
-            # 2.3 增加每张图片的多分类分数
-            m = CocoMatchBase(df)
-            images.loc[image_id, 'n_gt_box'] = m.n_gt_box()
-            images.loc[image_id, 'n_dt_box'] = m.n_dt_box()
-            images.loc[image_id, 'n_match0.5_box'] = m.n_match_box(0.5)
-            images.loc[image_id, 'n_matchcat0.5_box'] = m.n_matchcat_box(0.5)
-            images.loc[image_id, 'f1_micro0.5'] = m.f1_score('micro', 0.5)
-
-            # 2.4 增加每张图片的ic13分数
-            # df要先按category_id分组，多个ltrb值存成list
-            if eval_im:
+                # df要先按category_id分组，多个ltrb值存成list
+                im_df = match_anns.get_group(image_id)
                 gt, dt = dict(), dict()
-                for key, items in df.groupby('gt_category_id'):
+                for key, items in im_df.groupby('gt_category_id'):
                     if key != -1:
                         gt[key] = list(items['gt_ltrb'])
-                for key, items in df.groupby('dt_category_id'):
+                for key, items in im_df.groupby('dt_category_id'):
                     if key != -1:
                         dt[key] = list(items['dt_ltrb'])
                 images.loc[image_id, 'ic13_score'] = IcdarEval(gt, dt).icdar2013()['hmean']
@@ -8,8 +8,12 @@
 #Description: Evaluation script that computes Text Localization following the Deteval implementation
 
 from collections import namedtuple
+import math
+
+import numpy as np
+
 import pyxlpr.data.icdar.rrc_evaluation_funcs_1_1 as rrc_evaluation_funcs
-import importlib
+from pyxlpr.data.icdar.icdar2013 import rect_overlap_matrices
 
 def evaluation_imports():
     """
@@ -33,7 +37,8 @@ def default_evaluation_params():
                 'MTYPE_OM_M':1.,
                 'GT_SAMPLE_NAME_2_ID':'gt_img_([0-9]+).txt',
                 'DET_SAMPLE_NAME_2_ID':'res_img_([0-9]+).txt',
-                'CRLF':False # Lines are delimited by Windows CRLF format
+                'CRLF':False, # Lines are delimited by Windows CRLF format
+                'MAX_WORKERS':1 # ckz: number of processes evaluating the samples, None uses all cpus
             }
 
 def validate_data(gtFilePath, submFilePath,evaluationParams):
@@ -58,50 +63,25 @@ def validate_data(gtFilePath, submFilePath,evaluationParams):
         rrc_evaluation_funcs.validate_lines_in_file(k,subm[k],evaluationParams['CRLF'],True,False)
 
 
-def evaluate_method(gtFilePath, submFilePath, evaluationParams):
+Rectangle = namedtuple('Rectangle', 'xmin ymin xmax ymax')
+Point = namedtuple('Point', 'x y')
+
+
+def evaluate_sample(gtFile, detFile, evaluationParams):
     """
-    Method evaluate_method: evaluate method and returns the results
-        Results. Dictionary with the following values:
-        - method (required)  Global method metrics. Ex: { 'Precision':0.8,'Recall':0.9 }
-        - samples (optional) Per sample metrics. Ex: {'sample1' : { 'Precision':0.8,'Recall':0.9 } , 'sample2' : { 'Precision':0.8,'Recall':0.9 }
+    ckz: Evaluates one sample (image). detFile is None when the sample is not present in the submission.
+    Returns a dict with the per sample metrics and the accumulators needed for the global metrics.
     """
 
-    for module,alias in evaluation_imports().items():
-        globals()[alias] = importlib.import_module(module)
-
     def one_to_one_match(row, col):
-        cont = 0
-        for j in range(len(recallMat[0])):
-            if recallMat[row,j] >= evaluationParams['AREA_RECALL_CONSTRAINT'] and precisionMat[row,j] >= evaluationParams['AREA_PRECISION_CONSTRAINT'] :
-                cont = cont +1
-        if (cont != 1):
-            return False
-        cont = 0
-        for i in range(len(recallMat)):
-            if recallMat[i,col] >= evaluationParams['AREA_RECALL_CONSTRAINT'] and precisionMat[i,col] >= evaluationParams['AREA_PRECISION_CONSTRAINT'] :
-                cont = cont +1
-        if (cont != 1):
-            return False
-
-        if recallMat[row,col] >= evaluationParams['AREA_RECALL_CONSTRAINT'] and precisionMat[row,col] >= evaluationParams['AREA_PRECISION_CONSTRAINT'] :
-            return True
-        return False
+        # the number of matches in every row and column is fixed, so it is counted once instead of scanning them per pair
+        return rowMatchCount[row] == 1 and colMatchCount[col] == 1 and bool(areaMatchMat[row, col])
 
     def num_overlaps_gt(gtNum):
-        cont = 0
-        for detNum in range(len(detRects)):
-            if detNum not in detDontCareRectsNum:
-                if recallMat[gtNum,detNum] > 0 :
-                    cont = cont +1
-        return cont
+        return int(gtOverlapCount[gtNum])
 
     def num_overlaps_det(detNum):
-        cont = 0
-        for gtNum in range(len(recallMat)):
-            if gtNum not in gtDontCareRectsNum:
-                if recallMat[gtNum,detNum] > 0 :
-                    cont = cont +1
-        return cont
+        return int(detOverlapCount[detNum])
 
     def is_single_overlap(row, col):
         if num_overlaps_gt(row)==1 and num_overlaps_det(col)==1:
@@ -110,39 +90,29 @@ def evaluate_method(gtFilePath, submFilePath, evaluationParams):
             return False
 
     def one_to_many_match(gtNum):
-        many_sum = 0
-        detRects = []
-        for detNum in range(len(recallMat[0])):
-            if gtRectMat[gtNum] == 0 and detRectMat[detNum] == 0 and detNum not in detDontCareRectsNum:
-                if precisionMat[gtNum,detNum] >= evaluationParams['AREA_PRECISION_CONSTRAINT'] :
-                    many_sum += recallMat[gtNum,detNum]
-                    detRects.append(detNum)
+        if gtRectMat[gtNum] != 0:
+            detRects = []
+        else:
+            mask = (detRectMat == 0) & ~detDontCareMask & (precisionMat[gtNum] >= evaluationParams['AREA_PRECISION_CONSTRAINT'])
+            detRects = np.flatnonzero(mask).tolist()
+        many_sum = sum(recallMat[gtNum, detRects].tolist())
         if round(many_sum,4) >=evaluationParams['AREA_RECALL_CONSTRAINT'] :
             return True,detRects
         else:
             return False,[]
 
     def many_to_one_match(detNum):
-        many_sum = 0
-        gtRects = []
-        for gtNum in range(len(recallMat)):
-            if gtRectMat[gtNum] == 0 and detRectMat[detNum] == 0 and gtNum not in gtDontCareRectsNum:
-                if recallMat[gtNum,detNum] >= evaluationParams['AREA_RECALL_CONSTRAINT'] :
-                    many_sum += precisionMat[gtNum,detNum]
-                    gtRects.append(gtNum)
+        if detRectMat[detNum] != 0:
+            gtRects = []
+        else:
+            mask = (gtRectMat == 0) & ~gtDontCareMask & (recallMat[:, detNum] >= evaluationParams['AREA_RECALL_CONSTRAINT'])
+            gtRects = np.flatnonzero(mask).tolist()
+        many_sum = sum(precisionMat[gtRects, detNum].tolist())
         if round(many_sum,4) >=evaluationParams['AREA_PRECISION_CONSTRAINT'] :
             return True,gtRects
         else:
             return False,[]
 
-    def area(a, b):
-            dx = min(a.xmax, b.xmax) - max(a.xmin, b.xmin) + 1
-            dy = min(a.ymax, b.ymax) - max(a.ymin, b.ymin) + 1
-            if (dx>=0) and (dy>=0):
-                    return dx*dy
-            else:
-                    return 0.
-
     def center(r):
         x = float(r.xmin) + float(r.xmax - r.xmin + 1) / 2.;
         y = float(r.ymin) + float(r.ymax - r.ymin + 1) / 2.;
@@ -162,18 +132,176 @@ def evaluate_method(gtFilePath, submFilePath, evaluationParams):
         h = (r.ymax - r.ymin + 1)
         return math.sqrt(h * h + w * w)
 
-    def rectangle_to_points(rect):
-        points = [int(rect.xmin), int(rect.ymax), int(rect.xmax), int(rect.ymax), int(rect.xmax), int(rect.ymin), int(rect.xmin), int(rect.ymin)]
-        return points
+    recall = 0
+    precision = 0
+    hmean = 0
+    recallAccum = 0.
+    precisionAccum = 0.
+    gtRects = []
+    detRects = []
+    gtPolPoints = []
+    detPolPoints = []
+    gtDontCareRectsNum = []#Array of Ground Truth Rectangles' keys marked as don't Care
+    detDontCareRectsNum = []#Array of Detected Rectangles' matched with a don't Care GT
+    pairs = []
+    evaluationLog = ""
+
+    recallMat = np.empty([1,1])
+    precisionMat = np.empty([1,1])
+
+    pointsList,_,transcriptionsList = rrc_evaluation_funcs.get_tl_line_values_from_file_contents(gtFile,evaluationParams['CRLF'],True,True,False)
+    for n in range(len(pointsList)):
+        points = pointsList[n]
+        transcription = transcriptionsList[n]
+        dontCare = transcription == "###"
+        gtRect = Rectangle(*points)
+        gtRects.append(gtRect)
+        gtPolPoints.append(points)
+        if dontCare:
+            gtDontCareRectsNum.append( len(gtRects)-1 )
+
+    evaluationLog += "GT rectangles: " + str(len(gtRects)) + (" (" + str(len(gtDontCareRectsNum)) + " don't care)\n" if len(gtDontCareRectsNum)>0 else "\n")
+
+    if detFile is not None:
+        pointsList,_,_ = rrc_evaluation_funcs.get_tl_line_values_from_file_contents(detFile,evaluationParams['CRLF'],True,False,False)
+        for n in range(len(pointsList)):
+            points = pointsList[n]
+            detRect = Rectangle(*points)
+            detRects.append(detRect)
+            detPolPoints.append(points)
+
+        if len(detRects)>0:
+            #Calculate recall and precision matrixs
+            recallMat, precisionMat = rect_overlap_matrices(gtRects, detRects)
+
+        if len(gtDontCareRectsNum)>0 and len(detRects)>0:
+            # a detection is don't care if it is mostly inside any don't care gt, precisionMat is intersected_area / rdDimensions
+            dontCarePrecision = precisionMat[gtDontCareRectsNum]
+            detDontCareRectsNum = np.flatnonzero((dontCarePrecision > evaluationParams['AREA_PRECISION_CONSTRAINT']).any(axis=0)).tolist()
+
+        evaluationLog += "DET rectangles: " + str(len(detRects)) + (" (" + str(len(detDontCareRectsNum)) + " don't care)\n" if len(detDontCareRectsNum)>0 else "\n")
+
+        if len(gtRects)==0:
+            recall = 1
+            precision = 0 if len(detRects)>0 else 1
+
+        if len(detRects)>0:
+            gtRectMat = np.zeros(len(gtRects),np.int8)
+            detRectMat = np.zeros(len(detRects),np.int8)
+            gtDontCareMask = np.zeros(len(gtRects), bool)
+            gtDontCareMask[gtDontCareRectsNum] = True
+            detDontCareMask = np.zeros(len(detRects), bool)
+            detDontCareMask[detDontCareRectsNum] = True
+            areaMatchMat = (recallMat >= evaluationParams['AREA_RECALL_CONSTRAINT']) & (precisionMat >= evaluationParams['AREA_PRECISION_CONSTRAINT'])
+            rowMatchCount, colMatchCount = areaMatchMat.sum(axis=1), areaMatchMat.sum(axis=0)
+            gtOverlapCount = ((recallMat > 0) & ~detDontCareMask[None, :]).sum(axis=1)
+            detOverlapCount = ((recallMat > 0) & ~gtDontCareMask[:, None]).sum(axis=0)
+
+            # Find one-to-one matches
+            evaluationLog += "Find one-to-one matches\n"
+            # only pairs passing both area constraints can be one-to-one matches, in the same row-major order
+            for gtNum, detNum in np.argwhere(areaMatchMat).tolist():
+                if gtRectMat[gtNum] == 0 and detRectMat[detNum] == 0 and not gtDontCareMask[gtNum] and not detDontCareMask[detNum] :
+                    match = one_to_one_match(gtNum, detNum)
+                    if match is True :
+                        #in deteval we have to make other validation before mark as one-to-one
+                        if is_single_overlap(gtNum, detNum) is True :
+                            rG = gtRects[gtNum]
+                            rD = detRects[detNum]
+                            normDist = center_distance(rG, rD);
+                            normDist /= diag(rG) + diag(rD);
+                            normDist *= 2.0;
+                            if normDist < evaluationParams['EV_PARAM_IND_CENTER_DIFF_THR'] :
+                                gtRectMat[gtNum] = 1
+                                detRectMat[detNum] = 1
+                                recallAccum += evaluationParams['MTYPE_OO_O']
+                                precisionAccum += evaluationParams['MTYPE_OO_O']
+                                pairs.append({'gt':gtNum,'det':detNum,'type':'OO'})
+                                evaluationLog += "Match GT #" + str(gtNum) + " with Det #" + str(detNum) + "\n"
+                            else:
+                                evaluationLog += "Match Discarded GT #" + str(gtNum) + " with Det #" + str(detNum) + " normDist: " + str(normDist) + " \n"
+                        else:
+                            evaluationLog += "Match Discarded GT #" + str(gtNum) + " with Det #" + str(detNum) + " not single overlap\n"
+            # Find one-to-many matches
+            evaluationLog += "Find one-to-many matches\n"
+            for gtNum in range(len(gtRects)):
+                if not gtDontCareMask[gtNum]:
+                    match,matchesDet = one_to_many_match(gtNum)
+                    if match is True :
+                        evaluationLog += "num_overlaps_gt=" + str(num_overlaps_gt(gtNum))
+                        #in deteval we have to make other validation before mark as one-to-one
+                        if num_overlaps_gt(gtNum)>=2 :
+                            gtRectMat[gtNum] = 1
+                            recallAccum += (evaluationParams['MTYPE_OO_O'] if len(matchesDet)==1 else evaluationParams['MTYPE_OM_O'])
+                            precisionAccum += (evaluationParams['MTYPE_OO_O'] if len(matchesDet)==1 else evaluationParams['MTYPE_OM_O']*len(matchesDet))
+                            pairs.append({'gt':gtNum,'det':matchesDet,'type': 'OO' if len(matchesDet)==1 else 'OM'})
+                            for detNum in matchesDet :
+                                detRectMat[detNum] = 1
+                            evaluationLog += "Match GT #" + str(gtNum) + " with Det #" + str(matchesDet) + "\n"
+                        else:
+                            evaluationLog += "Match Discarded GT #" + str(gtNum) + " with Det #" + str(matchesDet) + " not single overlap\n"
+
+            # Find many-to-one matches
+            evaluationLog += "Find many-to-one matches\n"
+            for detNum in range(len(detRects)):
+                if not detDontCareMask[detNum]:
+                    match,matchesGt = many_to_one_match(detNum)
+                    if match is True :
+                        #in deteval we have to make other validation before mark as one-to-one
+                        if num_overlaps_det(detNum)>=2 :
+                            detRectMat[detNum] = 1
+                            recallAccum += (evaluationParams['MTYPE_OO_O'] if len(matchesGt)==1 else evaluationParams['MTYPE_OM_M']*len(matchesGt))
+                            precisionAccum += (evaluationParams['MTYPE_OO_O'] if len(matchesGt)==1 else evaluationParams['MTYPE_OM_M'])
+                            pairs.append({'gt':matchesGt,'det':detNum,'type': 'OO' if len(matchesGt)==1 else 'MO'})
+                            for gtNum in matchesGt :
+                                gtRectMat[gtNum] = 1
+                            evaluationLog += "Match GT #" + str(matchesGt) + " with Det #" + str(detNum) + "\n"
+                        else:
+                            evaluationLog += "Match Discarded GT #" + str(matchesGt) + " with Det #" + str(detNum) + " not single overlap\n"
+
+            numGtCare = (len(gtRects) - len(gtDontCareRectsNum))
+            if numGtCare == 0:
+                recall = float(1)
+                precision = float(0) if len(detRects)>0 else float(1)
+            else:
+                recall = float(recallAccum) / numGtCare
+                precision =  float(0) if (len(detRects) - len(detDontCareRectsNum))==0 else float(precisionAccum) / (len(detRects) - len(detDontCareRectsNum))
+            hmean = 0 if (precision + recall)==0 else 2.0 * precision * recall / (precision + recall)
+
+    sampleMetrics = {
+                        'precision':precision,
+                        'recall':recall,
+                        'hmean':hmean,
+                        'pairs':pairs,
+                        'recallMat':[] if len(detRects)>100 else recallMat.tolist(),
+                        'precisionMat':[] if len(detRects)>100 else precisionMat.tolist(),
+                        'gtPolPoints':gtPolPoints,
+                        'detPolPoints':detPolPoints,
+                        'gtDontCare':gtDontCareRectsNum,
+                        'detDontCare':detDontCareRectsNum,
+                        'evaluationParams': evaluationParams,
+                        'evaluationLog': evaluationLog
+                    }
+    return {'metrics': sampleMetrics,
+            'recallAccum': recallAccum,
+            'precisionAccum': precisionAccum,
+            'numGt': len(gtRects) - len(gtDontCareRectsNum),
+            'numDet': len(detRects) - len(detDontCareRectsNum)}
+
+
+def evaluate_method(gtFilePath, submFilePath, evaluationParams):
+    """
+    Method evaluate_method: evaluate method and returns the results
+        Results. Dictionary with the following values:
+        - method (required)  Global method metrics. Ex: { 'Precision':0.8,'Recall':0.9 }
+        - samples (optional) Per sample metrics. Ex: {'sample1' : { 'Precision':0.8,'Recall':0.9 } , 'sample2' : { 'Precision':0.8,'Recall':0.9 }
+    """
 
     perSampleMetrics = {}
 
     methodRecallSum = 0
     methodPrecisionSum = 0
 
-    Rectangle = namedtuple('Rectangle', 'xmin ymin xmax ymax')
-    Point = namedtuple('Point', 'x y')
-
     if isinstance(gtFilePath, str):
         gt = rrc_evaluation_funcs.load_zip_file(gtFilePath,evaluationParams['GT_SAMPLE_NAME_2_ID'])
     else:
@@ -186,178 +314,12 @@ def evaluate_method(gtFilePath, submFilePath, evaluationParams):
     numGt = 0;
     numDet = 0;
 
-    for resFile in gt:
-        if isinstance(gt[resFile], bytes):
-            gtFile = rrc_evaluation_funcs.decode_utf8(gt[resFile])
-        else:
-            gtFile = gt[resFile]
-        recall = 0
-        precision = 0
-        hmean = 0
-        recallAccum = 0.
-        precisionAccum = 0.
-        gtRects = []
-        detRects = []
-        gtPolPoints = []
-        detPolPoints = []
-        gtDontCareRectsNum = []#Array of Ground Truth Rectangles' keys marked as don't Care
-        detDontCareRectsNum = []#Array of Detected Rectangles' matched with a don't Care GT
-        pairs = []
-        evaluationLog = ""
-
-        recallMat = np.empty([1,1])
-        precisionMat = np.empty([1,1])
-
-        pointsList,_,transcriptionsList = rrc_evaluation_funcs.get_tl_line_values_from_file_contents(gtFile,evaluationParams['CRLF'],True,True,False)
-        for n in range(len(pointsList)):
-            points = pointsList[n]
-            transcription = transcriptionsList[n]
-            dontCare = transcription == "###"
-            gtRect = Rectangle(*points)
-            gtRects.append(gtRect)
-            gtPolPoints.append(points)
-            if dontCare:
-                gtDontCareRectsNum.append( len(gtRects)-1 )
-
-        evaluationLog += "GT rectangles: " + str(len(gtRects)) + (" (" + str(len(gtDontCareRectsNum)) + " don't care)\n" if len(gtDontCareRectsNum)>0 else "\n")
-
-        if resFile in subm:
-            if isinstance(subm[resFile], bytes):
-                detFile = rrc_evaluation_funcs.decode_utf8(subm[resFile])
-            else:
-                detFile = subm[resFile]
-            pointsList,_,_ = rrc_evaluation_funcs.get_tl_line_values_from_file_contents(detFile,evaluationParams['CRLF'],True,False,False)
-            for n in range(len(pointsList)):
-                points = pointsList[n]
-                detRect = Rectangle(*points)
-                detRects.append(detRect)
-                detPolPoints.append(points)
-                if len(gtDontCareRectsNum)>0 :
-                    for dontCareRectNum in gtDontCareRectsNum:
-                        dontCareRect = gtRects[dontCareRectNum]
-                        intersected_area = area(dontCareRect,detRect)
-                        rdDimensions = ( (detRect.xmax - detRect.xmin+1) * (detRect.ymax - detRect.ymin+1));
-                        if (rdDimensions==0) :
-                            precision = 0
-                        else:
-                            precision= intersected_area / rdDimensions
-                        if (precision > evaluationParams['AREA_PRECISION_CONSTRAINT'] ):
-                            detDontCareRectsNum.append( len(detRects)-1 )
-                            break
-
-            evaluationLog += "DET rectangles: " + str(len(detRects)) + (" (" + str(len(detDontCareRectsNum)) + " don't care)\n" if len(detDontCareRectsNum)>0 else "\n")
-
-            if len(gtRects)==0:
-                recall = 1
-                precision = 0 if len(detRects)>0 else 1
-
-            if len(detRects)>0:
-                #Calculate recall and precision matrixs
-                outputShape=[len(gtRects),len(detRects)]
-                recallMat = np.empty(outputShape)
-                precisionMat = np.empty(outputShape)
-                gtRectMat = np.zeros(len(gtRects),np.int8)
-                detRectMat = np.zeros(len(detRects),np.int8)
-                for gtNum in range(len(gtRects)):
-                    for detNum in range(len(detRects)):
-                        rG = gtRects[gtNum]
-                        rD = detRects[detNum]
-                        intersected_area = area(rG,rD)
-                        rgDimensions = ( (rG.xmax - rG.xmin+1) * (rG.ymax - rG.ymin+1) );
-                        rdDimensions = ( (rD.xmax - rD.xmin+1) * (rD.ymax - rD.ymin+1));
-                        recallMat[gtNum,detNum] = 0 if rgDimensions==0 else  intersected_area / rgDimensions
-                        precisionMat[gtNum,detNum] = 0 if rdDimensions==0 else intersected_area / rdDimensions
-
-                # Find one-to-one matches
-                evaluationLog += "Find one-to-one matches\n"
-                for gtNum in range(len(gtRects)):
-                    for detNum in range(len(detRects)):
-                        if gtRectMat[gtNum] == 0 and detRectMat[detNum] == 0 and gtNum not in gtDontCareRectsNum and detNum not in detDontCareRectsNum :
-                            match = one_to_one_match(gtNum, detNum)
-                            if match is True :
-                                #in deteval we have to make other validation before mark as one-to-one
-                                if is_single_overlap(gtNum, detNum) is True :
-                                    rG = gtRects[gtNum]
-                                    rD = detRects[detNum]
-                                    normDist = center_distance(rG, rD);
-                                    normDist /= diag(rG) + diag(rD);
-                                    normDist *= 2.0;
-                                    if normDist < evaluationParams['EV_PARAM_IND_CENTER_DIFF_THR'] :
-                                        gtRectMat[gtNum] = 1
-                                        detRectMat[detNum] = 1
-                                        recallAccum += evaluationParams['MTYPE_OO_O']
-                                        precisionAccum += evaluationParams['MTYPE_OO_O']
-                                        pairs.append({'gt':gtNum,'det':detNum,'type':'OO'})
-                                        evaluationLog += "Match GT #" + str(gtNum) + " with Det #" + str(detNum) + "\n"
-                                    else:
-                                        evaluationLog += "Match Discarded GT #" + str(gtNum) + " with Det #" + str(detNum) + " normDist: " + str(normDist) + " \n"
-                                else:
-                                    evaluationLog += "Match Discarded GT #" + str(gtNum) + " with Det #" + str(detNum) + " not single overlap\n"
-                # Find one-to-many matches
-                evaluationLog += "Find one-to-many matches\n"
-                for gtNum in range(len(gtRects)):
-                    if gtNum not in gtDontCareRectsNum:
-                        match,matchesDet = one_to_many_match(gtNum)
-                        if match is True :
-                            evaluationLog += "num_overlaps_gt=" + str(num_overlaps_gt(gtNum))
-                            #in deteval we have to make other validation before mark as one-to-one
-                            if num_overlaps_gt(gtNum)>=2 :
-                                gtRectMat[gtNum] = 1
-                                recallAccum += (evaluationParams['MTYPE_OO_O'] if len(matchesDet)==1 else evaluationParams['MTYPE_OM_O'])
-                                precisionAccum += (evaluationParams['MTYPE_OO_O'] if len(matchesDet)==1 else evaluationParams['MTYPE_OM_O']*len(matchesDet))
-                                pairs.append({'gt':gtNum,'det':matchesDet,'type': 'OO' if len(matchesDet)==1 else 'OM'})
-                                for detNum in matchesDet :
-                                    detRectMat[detNum] = 1
-                                evaluationLog += "Match GT #" + str(gtNum) + " with Det #" + str(matchesDet) + "\n"
-                            else:
-                                evaluationLog += "Match Discarded GT #" + str(gtNum) + " with Det #" + str(matchesDet) + " not single overlap\n"
-
-                # Find many-to-one matches
-                evaluationLog += "Find many-to-one matches\n"
-                for detNum in range(len(detRects)):
-                    if detNum not in detDontCareRectsNum:
-                        match,matchesGt = many_to_one_match(detNum)
-                        if match is True :
-                            #in deteval we have to make other validation before mark as one-to-one
-                            if num_overlaps_det(detNum)>=2 :
-                                detRectMat[detNum] = 1
-                                recallAccum += (evaluationParams['MTYPE_OO_O'] if len(matchesGt)==1 else evaluationParams['MTYPE_OM_M']*len(matchesGt))
-                                precisionAccum += (evaluationParams['MTYPE_OO_O'] if len(matchesGt)==1 else evaluationParams['MTYPE_OM_M'])
-                                pairs.append({'gt':matchesGt,'det':detNum,'type': 'OO' if len(matchesGt)==1 else 'MO'})
-                                for gtNum in matchesGt :
-                                    gtRectMat[gtNum] = 1
-                                evaluationLog += "Match GT #" + str(matchesGt) + " with Det #" + str(detNum) + "\n"
-                            else:
-                                evaluationLog += "Match Discarded GT #" + str(matchesGt) + " with Det #" + str(detNum) + " not single overlap\n"
-
-                numGtCare = (len(gtRects) - len(gtDontCareRectsNum))
-                if numGtCare == 0:
-                    recall = float(1)
-                    precision = float(0) if len(detRects)>0 else float(1)
-                else:
-                    recall = float(recallAccum) / numGtCare
-                    precision =  float(0) if (len(detRects) - len(detDontCareRectsNum))==0 else float(precisionAccum) / (len(detRects) - len(detDontCareRectsNum))
-                hmean = 0 if (precision + recall)==0 else 2.0 * precision * recall / (precision + recall)
-
-        methodRecallSum += recallAccum
-        methodPrecisionSum += precisionAccum
-        numGt += len(gtRects) - len(gtDontCareRectsNum)
-        numDet += len(detRects) - len(detDontCareRectsNum)
-
-        perSampleMetrics[resFile] = {
-                                        'precision':precision,
-                                        'recall':recall,
-                                        'hmean':hmean,
-                                        'pairs':pairs,
-                                        'recallMat':[] if len(detRects)>100 else recallMat.tolist(),
-                                        'precisionMat':[] if len(detRects)>100 else precisionMat.tolist(),
-                                        'gtPolPoints':gtPolPoints,
-                                        'detPolPoints':detPolPoints,
-                                        'gtDontCare':gtDontCareRectsNum,
-                                        'detDontCare':detDontCareRectsNum,
-                                        'evaluationParams': evaluationParams,
-                                        'evaluationLog': evaluationLog
-                                    }
+    for resFile, res in rrc_evaluation_funcs.map_samples(evaluate_sample, gt, subm, evaluationParams):
+        methodRecallSum += res['recallAccum']
+        methodPrecisionSum += res['precisionAccum']
+        numGt += res['numGt']
+        numDet += res['numDet']
+        perSampleMetrics[resFile] = res['metrics']
 
     methodRecall = 0 if numGt==0 else methodRecallSum/numGt
     methodPrecision = 0 if numDet==0 else methodPrecisionSum/numDet
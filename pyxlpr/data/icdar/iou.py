@@ -9,12 +9,14 @@
 #Average Precision is also calcuted when 'CONFIDENCES' parameter is True
 
 from collections import namedtuple
-import pyxlpr.data.icdar.rrc_evaluation_funcs_1_1 as rrc_evaluation_funcs
-import importlib
 
 import numpy as np
-# import shapely.geometry as plg
-import Polygon as plg
+import shapely
+
+import pyxlpr.data.icdar.rrc_evaluation_funcs_1_1 as rrc_evaluation_funcs
+# ckz: 原来用的Polygon3库（import Polygon as plg）在有些环境装不上、退出时还会崩溃，
+#   现在改用shapely，多边形只构造一次，用STRtree筛出可能相交的框再批量求交
+from pyxllib.algo.shapelylib import ShapelyPolygon, polygon_intersection_matrix
 
 # def evaluation_imports():
 #     """
@@ -38,7 +40,8 @@ def default_evaluation_params():
                 'LTRB':True, #LTRB:2points(left,top,right,bottom) or 4 points(x1,y1,x2,y2,x3,y3,x4,y4)
                 'CRLF':False, # Lines are delimited by Windows CRLF format
                 'CONFIDENCES':False, #Detections must include confidence value. AP will be calculated
-                'PER_SAMPLE_RESULTS':True #Generate per sample results and produce data for visualization
+                'PER_SAMPLE_RESULTS':True, #Generate per sample results and produce data for visualization
+                'MAX_WORKERS':1 # ckz: number of processes evaluating the samples, None uses all cpus
             }
 
 def validate_data(gtFilePath, submFilePath,evaluationParams):
@@ -63,260 +66,223 @@ def validate_data(gtFilePath, submFilePath,evaluationParams):
         rrc_evaluation_funcs.validate_lines_in_file(k,subm[k],evaluationParams['CRLF'],evaluationParams['LTRB'],False,evaluationParams['CONFIDENCES'])
 
 
-def evaluate_method(gtFilePath, submFilePath, evaluationParams):
+Rectangle = namedtuple('Rectangle', 'xmin ymin xmax ymax')
+
+
+def polygon_from_points(points):
     """
-    Method evaluate_method: evaluate method and returns the results
-        Results. Dictionary with the following values:
-        - method (required)  Global method metrics. Ex: { 'Precision':0.8,'Recall':0.9 }
-        - samples (optional) Per sample metrics. Ex: {'sample1' : { 'Precision':0.8,'Recall':0.9 } , 'sample2' : { 'Precision':0.8,'Recall':0.9 }
+    Returns the 4 corner coordinates from a list of 8 points: x1,y1,x2,y2,x3,y3,x4,y4
     """
+    return [[int(points[0]), int(points[1])], [int(points[2]), int(points[3])],
+            [int(points[4]), int(points[5])], [int(points[6]), int(points[7])]]
 
-    # for module,alias in evaluation_imports().items():
-    #     globals()[alias] = importlib.import_module(module)
-
-    def polygon_from_points(points):
-        """
-        Returns a Polygon object to use with the Polygon2 class from a list of 8 points: x1,y1,x2,y2,x3,y3,x4,y4
-        """
-        resBoxes=np.empty([1,8],dtype='int32')
-        resBoxes[0,0]=int(points[0])
-        resBoxes[0,4]=int(points[1])
-        resBoxes[0,1]=int(points[2])
-        resBoxes[0,5]=int(points[3])
-        resBoxes[0,2]=int(points[4])
-        resBoxes[0,6]=int(points[5])
-        resBoxes[0,3]=int(points[6])
-        resBoxes[0,7]=int(points[7])
-        pointMat = resBoxes[0].reshape([2,4]).T
-        return plg.Polygon(pointMat)
-
-    def rectangle_to_polygon(rect):
-        resBoxes=np.empty([1,8],dtype='int32')
-        resBoxes[0,0]=int(rect.xmin)
-        resBoxes[0,4]=int(rect.ymax)
-        resBoxes[0,1]=int(rect.xmin)
-        resBoxes[0,5]=int(rect.ymin)
-        resBoxes[0,2]=int(rect.xmax)
-        resBoxes[0,6]=int(rect.ymin)
-        resBoxes[0,3]=int(rect.xmax)
-        resBoxes[0,7]=int(rect.ymax)
-
-        pointMat = resBoxes[0].reshape([2,4]).T
-
-        return plg.Polygon(pointMat)
-
-    def rectangle_to_points(rect):
-        points = [int(rect.xmin), int(rect.ymax), int(rect.xmax), int(rect.ymax), int(rect.xmax), int(rect.ymin), int(rect.xmin), int(rect.ymin)]
-        return points
-
-    def get_union(pD,pG):
-        areaA = pD.area()
-        areaB = pG.area()
-        return areaA + areaB - get_intersection(pD, pG)
-
-    def get_intersection_over_union(pD,pG):
-        try:
-            return get_intersection(pD, pG) / get_union(pD, pG)
-        except:
-            return 0
-
-    def get_intersection(pD,pG):
-        pInt = pD & pG
-        if len(pInt) == 0:
-            return 0
-        return pInt.area()
-
-    def compute_ap(confList, matchList,numGtCare):
-        correct = 0
-        AP = 0
-        if len(confList)>0:
-            confList = np.array(confList)
-            matchList = np.array(matchList)
-            sorted_ind = np.argsort(-confList)
-            confList = confList[sorted_ind]
-            matchList = matchList[sorted_ind]
-            for n in range(len(confList)):
-                match = matchList[n]
-                if match:
-                    correct += 1
-                    AP += float(correct)/(n + 1)
-
-            if numGtCare>0:
-                AP /= numGtCare
-
-        return AP
 
-    perSampleMetrics = {}
+def rectangle_to_polygon(rect):
+    return [[int(rect.xmin), int(rect.ymax)], [int(rect.xmin), int(rect.ymin)],
+            [int(rect.xmax), int(rect.ymin)], [int(rect.xmax), int(rect.ymax)]]
 
-    matchedSum = 0
 
-    Rectangle = namedtuple('Rectangle', 'xmin ymin xmax ymax')
+def compute_ap(confList, matchList,numGtCare):
+    correct = 0
+    AP = 0
+    if len(confList)>0:
+        confList = np.array(confList)
+        matchList = np.array(matchList)
+        sorted_ind = np.argsort(-confList)
+        confList = confList[sorted_ind]
+        matchList = matchList[sorted_ind]
+        for n in range(len(confList)):
+            match = matchList[n]
+            if match:
+                correct += 1
+                AP += float(correct)/(n + 1)
 
-    if isinstance(gtFilePath, str):
-        gt = rrc_evaluation_funcs.load_zip_file(gtFilePath,evaluationParams['GT_SAMPLE_NAME_2_ID'])
-    else:
-        gt = gtFilePath
-    if isinstance(submFilePath, str):
-        subm = rrc_evaluation_funcs.load_zip_file(submFilePath,evaluationParams['DET_SAMPLE_NAME_2_ID'],True)
-    else:
-        subm = submFilePath
+        if numGtCare>0:
+            AP /= numGtCare
 
-    numGlobalCareGt = 0
-    numGlobalCareDet = 0
+    return AP
 
-    arrGlobalConfidences = []
-    arrGlobalMatches = []
 
-    for resFile in gt:
+def evaluate_sample(gtFile, detFile, evaluationParams):
+    """
+    ckz: Evaluates one sample (image). detFile is None when the sample is not present in the submission.
+    Returns a dict with the per sample metrics and the accumulators needed for the global metrics.
 
-        if isinstance(gt[resFile], bytes):
-            gtFile = rrc_evaluation_funcs.decode_utf8(gt[resFile])
-        else:
-            gtFile = gt[resFile]
+    The polygons are built once per sample; intersections are only computed for the gt/det pairs
+    whose bounding boxes overlap (STRtree), with the vectorized shapely api.
+    """
+    recall = 0
+    precision = 0
+    hmean = 0
 
-        recall = 0
-        precision = 0
-        hmean = 0
+    detMatched = 0
 
-        detMatched = 0
+    iouMat = np.empty([1,1])
 
-        iouMat = np.empty([1,1])
+    gtPols = []
+    detPols = []
 
-        gtPols = []
-        detPols = []
+    gtPolPoints = []
+    detPolPoints = []
 
-        gtPolPoints = []
-        detPolPoints = []
+    #Array of Ground Truth Polygons' keys marked as don't Care
+    gtDontCarePolsNum = []
+    #Array of Detected Polygons' matched with a don't Care GT
+    detDontCarePolsNum = []
 
-        #Array of Ground Truth Polygons' keys marked as don't Care
-        gtDontCarePolsNum = []
-        #Array of Detected Polygons' matched with a don't Care GT
-        detDontCarePolsNum = []
+    pairs = []
+    detMatchedNums = []
 
-        pairs = []
-        detMatchedNums = []
+    arrSampleConfidences = []
+    arrSampleMatch = []
+    sampleAP = 0
 
-        arrSampleConfidences = []
-        arrSampleMatch = []
-        sampleAP = 0
+    evaluationLog = ""
 
-        evaluationLog = ""
+    pointsList,_,transcriptionsList = rrc_evaluation_funcs.get_tl_line_values_from_file_contents(gtFile,evaluationParams['CRLF'],evaluationParams['LTRB'],True,False)
+    for n in range(len(pointsList)):
+        points = pointsList[n]
+        transcription = transcriptionsList[n]
+        dontCare = transcription == "###"
+        if evaluationParams['LTRB']:
+            gtRect = Rectangle(*points)
+            gtPol = rectangle_to_polygon(gtRect)
+        else:
+            gtPol = polygon_from_points(points)
+        gtPols.append(gtPol)
+        gtPolPoints.append(points)
+        if dontCare:
+            gtDontCarePolsNum.append( len(gtPols)-1 )
 
-        pointsList,_,transcriptionsList = rrc_evaluation_funcs.get_tl_line_values_from_file_contents(gtFile,evaluationParams['CRLF'],evaluationParams['LTRB'],True,False)
+    evaluationLog += "GT polygons: " + str(len(gtPols)) + (" (" + str(len(gtDontCarePolsNum)) + " don't care)\n" if len(gtDontCarePolsNum)>0 else "\n")
+
+    if detFile is not None:
+        pointsList,confidencesList,_ = rrc_evaluation_funcs.get_tl_line_values_from_file_contents(detFile,evaluationParams['CRLF'],evaluationParams['LTRB'],False,evaluationParams['CONFIDENCES'])
         for n in range(len(pointsList)):
             points = pointsList[n]
-            transcription = transcriptionsList[n]
-            dontCare = transcription == "###"
+
             if evaluationParams['LTRB']:
-                gtRect = Rectangle(*points)
-                gtPol = rectangle_to_polygon(gtRect)
+                detRect = Rectangle(*points)
+                detPol = rectangle_to_polygon(detRect)
             else:
-                gtPol = polygon_from_points(points)
-            gtPols.append(gtPol)
-            gtPolPoints.append(points)
-            if dontCare:
-                gtDontCarePolsNum.append( len(gtPols)-1 )
+                detPol = polygon_from_points(points)
+            detPols.append(detPol)
+            detPolPoints.append(points)
+
+        if len(gtPols)>0 and len(detPols)>0:
+            gtGeoms, detGeoms = ShapelyPolygon.gen_array(gtPols), ShapelyPolygon.gen_array(detPols)
+            interMat = polygon_intersection_matrix(gtGeoms, detGeoms)
+            gtAreas, detAreas = shapely.area(gtGeoms), shapely.area(detGeoms)
+
+            if len(gtDontCarePolsNum)>0 :
+                # a detection is don't care if it is mostly inside any don't care gt
+                dontCarePrecision = np.divide(interMat[gtDontCarePolsNum], detAreas[None, :],
+                                              out=np.zeros((len(gtDontCarePolsNum), len(detPols))), where=detAreas[None, :] != 0)
+                detDontCarePolsNum = np.flatnonzero((dontCarePrecision > evaluationParams['AREA_PRECISION_CONSTRAINT']).any(axis=0)).tolist()
+
+        evaluationLog += "DET polygons: " + str(len(detPols)) + (" (" + str(len(detDontCarePolsNum)) + " don't care)\n" if len(detDontCarePolsNum)>0 else "\n")
+
+        if len(gtPols)>0 and len(detPols)>0:
+            #Calculate IoU and precision matrixs
+            unionMat = gtAreas[:, None] + detAreas[None, :] - interMat
+            iouMat = np.divide(interMat, unionMat, out=np.zeros_like(interMat), where=unionMat != 0)
+            gtRectMat = np.zeros(len(gtPols),np.int8)
+            detRectMat = np.zeros(len(detPols),np.int8)
+            gtDontCareSet, detDontCareSet = set(gtDontCarePolsNum), set(detDontCarePolsNum)
+
+            # only pairs above the iou constraint can match, in the same row-major order
+            for gtNum, detNum in np.argwhere(iouMat > evaluationParams['IOU_CONSTRAINT']).tolist():
+                if gtRectMat[gtNum] == 0 and detRectMat[detNum] == 0 and gtNum not in gtDontCareSet and detNum not in detDontCareSet :
+                    gtRectMat[gtNum] = 1
+                    detRectMat[detNum] = 1
+                    detMatched += 1
+                    pairs.append({'gt':gtNum,'det':detNum})
+                    detMatchedNums.append(detNum)
+                    evaluationLog += "Match GT #" + str(gtNum) + " with Det #" + str(detNum) + "\n"
+
+        if evaluationParams['CONFIDENCES']:
+            detMatchedSet = set(detMatchedNums)
+            for detNum in range(len(detPols)):
+                if detNum not in detDontCarePolsNum :
+                    #we exclude the don't care detections
+                    match = detNum in detMatchedSet
+
+                    arrSampleConfidences.append(confidencesList[detNum])
+                    arrSampleMatch.append(match)
+
+    numGtCare = (len(gtPols) - len(gtDontCarePolsNum))
+    numDetCare = (len(detPols) - len(detDontCarePolsNum))
+    if numGtCare == 0:
+        recall = float(1)
+        precision = float(0) if numDetCare >0 else float(1)
+        sampleAP = precision
+    else:
+        recall = float(detMatched) / numGtCare
+        precision = 0 if numDetCare==0 else float(detMatched) / numDetCare
+        if evaluationParams['CONFIDENCES'] and evaluationParams['PER_SAMPLE_RESULTS']:
+            sampleAP = compute_ap(arrSampleConfidences, arrSampleMatch, numGtCare )
+
+    hmean = 0 if (precision + recall)==0 else 2.0 * precision * recall / (precision + recall)
+
+    sampleMetrics = None
+    if evaluationParams['PER_SAMPLE_RESULTS']:
+        sampleMetrics = {
+                            'precision':precision,
+                            'recall':recall,
+                            'hmean':hmean,
+                            'pairs':pairs,
+                            'AP':sampleAP,
+                            'iouMat':[] if len(detPols)>100 else iouMat.tolist(),
+                            'gtPolPoints':gtPolPoints,
+                            'detPolPoints':detPolPoints,
+                            'gtDontCare':gtDontCarePolsNum,
+                            'detDontCare':detDontCarePolsNum,
+                            'evaluationParams': evaluationParams,
+                            'evaluationLog': evaluationLog
+                        }
+    return {'metrics': sampleMetrics,
+            'detMatched': detMatched,
+            'numGtCare': numGtCare,
+            'numDetCare': numDetCare,
+            'confidences': arrSampleConfidences,
+            'matches': arrSampleMatch}
 
-        evaluationLog += "GT polygons: " + str(len(gtPols)) + (" (" + str(len(gtDontCarePolsNum)) + " don't care)\n" if len(gtDontCarePolsNum)>0 else "\n")
 
-        if resFile in subm:
+def evaluate_method(gtFilePath, submFilePath, evaluationParams):
+    """
+    Method evaluate_method: evaluate method and returns the results
+        Results. Dictionary with the following values:
+        - method (required)  Global method metrics. Ex: { 'Precision':0.8,'Recall':0.9 }
+        - samples (optional) Per sample metrics. Ex: {'sample1' : { 'Precision':0.8,'Recall':0.9 } , 'sample2' : { 'Precision':0.8,'Recall':0.9 }
+    """
+    perSampleMetrics = {}
 
-            if isinstance(subm[resFile], bytes):
-                detFile = rrc_evaluation_funcs.decode_utf8(subm[resFile])
-            else:
-                detFile = subm[resFile]
-
-            pointsList,confidencesList,_ = rrc_evaluation_funcs.get_tl_line_values_from_file_contents(detFile,evaluationParams['CRLF'],evaluationParams['LTRB'],False,evaluationParams['CONFIDENCES'])
-            for n in range(len(pointsList)):
-                points = pointsList[n]
-
-                if evaluationParams['LTRB']:
-                    detRect = Rectangle(*points)
-                    detPol = rectangle_to_polygon(detRect)
-                else:
-                    detPol = polygon_from_points(points)
-                detPols.append(detPol)
-                detPolPoints.append(points)
-                if len(gtDontCarePolsNum)>0 :
-                    for dontCarePol in gtDontCarePolsNum:
-                        dontCarePol = gtPols[dontCarePol]
-                        intersected_area = get_intersection(dontCarePol,detPol)
-                        pdDimensions = detPol.area()
-                        precision = 0 if pdDimensions == 0 else intersected_area / pdDimensions
-                        if (precision > evaluationParams['AREA_PRECISION_CONSTRAINT'] ):
-                            detDontCarePolsNum.append( len(detPols)-1 )
-                            break
-
-            evaluationLog += "DET polygons: " + str(len(detPols)) + (" (" + str(len(detDontCarePolsNum)) + " don't care)\n" if len(detDontCarePolsNum)>0 else "\n")
-
-            if len(gtPols)>0 and len(detPols)>0:
-                #Calculate IoU and precision matrixs
-                outputShape=[len(gtPols),len(detPols)]
-                iouMat = np.empty(outputShape)
-                gtRectMat = np.zeros(len(gtPols),np.int8)
-                detRectMat = np.zeros(len(detPols),np.int8)
-                for gtNum in range(len(gtPols)):
-                    for detNum in range(len(detPols)):
-                        pG = gtPols[gtNum]
-                        pD = detPols[detNum]
-                        iouMat[gtNum,detNum] = get_intersection_over_union(pD,pG)
-
-                for gtNum in range(len(gtPols)):
-                    for detNum in range(len(detPols)):
-                        if gtRectMat[gtNum] == 0 and detRectMat[detNum] == 0 and gtNum not in gtDontCarePolsNum and detNum not in detDontCarePolsNum :
-                            if iouMat[gtNum,detNum]>evaluationParams['IOU_CONSTRAINT']:
-                                gtRectMat[gtNum] = 1
-                                detRectMat[detNum] = 1
-                                detMatched += 1
-                                pairs.append({'gt':gtNum,'det':detNum})
-                                detMatchedNums.append(detNum)
-                                evaluationLog += "Match GT #" + str(gtNum) + " with Det #" + str(detNum) + "\n"
-
-            if evaluationParams['CONFIDENCES']:
-                for detNum in range(len(detPols)):
-                    if detNum not in detDontCarePolsNum :
-                        #we exclude the don't care detections
-                        match = detNum in detMatchedNums
-
-                        arrSampleConfidences.append(confidencesList[detNum])
-                        arrSampleMatch.append(match)
-
-                        arrGlobalConfidences.append(confidencesList[detNum])
-                        arrGlobalMatches.append(match)
-
-        numGtCare = (len(gtPols) - len(gtDontCarePolsNum))
-        numDetCare = (len(detPols) - len(detDontCarePolsNum))
-        if numGtCare == 0:
-            recall = float(1)
-            precision = float(0) if numDetCare >0 else float(1)
-            sampleAP = precision
-        else:
-            recall = float(detMatched) / numGtCare
-            precision = 0 if numDetCare==0 else float(detMatched) / numDetCare
-            if evaluationParams['CONFIDENCES'] and evaluationParams['PER_SAMPLE_RESULTS']:
-                sampleAP = compute_ap(arrSampleConfidences, arrSampleMatch, numGtCare )
+    matchedSum = 0
 
-        hmean = 0 if (precision + recall)==0 else 2.0 * precision * recall / (precision + recall)
+    if isinstance(gtFilePath, str):
+        gt = rrc_evaluation_funcs.load_zip_file(gtFilePath,evaluationParams['GT_SAMPLE_NAME_2_ID'])
+    else:
+        gt = gtFilePath
+    if isinstance(submFilePath, str):
+        subm = rrc_evaluation_funcs.load_zip_file(submFilePath,evaluationParams['DET_SAMPLE_NAME_2_ID'],True)
+    else:
+        subm = submFilePath
+
+    numGlobalCareGt = 0
+    numGlobalCareDet = 0
+
+    arrGlobalConfidences = []
+    arrGlobalMatches = []
 
-        matchedSum += detMatched
-        numGlobalCareGt += numGtCare
-        numGlobalCareDet += numDetCare
+    for resFile, res in rrc_evaluation_funcs.map_samples(evaluate_sample, gt, subm, evaluationParams):
+        matchedSum += res['detMatched']
+        numGlobalCareGt += res['numGtCare']
+        numGlobalCareDet += res['numDetCare']
+        arrGlobalConfidences += res['confidences']
+        arrGlobalMatches += res['matches']
 
         if evaluationParams['PER_SAMPLE_RESULTS']:
-            perSampleMetrics[resFile] = {
-                                            'precision':precision,
-                                            'recall':recall,
-                                            'hmean':hmean,
-                                            'pairs':pairs,
-                                            'AP':sampleAP,
-                                            'iouMat':[] if len(detPols)>100 else iouMat.tolist(),
-                                            'gtPolPoints':gtPolPoints,
-                                            'detPolPoints':detPolPoints,
-                                            'gtDontCare':gtDontCarePolsNum,
-                                            'detDontCare':detDontCarePolsNum,
-                                            'evaluationParams': evaluationParams,
-                                            'evaluationLog': evaluationLog
-                                        }
+            perSampleMetrics[resFile] = res['metrics']
 
     # Compute MAP and MAR
     AP = 0
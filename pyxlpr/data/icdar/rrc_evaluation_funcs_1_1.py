@@ -89,6 +89,34 @@ def decode_utf8(raw):
     except:
        return None
 
+def _evaluate_sample_task(evaluate_sample_fn, evaluationParams, task):
+    return evaluate_sample_fn(task[0], task[1], evaluationParams)
+
+
+def map_samples(evaluate_sample_fn, gt, subm, evaluationParams):
+    """
+    ckz: Calls evaluate_sample_fn(gtFile, detFile, evaluationParams) for every sample of gt and returns [(resFile, result), ...]
+    detFile is None when the sample is not present in the submission.
+    With evaluationParams['MAX_WORKERS'] != 1 the samples are evaluated in a process pool (None uses all cpus).
+    """
+    def tasks():
+        for resFile in gt:
+            gtFile = decode_utf8(gt[resFile]) if isinstance(gt[resFile], bytes) else gt[resFile]
+            detFile = None
+            if resFile in subm:
+                detFile = decode_utf8(subm[resFile]) if isinstance(subm[resFile], bytes) else subm[resFile]
+            yield gtFile, detFile
+
+    maxWorkers = evaluationParams.get('MAX_WORKERS', 1)
+    if maxWorkers == 1:
+        results = [evaluate_sample_fn(gtFile, detFile, evaluationParams) for gtFile, detFile in tasks()]
+    else:
+        import functools
+        from pyxllib.prog.specialist.xlexecutor import XlExecutor
+        func = functools.partial(_evaluate_sample_task, evaluate_sample_fn, evaluationParams)
+        results = list(XlExecutor(maxWorkers, 'process', chunk_size=16).map(func, tasks()))
+    return list(zip(gt.keys(), results))
+
 def validate_lines_in_file(fileName,file_contents,CRLF=True,LTRB=True,withTranscription=False,withConfidence=False,imWidth=0,imHeight=0):
     """
     This function validates that all lines of the file calling the Line validation function for each line
@@ -307,8 +307,8 @@ class ToLabelmeJson:
     @classmethod
     def main_pair(cls, images, labels):
         """ 一一配对匹配处理 """
-        Iterate(zip(images, labels)).run(lambda x: cls.create_json(x[0], x[1]),
-                                         pinterval='20%', max_workers=8)
+        pairs = list(zip(images, labels))  # zip没有长度，转成list才能按百分比输出进度
+        Iterate(pairs).run(lambda x: cls.create_json(x[0], x[1]), pinterval='20%', max_workers=8)
 
 
 class Quad2Labelme(ToLabelmeJson):